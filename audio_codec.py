@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+АУДИО-КОДЕКИ: G.711 μ-law (2:1) и IMA-ADPCM (4:1)
+Общие для клиента и сервера, ответный декодер - в плеере (server.py)
+
+μ-law кодируется и декодируется таблицами на весь диапазон int16.
+
+IMA-ADPCM: каждый кадр - независимый блок, чтобы потеря пакета не ломала
+следующие:
+
+    predictor  h   начальное значение предсказателя (little-endian)
+    index      B   начальный индекс шага
+    flags      B   бит 0 - последний полубайт пустой (нечётное число сэмплов)
+    codes          4-битные коды, младший полубайт первым
+
+Кодер ADPCM последовательный по своей природе (каждый код зависит от
+восстановленного предсказателя), поэтому в цикле остаётся только
+рекурсия по целым числам, всё остальное - векторно.
+"""
+import struct
+
+import numpy as np
+
+import protocol
+
+# Имена кодеков в приветствии spy -> формат кадра
+CODECS = {
+    'pcm16': protocol.FORMAT_PCM16,
+    'ulaw': protocol.FORMAT_ULAW,
+    'adpcm': protocol.FORMAT_ADPCM,
+}
+CODEC_NAMES = {fmt: name for name, fmt in CODECS.items()}
+
+# ========== G.711 μ-law ==========
+ULAW_BIAS = 0x84
+ULAW_CLIP = 32635
+
+
+def _build_ulaw_tables():
+    # Кодирование: индекс - int16 как uint16
+    pcm = np.arange(65536, dtype=np.uint16).view(np.int16).astype(np.int32)
+    sign = np.where(pcm < 0, 0x80, 0)
+    magnitude = np.minimum(np.abs(pcm), ULAW_CLIP) + ULAW_BIAS
+    exponent = np.floor(np.log2(magnitude)).astype(np.int32) - 7
+    mantissa = (magnitude >> (exponent + 3)) & 0x0F
+    encode = (~(sign | (exponent << 4) | mantissa) & 0xFF).astype(np.uint8)
+
+    # Декодирование: 256 значений
+    codes = ~np.arange(256, dtype=np.int32) & 0xFF
+    exponent = (codes >> 4) & 0x07
+    mantissa = codes & 0x0F
+    magnitude = (((mantissa << 3) + ULAW_BIAS) << exponent) - ULAW_BIAS
+    decode = np.where(codes & 0x80, -magnitude, magnitude).astype(np.int16)
+    return encode, decode
+
+
+ULAW_ENCODE_TABLE, ULAW_DECODE_TABLE = _build_ulaw_tables()
+
+
+def ulaw_encode(pcm):
+    """int16 -> байты μ-law"""
+    return ULAW_ENCODE_TABLE[np.asarray(pcm, dtype=np.int16).view(np.uint16)].tobytes()
+
+
+def ulaw_decode(data):
+    """Байты μ-law -> int16"""
+    return ULAW_DECODE_TABLE[np.frombuffer(data, dtype=np.uint8)]
+
+
+# ========== IMA-ADPCM ==========
+ADPCM_HEADER = struct.Struct('<hBB')
+ADPCM_FLAG_ODD = 0x01
+
+ADPCM_STEPS = np.array([
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767
+], dtype=np.int32)
+ADPCM_INDEX_ADJUST = np.array([-1, -1, -1, -1, 2, 4, 6, 8] * 2, dtype=np.int32)
+
+
+def _build_adpcm_tables():
+    # Приращение предсказателя и следующий индекс для (индекс, код)
+    step = ADPCM_STEPS[:, None]
+    code = np.arange(16, dtype=np.int32)[None, :]
+    delta = (step >> 3) + np.where(code & 4, step, 0) \
+        + np.where(code & 2, step >> 1, 0) + np.where(code & 1, step >> 2, 0)
+    delta = np.where(code & 8, -delta, delta)
+    next_index = np.clip(np.arange(89)[:, None] + ADPCM_INDEX_ADJUST[None, :], 0, 88)
+    return delta.astype(np.int32), next_index.astype(np.int32)
+
+
+ADPCM_DELTA, ADPCM_NEXT_INDEX = _build_adpcm_tables()
+_DELTA_ROWS = ADPCM_DELTA.tolist()
+_NEXT_ROWS = ADPCM_NEXT_INDEX.tolist()
+_STEPS = ADPCM_STEPS.tolist()
+
+
+class AdpcmEncoder:
+    """Кодер IMA-ADPCM, состояние переносится между кадрами"""
+
+    def __init__(self):
+        self.predictor = 0
+        self.index = 0
+
+    def encode(self, pcm):
+        samples = np.asarray(pcm, dtype=np.int16)
+        header = ADPCM_HEADER.pack(self.predictor, self.index,
+                                   ADPCM_FLAG_ODD if len(samples) % 2 else 0)
+
+        codes = []
+        predictor, index = self.predictor, self.index
+        for sample in samples.tolist():
+            diff = sample - predictor
+            step = _STEPS[index]
+            if diff < 0:
+                code = min(7, (-diff << 2) // step) | 8
+            else:
+                code = min(7, (diff << 2) // step)
+            predictor += _DELTA_ROWS[index][code]
+            if predictor > 32767:
+                predictor = 32767
+            elif predictor < -32768:
+                predictor = -32768
+            index = _NEXT_ROWS[index][code]
+            codes.append(code)
+        self.predictor, self.index = predictor, index
+
+        if len(codes) % 2:
+            codes.append(0)
+        codes = np.array(codes, dtype=np.uint8)
+        packed = codes[0::2] | (codes[1::2] << 4)
+        return header + packed.tobytes()
+
+
+def adpcm_decode(data):
+    """Блок IMA-ADPCM -> int16 (без состояния между кадрами)"""
+    predictor, index, flags = ADPCM_HEADER.unpack_from(data)
+    packed = np.frombuffer(data, dtype=np.uint8, offset=ADPCM_HEADER.size)
+    codes = np.empty(len(packed) * 2, dtype=np.int32)
+    codes[0::2] = packed & 0x0F
+    codes[1::2] = packed >> 4
+    if flags & ADPCM_FLAG_ODD:
+        codes = codes[:-1]
+
+    # Индексы шага зависят только от кодов: короткий цикл по целым
+    indices = []
+    for code in codes.tolist():
+        indices.append(index)
+        index = _NEXT_ROWS[index][code]
+
+    # Предсказатель - накопленная сумма приращений
+    deltas = ADPCM_DELTA[indices, codes]
+    samples = predictor + np.cumsum(deltas)
+    if samples.size and (samples.max() > 32767 or samples.min() < -32768):
+        # Редкий случай насыщения: ограничение на каждом шаге
+        for i, delta in enumerate(deltas.tolist()):
+            predictor = min(32767, max(-32768, predictor + delta))
+            samples[i] = predictor
+    return samples.astype(np.int16)
+
+
+# ========== Ресемплинг ==========
+RESAMPLER_TAPS = 31
+
+
+class Resampler:
+    """Потоковый ресемплер: ФНЧ (windowed sinc) при понижении частоты +
+    линейная интерполяция, состояние переносится между кадрами"""
+
+    def __init__(self, src_rate, dst_rate):
+        self.src_rate = src_rate
+        self.dst_rate = dst_rate
+        self.step = src_rate / dst_rate
+        self.position = 0.0
+        self.tail = np.zeros(1, dtype=np.float32)
+        self.fir = None
+        if dst_rate < src_rate:
+            cutoff = 0.5 * dst_rate / src_rate
+            n = np.arange(RESAMPLER_TAPS) - (RESAMPLER_TAPS - 1) / 2
+            fir = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(RESAMPLER_TAPS)
+            self.fir = (fir / fir.sum()).astype(np.float32)
+            self.fir_state = np.zeros(RESAMPLER_TAPS - 1, dtype=np.float32)
+
+    def process(self, pcm):
+        """int16 -> int16 на новой частоте"""
+        samples = np.asarray(pcm, dtype=np.float32)
+        if self.fir is not None:
+            filtered = np.concatenate((self.fir_state, samples))
+            self.fir_state = filtered[-(RESAMPLER_TAPS - 1):]
+            samples = np.convolve(filtered, self.fir, mode='valid')
+
+        buffer = np.concatenate((self.tail, samples))
+        last = len(buffer) - 1
+        count = max(0, int(np.ceil((last - self.position) / self.step)))
+        positions = self.position + np.arange(count) * self.step
+        index = positions.astype(np.int64)
+        frac = (positions - index).astype(np.float32)
+        output = buffer[index] * (1 - frac) + buffer[np.minimum(index + 1, last)] * frac
+
+        self.position += count * self.step - last
+        self.tail = buffer[-1:]
+        return np.clip(np.rint(output), -32768, 32767).astype(np.int16)
+
+
+def encode(fmt, pcm, adpcm_encoder=None):
+    """int16 -> данные кадра в формате fmt"""
+    if fmt == protocol.FORMAT_PCM16:
+        return np.asarray(pcm, dtype='<i2').tobytes()
+    if fmt == protocol.FORMAT_ULAW:
+        return ulaw_encode(pcm)
+    if fmt == protocol.FORMAT_ADPCM:
+        return (adpcm_encoder or AdpcmEncoder()).encode(pcm)
+    raise ValueError(f"unknown audio format: {fmt}")
+
+
+def decode(fmt, payload):
+    """Данные кадра любого формата -> int16"""
+    if fmt == protocol.FORMAT_PCM16:
+        return np.frombuffer(payload, dtype='<i2')
+    if fmt == protocol.FORMAT_ULAW:
+        return ulaw_decode(payload)
+    if fmt == protocol.FORMAT_ADPCM:
+        return adpcm_decode(payload)
+    raise ValueError(f"unknown audio format: {fmt}")
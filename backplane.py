@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ОБЩАЯ ШИНА МЕЖДУ УЗЛАМИ РЕЛЕЯ
+Узлы за балансировщиком публикуют кадры своих источников и события по
+каналам, а получают чужие - так слушатель на любом узле слышит источник,
+подключённый к другому. Свои сообщения узел отбрасывает по node id.
+
+    memory              в пределах процесса (разработка, проверки)
+    redis://[:пароль@]хост[:порт][/бд]
+                        Redis pub/sub; подойдёт и redis-server, и любой
+                        сервер с тем же протоколом (RESP)
+
+Каналы шины: <prefix>frame:<id канала> - кадры, <prefix>event:<id> - события
+(JSON). Кадр в шине: FRAME_META (узел, длительность кадра, профиль) + кадр.
+Отправка не ждёт: если соединение занято или потеряно, кадр отбрасывается.
+"""
+import abc
+import asyncio
+import json
+import struct
+from urllib.parse import urlparse
+
+# Узел (до NODE_ID_SIZE байт), длительность кадра (десятые мс), код профиля
+NODE_ID_SIZE = 16
+FRAME_META = struct.Struct(f'!{NODE_ID_SIZE}sHB')
+DEFAULT_PREFIX = 'audio:'
+# Буфер записи, после которого кадры в Redis отбрасываются, байт
+WRITE_BUFFER_LIMIT = 1024 * 1024
+RECONNECT_MIN = 0.5
+RECONNECT_MAX = 10.0
+
+
+class Backplane(abc.ABC):
+    """Общий интерфейс: on_frame(node, channel_id, frame, frame_ms, profile)
+    и on_event(node, channel_id, event) вызываются в цикле событий узла"""
+
+    def __init__(self, node, prefix=DEFAULT_PREFIX):
+        # Обрезанный id совпал бы у узлов с общим началом, и они
+        # отбрасывали бы кадры друг друга как свои
+        node_bytes = node.encode()
+        if not node_bytes or len(node_bytes) > NODE_ID_SIZE:
+            raise ValueError(f"node id must be 1-{NODE_ID_SIZE} bytes: {node!r}")
+        self.node = node
+        self.node_bytes = node_bytes.ljust(NODE_ID_SIZE)
+        self.prefix = prefix
+        self.on_frame = None
+        self.on_event = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+
+    async def start(self, on_frame, on_event):
+        self.on_frame = on_frame
+        self.on_event = on_event
+
+    async def close(self):
+        pass
+
+    @property
+    def connected(self):
+        return True
+
+    def publish_frame(self, channel_id, frame, frame_ms=0.0, profile=0):
+        payload = FRAME_META.pack(self.node_bytes, min(65535, int(frame_ms * 10)), profile) + frame
+        if self.send(f'{self.prefix}frame:{channel_id}', payload):
+            self.published += 1
+        else:
+            self.dropped += 1
+
+    def publish_event(self, channel_id, event):
+        payload = json.dumps(dict(event, node=self.node)).encode()
+        if not self.send(f'{self.prefix}event:{channel_id}', payload):
+            self.dropped += 1
+
+    @abc.abstractmethod
+    def send(self, topic, payload):
+        """Отправка без ожидания; False - сообщение отброшено"""
+
+    # Сообщение из шины: разбор, отсев своих и передача узлу
+    def deliver(self, topic, payload):
+        if not topic.startswith(self.prefix):
+            return
+        kind, _, channel_id = topic[len(self.prefix):].partition(':')
+        if kind == 'frame':
+            if len(payload) < FRAME_META.size:
+                return
+            node, frame_ms, profile = FRAME_META.unpack_from(payload)
+            if node == self.node_bytes:
+                return
+            self.received += 1
+            self.on_frame(node.decode().strip(), channel_id, bytes(payload[FRAME_META.size:]),
+                          frame_ms / 10, profile)
+        elif kind == 'event':
+            event = json.loads(payload)
+            node = event.pop('node', None)
+            if node != self.node:
+                self.on_event(node, channel_id, event)
+
+    def stats(self):
+        return {
+            "node": self.node,
+            "connected": self.connected,
+            "published": self.published,
+            "received": self.received,
+            "dropped": self.dropped
+        }
+
+
+# Подписчики шины memory в этом процессе
+_memory_nodes = []
+
+
+class InProcessBackplane(Backplane):
+    """Шина внутри процесса: доставка через call_soon, как из сети"""
+
+    async def start(self, on_frame, on_event):
+        await super().start(on_frame, on_event)
+        self.loop = asyncio.get_running_loop()
+        _memory_nodes.append(self)
+
+    async def close(self):
+        if self in _memory_nodes:
+            _memory_nodes.remove(self)
+
+    def send(self, topic, payload):
+        payload = bytes(payload)
+        for node in _memory_nodes:
+            if node is not self:
+                node.loop.call_soon_threadsafe(node.deliver, topic, payload)
+        return True
+
+
+class RedisError(Exception):
+    pass
+
+
+def encode_command(*args):
+    """Команда RESP: массив bulk-строк"""
+    parts = [b'*%d\r\n' % len(args)]
+    for arg in args:
+        if isinstance(arg, str):
+            arg = arg.encode()
+        parts.append(b'$%d\r\n' % len(arg))
+        parts.append(arg)
+        parts.append(b'\r\n')
+    return b''.join(parts)
+
+
+async def read_reply(reader):
+    """Один ответ RESP2"""
+    line = await reader.readline()
+    if not line.endswith(b'\r\n'):
+        raise ConnectionError("connection closed")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b'+':
+        return rest
+    if kind == b'-':
+        raise RedisError(rest.decode(errors='replace'))
+    if kind == b':':
+        return int(rest)
+    if kind == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        return (await reader.readexactly(length + 2))[:-2]
+    if kind == b'*':
+        length = int(rest)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise RedisError(f"unexpected reply: {line[:32]!r}")
+
+
+class RedisBackplane(Backplane):
+    """Redis pub/sub: одно соединение на PUBLISH, второе на PSUBSCRIBE"""
+
+    def __init__(self, url, node, prefix=DEFAULT_PREFIX):
+        super().__init__(node, prefix)
+        parsed = urlparse(url)
+        self.host = parsed.hostname or 'localhost'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.writer = None
+        self.task = None
+
+    @property
+    def connected(self):
+        return self.writer is not None
+
+    async def start(self, on_frame, on_event):
+        await super().start(on_frame, on_event)
+        self.task = asyncio.create_task(self.run())
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            # Ждём, пока run() закроет соединения
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def connect(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            writer.write(encode_command('AUTH', self.password))
+            await read_reply(reader)
+        if self.db:
+            writer.write(encode_command('SELECT', str(self.db)))
+            await read_reply(reader)
+        return reader, writer
+
+    # Соединения и переподключение с нарастающей паузой
+    async def run(self):
+        delay = RECONNECT_MIN
+        while True:
+            pub_writer = sub_writer = None
+            try:
+                pub_reader, pub_writer = await self.connect()
+                sub_reader, sub_writer = await self.connect()
+                sub_writer.write(encode_command('PSUBSCRIBE', self.prefix + '*'))
+                await read_reply(sub_reader)
+                self.writer = pub_writer
+                delay = RECONNECT_MIN
+                print(f"🔗 Backplane connected to {self.host}:{self.port}")
+                # Ответы на PUBLISH не нужны, но их надо вычитывать
+                tasks = [asyncio.create_task(self.discard_replies(pub_reader)),
+                         asyncio.create_task(self.listen(sub_reader))]
+                try:
+                    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                finally:
+                    # И при обрыве, и при close() обе задачи завершены и разобраны
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                for task in done:
+                    task.result()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ Backplane error: {e}")
+            finally:
+                self.writer = None
+                for writer in (pub_writer, sub_writer):
+                    if writer is not None:
+                        writer.close()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RECONNECT_MAX)
+
+    async def discard_replies(self, reader):
+        while True:
+            try:
+                await read_reply(reader)
+            except RedisError as e:
+                print(f"❌ Backplane publish error: {e}")
+
+    async def listen(self, reader):
+        while True:
+            message = await read_reply(reader)
+            if isinstance(message, list) and len(message) == 4 and message[0] == b'pmessage':
+                try:
+                    self.deliver(message[2].decode(), message[3])
+                except Exception as e:
+                    print(f"❌ Backplane message error: {e}")
+
+    def send(self, topic, payload):
+        writer = self.writer
+        if writer is None or writer.transport.get_write_buffer_size() > WRITE_BUFFER_LIMIT:
+            return False
+        writer.write(encode_command('PUBLISH', topic, payload))
+        return True
+
+
+def create_backplane(spec, node, prefix=DEFAULT_PREFIX):
+    """Шина по строке BACKPLANE; пустая строка - без шины"""
+    if not spec:
+        return None
+    if spec == 'memory':
+        return InProcessBackplane(node, prefix)
+    if spec.startswith('redis://'):
+        return RedisBackplane(spec, node, prefix)
+    raise ValueError(f"unknown backplane: {spec}")
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+БЕНЧМАРК: CPU РЕЛЕЯ НА ПЕРЕСЛАННЫЙ МЕГАБАЙТ
+Сравнивает цикл пересылки до и после быстрого пути:
+
+    json      - базовая версия: json.loads каждого base64-сообщения + send_str
+    header    - бинарные кадры с разбором заголовка (protocol.unpack_header)
+    fastpath  - server.source_audio_frames + server.relay_frame (опкод + префикс)
+
+Слушатели - заглушки без сети, поэтому измеряется только работа релея.
+
+Запуск:
+    python benchmarks/relay_cpu.py [--packets 5000] [--listeners 10]
+"""
+import argparse
+import asyncio
+import base64
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from aiohttp import WSMessage, WSMsgType
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import protocol
+import server
+
+SAMPLE_RATE = 16000
+CHUNK_SIZE = 1024
+
+
+class NullListener:
+    """Слушатель-заглушка: считает байты, ничего не отправляет"""
+    closed = False
+    format = None
+
+    def __init__(self):
+        self.bytes_sent = 0
+
+    async def send_str(self, data):
+        self.bytes_sent += len(data)
+
+    async def send_bytes(self, data):
+        self.bytes_sent += len(data)
+
+    # Как server.Listener.enqueue: цикл источника только ставит в очередь
+    def enqueue(self, frame):
+        self.bytes_sent += len(frame)
+
+
+def make_messages(count, binary):
+    """Заранее готовим входящие сообщения, как их отдаёт aiohttp"""
+    rng = np.random.default_rng(0)
+    messages = []
+    for packet_id in range(count):
+        pcm = rng.integers(-8000, 8000, CHUNK_SIZE, dtype=np.int16).tobytes()
+        if binary:
+            data = protocol.pack_frame(pcm, packet_id, time.time(), SAMPLE_RATE)
+            messages.append(WSMessage(WSMsgType.BINARY, data, None))
+        else:
+            data = json.dumps({
+                "type": "audio",
+                "data": base64.b64encode(pcm).decode('ascii'),
+                "packet_id": packet_id,
+                "timestamp": time.time(),
+                "sample_rate": SAMPLE_RATE
+            })
+            messages.append(WSMessage(WSMsgType.TEXT, data, None))
+    return messages
+
+
+async def relay_json(messages, listeners):
+    # Цикл из базовой версии server.py
+    for audio_msg in messages:
+        audio_data = json.loads(audio_msg.data)
+        if audio_data.get('type') == 'audio':
+            for listener in list(listeners):
+                if not listener.closed:
+                    await listener.send_str(audio_msg.data)
+
+
+async def relay_header(messages, listeners):
+    for audio_msg in messages:
+        protocol.unpack_header(audio_msg.data)
+        for listener in list(listeners):
+            if not listener.closed:
+                await listener.send_bytes(audio_msg.data)
+
+
+async def relay_fastpath(messages, listeners):
+    channel = server.Channel('bench')
+    for listener in listeners:
+        channel.add(listener)
+    for audio_msg in messages:
+        for frame in server.source_audio_frames(audio_msg):
+            server.relay_frame(channel, frame)
+
+
+def run_case(name, relay, messages, listener_count):
+    listeners = [NullListener() for _ in range(listener_count)]
+
+    cpu_start = time.process_time()
+    asyncio.run(relay(messages, listeners))
+    cpu = time.process_time() - cpu_start
+
+    forwarded_mb = sum(l.bytes_sent for l in listeners) / 1e6
+    # Полезная нагрузка (PCM) одинакова для всех вариантов, base64 - нет
+    audio_mb = len(messages) * CHUNK_SIZE * 2 * listener_count / 1e6
+    return {
+        "case": name,
+        "cpu_sec": cpu,
+        "forwarded_mb": forwarded_mb,
+        "cpu_ms_per_mb": cpu * 1000 / forwarded_mb if forwarded_mb else 0.0,
+        "cpu_ms_per_audio_mb": cpu * 1000 / audio_mb if audio_mb else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay CPU per forwarded MB")
+    parser.add_argument("--packets", type=int, default=5000)
+    parser.add_argument("--listeners", type=int, default=10)
+    args = parser.parse_args()
+
+    json_messages = make_messages(args.packets, binary=False)
+    binary_messages = make_messages(args.packets, binary=True)
+
+    results = [
+        run_case("json", relay_json, json_messages, args.listeners),
+        run_case("header", relay_header, binary_messages, args.listeners),
+        run_case("fastpath", relay_fastpath, binary_messages, args.listeners),
+    ]
+
+    print(f"\n📊 {args.packets} пакетов x {args.listeners} слушателей, чанк {CHUNK_SIZE}")
+    print(f"{'case':10} {'cpu, s':>8} {'MB out':>8} {'cpu ms/MB':>10} {'ms/audio MB':>12}")
+    for r in results:
+        print(f"{r['case']:10} {r['cpu_sec']:8.3f} {r['forwarded_mb']:8.1f} "
+              f"{r['cpu_ms_per_mb']:10.3f} {r['cpu_ms_per_audio_mb']:12.3f}")
+
+
+if __name__ == "__main__":
+    main()
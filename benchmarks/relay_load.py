@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+БЕНЧМАРК: НАГРУЗКА НА РЕЛЕЙ
+Запускает server.py отдельным процессом и подключает к нему N синтетических
+источников (приветствие spy + бинарные аудио-кадры со сгенерированным PCM в
+реальном времени) и M слушателей, распределённых по каналам источников.
+
+Для каждой комбинации N x M x размер кадра измеряет:
+
+    throughput   кадров и мегабайт в секунду, доставленных слушателям
+    latency      p50/p99 от отправки кадра источником до приёма слушателем, мс
+    drops        доля кадров, не дошедших до слушателей (по пропускам packet_id)
+    fanout       время рассылки кадра на сервере: среднее и p50/p99 по
+                 корзинам гистограммы relay_fanout_seconds (/metrics), мкс
+    cpu, rss     загрузка CPU и память процесса сервера (Linux, /proc)
+
+Источник и слушатели живут в одном процессе с asyncio, поэтому на больших M
+генератор может упереться в себя раньше сервера - смотрите на client_cpu.
+
+Запуск:
+    python benchmarks/relay_load.py [--sources 1,4] [--listeners 1,10,50]
+        [--frame-sizes 320,1024] [--duration 10] [--output results.json]
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import protocol
+
+SAMPLE_RATE = 16000
+WARMUP = 1.0
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def process_usage(pid):
+    """(CPU сек, RSS байт) процесса из /proc; None там, где /proc нет"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        with open(f'/proc/{pid}/status') as f:
+            rss = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmRSS:'))
+        return cpu, rss
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None, None
+
+
+async def start_server(port):
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, 'server.py')],
+        cwd=ROOT,
+        env=dict(os.environ, PORT=str(port)),
+        stdout=subprocess.DEVNULL
+    )
+    url = f'http://127.0.0.1:{port}'
+    async with aiohttp.ClientSession() as session:
+        for _ in range(100):
+            try:
+                async with session.get(url + '/health') as response:
+                    if response.status == 200:
+                        return proc
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+    proc.kill()
+    raise RuntimeError("server did not start")
+
+
+async def fanout_stats(session, url):
+    """Гистограмма relay_fanout_seconds из /metrics: {"sum", "count",
+    "buckets": [(граница, накопленное число), ...]}; None - метрик нет"""
+    try:
+        async with session.get(url + '/metrics') as response:
+            text = await response.text()
+    except aiohttp.ClientError:
+        return None
+    stats = {"buckets": []}
+    for line in text.splitlines():
+        if line.startswith('relay_fanout_seconds_bucket{'):
+            labels, value = line.rsplit(' ', 1)
+            bound = labels.split('le="', 1)[1].split('"', 1)[0]
+            stats["buckets"].append((float(bound), float(value)))
+        elif line.startswith('relay_fanout_seconds_sum '):
+            stats["sum"] = float(line.split()[1])
+        elif line.startswith('relay_fanout_seconds_count '):
+            stats["count"] = float(line.split()[1])
+    if "count" not in stats:
+        return None
+    return stats
+
+
+def fanout_delta(start, end):
+    """Замеры за время прогона: разность двух снимков гистограммы"""
+    if start is None or end is None:
+        return None
+    return {
+        "sum": end["sum"] - start["sum"],
+        "count": end["count"] - start["count"],
+        "buckets": [(bound, count - start_count)
+                    for (bound, count), (_, start_count) in zip(end["buckets"], start["buckets"])]
+    }
+
+
+def histogram_quantile(buckets, point):
+    """Квантиль по накопленным корзинам, как histogram_quantile в Prometheus:
+    линейно внутри корзины; попало в +Inf - последняя конечная граница"""
+    total = buckets[-1][1]
+    if not total:
+        return None
+    rank = point * total
+    lower, below = 0.0, 0.0
+    for bound, cumulative in buckets:
+        if cumulative >= rank:
+            if math.isinf(bound):
+                return lower
+            inside = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 1.0)
+        lower, below = bound, cumulative
+    return lower
+
+
+class SyntheticSource:
+    """Источник: тон с шумом, кадры по frame_size сэмплов в реальном времени"""
+
+    def __init__(self, index, frame_size):
+        self.id = f'bench-{index}'
+        self.frame_size = frame_size
+        self.sent = 0
+        rng = np.random.default_rng(index)
+        t = np.arange(SAMPLE_RATE) / SAMPLE_RATE
+        tone = 6000 * np.sin(2 * np.pi * (220 + 55 * index) * t) + rng.normal(0, 300, SAMPLE_RATE)
+        self.pcm = tone.astype(np.int16)
+
+    async def run(self, session, url, ready, stop):
+        async with session.ws_connect(url + '/ws') as ws:
+            # Без профиля: сервер принимает chunk_size как есть
+            await ws.send_str(json.dumps({
+                "type": "spy",
+                "sample_rate": SAMPLE_RATE,
+                "chunk_size": self.frame_size,
+                "channels": 1,
+                "client": self.id,
+                "codecs": ["pcm16"]
+            }))
+            await ws.receive()
+            ready.set()
+
+            period = self.frame_size / SAMPLE_RATE
+            started = time.perf_counter()
+            position = 0
+            while not stop.is_set():
+                chunk = np.take(self.pcm, range(position, position + self.frame_size), mode='wrap')
+                position = (position + self.frame_size) % SAMPLE_RATE
+                await ws.send_bytes(protocol.pack_frame(
+                    chunk.tobytes(), self.sent, time.time(), SAMPLE_RATE))
+                self.sent += 1
+                await asyncio.sleep(max(0.0, started + self.sent * period - time.perf_counter()))
+
+
+class HeadlessListener:
+    """Слушатель: считает кадры, байты, пропуски packet_id и задержку"""
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.frames = 0
+        self.bytes = 0
+        self.lost = 0
+        self.last_packet = None
+        self.latencies = []
+        self.measuring = False
+
+    async def run(self, session, url, ready, stop):
+        async with session.ws_connect(url + '/ws') as ws:
+            await ws.send_str(json.dumps({"type": "listener", "channel": self.channel}))
+            ready.set()
+            while not stop.is_set():
+                try:
+                    msg = await asyncio.wait_for(ws.receive(), timeout=0.5)
+                except asyncio.TimeoutError:
+                    continue
+                if msg.type == aiohttp.WSMsgType.BINARY:
+                    self.on_frame(msg.data)
+                elif msg.type in (aiohttp.WSMsgType.CLOSE, aiohttp.WSMsgType.CLOSED,
+                                  aiohttp.WSMsgType.ERROR):
+                    break
+
+    def on_frame(self, frame):
+        received = time.time()
+        packet_id = protocol.packet_id(frame)
+        # Предзагрузка из истории и кадры до разогрева не считаются
+        if not self.measuring:
+            self.last_packet = packet_id
+            return
+        if self.last_packet is not None and packet_id > self.last_packet + 1:
+            self.lost += packet_id - self.last_packet - 1
+        if self.last_packet is None or packet_id > self.last_packet:
+            self.last_packet = packet_id
+        self.frames += 1
+        self.bytes += len(frame)
+        self.latencies.append(received - protocol.timestamp(frame))
+
+
+async def run_case(source_count, listener_count, frame_size, duration):
+    port = free_port()
+    url = f'http://127.0.0.1:{port}'
+    server = await start_server(port)
+    stop = asyncio.Event()
+    try:
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            sources = [SyntheticSource(i, frame_size) for i in range(source_count)]
+            listeners = [HeadlessListener(sources[i % source_count].id) for i in range(listener_count)]
+
+            tasks = []
+            for client in itertools.chain(sources, listeners):
+                ready = asyncio.Event()
+                tasks.append(asyncio.create_task(client.run(session, url, ready, stop)))
+                await asyncio.wait_for(ready.wait(), timeout=10)
+
+            await asyncio.sleep(WARMUP)
+            for listener in listeners:
+                listener.measuring = True
+            sent_start = sum(source.sent for source in sources)
+            fanout_start = await fanout_stats(session, url)
+            server_cpu_start, _ = process_usage(server.pid)
+            client_cpu_start = time.process_time()
+            wall_start = time.perf_counter()
+
+            await asyncio.sleep(duration)
+
+            wall = time.perf_counter() - wall_start
+            client_cpu = time.process_time() - client_cpu_start
+            server_cpu_end, rss = process_usage(server.pid)
+            fanout_end = await fanout_stats(session, url)
+            sent = sum(source.sent for source in sources) - sent_start
+
+            stop.set()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        server.terminate()
+        server.wait()
+
+    latencies = np.array([value for listener in listeners for value in listener.latencies])
+    received = sum(listener.frames for listener in listeners)
+    lost = sum(listener.lost for listener in listeners)
+    fanout = fanout_delta(fanout_start, fanout_end)
+    if fanout is None or not fanout["count"]:
+        fanout = None
+    return {
+        "sources": source_count,
+        "listeners": listener_count,
+        "frame_size": frame_size,
+        "frame_ms": frame_size * 1000 / SAMPLE_RATE,
+        "duration": wall,
+        "frames_sent": sent,
+        "frames_received": received,
+        "frames_lost": lost,
+        "drop_rate": lost / (received + lost) if received + lost else 0.0,
+        "throughput_fps": received / wall,
+        "throughput_mbps": sum(listener.bytes for listener in listeners) / wall / 1e6,
+        "latency_p50_ms": float(np.percentile(latencies, 50) * 1000) if latencies.size else None,
+        "latency_p99_ms": float(np.percentile(latencies, 99) * 1000) if latencies.size else None,
+        "fanout_mean_us": fanout["sum"] / fanout["count"] * 1e6 if fanout else None,
+        "fanout_p50_us": histogram_quantile(fanout["buckets"], 0.5) * 1e6 if fanout else None,
+        "fanout_p99_us": histogram_quantile(fanout["buckets"], 0.99) * 1e6 if fanout else None,
+        "server_cpu": (server_cpu_end - server_cpu_start) / wall if server_cpu_end is not None else None,
+        "server_rss_mb": rss / 1e6 if rss is not None else None,
+        "client_cpu": client_cpu / wall,
+    }
+
+
+def fmt(value, spec):
+    return format(value, spec) if value is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay load benchmark")
+    parser.add_argument("--sources", type=parse_list, default=[1, 4])
+    parser.add_argument("--listeners", type=parse_list, default=[1, 10, 50])
+    parser.add_argument("--frame-sizes", type=parse_list, default=[320, 1024])
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--output", help="JSON file for results")
+    args = parser.parse_args()
+
+    results = []
+    # p50/p99 ms - от источника до слушателя; fan-out - на сервере, мкс
+    print(f"{'N':>3} {'M':>4} {'frame':>6} {'fps':>8} {'MB/s':>7} {'p50 ms':>7} {'p99 ms':>7} "
+          f"{'drops':>7} {'fan avg':>8} {'fan p50':>8} {'fan p99':>8} {'cpu':>5} {'rss MB':>7} {'gen cpu':>7}")
+    for source_count, listener_count, frame_size in itertools.product(
+            args.sources, args.listeners, args.frame_sizes):
+        r = asyncio.run(run_case(source_count, listener_count, frame_size, args.duration))
+        results.append(r)
+        print(f"{r['sources']:3} {r['listeners']:4} {r['frame_size']:6} {r['throughput_fps']:8.0f} "
+              f"{r['throughput_mbps']:7.2f} {fmt(r['latency_p50_ms'], '7.1f')} {fmt(r['latency_p99_ms'], '7.1f')} "
+              f"{r['drop_rate']:7.2%} {fmt(r['fanout_mean_us'], '8.1f')} {fmt(r['fanout_p50_us'], '8.1f')} "
+              f"{fmt(r['fanout_p99_us'], '8.1f')} {fmt(r['server_cpu'], '5.0%')} "
+              f"{fmt(r['server_rss_mb'], '7.1f')} {r['client_cpu']:7.0%}", flush=True)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                "started": time.strftime('%Y-%m-%dT%H:%M:%S'),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "sample_rate": SAMPLE_RATE,
+                "duration": args.duration,
+                "results": results
+            }, f, indent=2)
+        print(f"\n💾 Результаты: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
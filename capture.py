@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ИСТОЧНИКИ ЗВУКА ДЛЯ КЛИЕНТА
+Все источники одинаково вызывают callback(samples, overflow) из своего
+потока, как PortAudio, поэтому дальше клиент работает одинаково:
+
+    sounddevice                         микрофон (по умолчанию)
+    file:<путь.wav|путь.raw>[,speed=2][,loop=1]
+                                        воспроизведение файла в реальном
+                                        времени или ускоренно; raw - int16 LE
+                                        с частотой и каналами клиента
+    tone[:<Гц>][,level=0.25]            синусоида
+    noise[,level=0.1]                   белый шум
+
+Файлы и генераторы не требуют звуковой карты (CI, нагрузочные тесты).
+"""
+import abc
+import threading
+import time
+import wave
+
+import numpy as np
+
+import audio_codec
+
+
+class SounddeviceCapture:
+    """Микрофон через PortAudio"""
+
+    def __init__(self, sample_rate, channels, blocksize):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.stream = None
+        self.finished = False
+
+    def describe(self):
+        import sounddevice as sd
+        try:
+            return sd.query_devices(sd.default.device[0])['name']
+        except Exception:
+            return "микрофон по умолчанию"
+
+    def start(self, callback):
+        # Импорт здесь: без PortAudio остальные источники работают
+        import sounddevice as sd
+
+        def on_audio(indata, frames, time_info, status):
+            callback(np.frombuffer(indata, dtype=np.int16), status.input_overflow)
+
+        self.stream = sd.RawInputStream(
+            samplerate=self.sample_rate,
+            blocksize=self.blocksize,
+            channels=self.channels,
+            dtype='int16',
+            callback=on_audio
+        )
+        self.stream.start()
+
+    def stop(self):
+        if self.stream:
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+
+class _ThreadCapture(abc.ABC):
+    """Источник с собственным потоком: блоки по blocksize в темпе speed"""
+
+    def __init__(self, sample_rate, channels, blocksize, speed=1.0):
+        if speed <= 0:
+            raise ValueError(f"speed must be positive: {speed}")
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.blocksize = blocksize
+        self.speed = speed
+        self.running = False
+        self.finished = False
+        self.thread = None
+
+    def start(self, callback):
+        self.running = True
+        self.thread = threading.Thread(target=self._run, args=(callback,), daemon=True)
+        self.thread.start()
+
+    def _run(self, callback):
+        period = self.blocksize / self.sample_rate / self.speed
+        next_time = time.perf_counter()
+        while self.running:
+            block = self.read_block()
+            if block is None:
+                # Конец данных: пустой блок будит отправителя
+                self.finished = True
+                callback(np.zeros(0, dtype=np.int16), False)
+                return
+            callback(block, False)
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    @abc.abstractmethod
+    def read_block(self):
+        """Следующий блок int16 (blocksize * channels сэмплов); None - данные кончились"""
+
+    def stop(self):
+        self.running = False
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+
+class FileCapture(_ThreadCapture):
+    """WAV (int16) или raw int16 LE, приводится к частоте и каналам клиента"""
+
+    def __init__(self, sample_rate, channels, blocksize, path, speed=1.0, loop=False):
+        super().__init__(sample_rate, channels, blocksize, speed)
+        self.path = path
+        self.loop = loop
+        self.samples = self.load(path)
+        if not len(self.samples):
+            raise ValueError(f"no audio in {path}")
+        self.position = 0
+
+    def load(self, path):
+        if not path.lower().endswith('.wav'):
+            return np.fromfile(path, dtype='<i2')
+
+        with wave.open(path, 'rb') as wav:
+            if wav.getsampwidth() != 2:
+                raise ValueError(f"{path}: only 16-bit WAV is supported")
+            file_rate = wav.getframerate()
+            file_channels = wav.getnchannels()
+            data = np.frombuffer(wav.readframes(wav.getnframes()), dtype='<i2')
+
+        # Каналы файла -> моно -> частота клиента -> каналы клиента
+        mono = data.reshape(-1, file_channels).mean(axis=1).astype(np.int16)
+        if file_rate != self.sample_rate:
+            mono = audio_codec.Resampler(file_rate, self.sample_rate).process(mono)
+        if self.channels > 1:
+            return np.repeat(mono, self.channels)
+        return mono
+
+    def describe(self):
+        mode = f", x{self.speed:g}" if self.speed != 1 else ""
+        return f"файл {self.path} ({len(self.samples) / self.channels / self.sample_rate:.1f} с{mode})"
+
+    def read_block(self):
+        count = self.blocksize * self.channels
+        if self.position >= len(self.samples):
+            if not self.loop:
+                return None
+            self.position = 0
+        block = self.samples[self.position:self.position + count]
+        self.position += count
+        if self.loop and len(block) < count:
+            # Склейка конца с началом
+            self.position = count - len(block)
+            block = np.concatenate((block, self.samples[:self.position]))
+        return block
+
+
+class SyntheticCapture(_ThreadCapture):
+    """Синусоида или белый шум"""
+
+    def __init__(self, sample_rate, channels, blocksize, kind='tone', frequency=440.0, level=None):
+        super().__init__(sample_rate, channels, blocksize)
+        self.kind = kind
+        self.frequency = frequency
+        self.level = level if level is not None else (0.25 if kind == 'tone' else 0.1)
+        self.position = 0
+        self.rng = np.random.default_rng()
+
+    def describe(self):
+        if self.kind == 'tone':
+            return f"тон {self.frequency:g} Гц, уровень {self.level:g}"
+        return f"шум, уровень {self.level:g}"
+
+    def read_block(self):
+        if self.kind == 'tone':
+            t = (self.position + np.arange(self.blocksize)) / self.sample_rate
+            signal = np.sin(2 * np.pi * self.frequency * t)
+        else:
+            signal = self.rng.uniform(-1, 1, self.blocksize)
+        self.position += self.blocksize
+        block = np.clip(signal * self.level * 32767, -32768, 32767).astype(np.int16)
+        if self.channels > 1:
+            return np.repeat(block, self.channels)
+        return block
+
+
+def create_capture(spec, sample_rate, channels, blocksize):
+    """Источник по строке вида kind[:arg][,key=value...] (см. описание модуля)"""
+    kind, _, rest = spec.partition(':')
+    if ',' in kind:
+        kind, _, rest = spec.partition(',')
+    params = [item for item in rest.split(',') if item]
+    arg = params.pop(0) if params and '=' not in params[0] else None
+    options = dict(item.split('=', 1) for item in params)
+
+    if kind == 'sounddevice':
+        return SounddeviceCapture(sample_rate, channels, blocksize)
+    if kind == 'file':
+        if not arg:
+            raise ValueError("file capture needs a path: file:<path>")
+        return FileCapture(sample_rate, channels, blocksize, arg,
+                           speed=float(options.get('speed', 1)),
+                           loop=options.get('loop', '0') not in ('0', 'false', 'no'))
+    if kind in ('tone', 'noise'):
+        level = float(options['level']) if 'level' in options else None
+        return SyntheticCapture(sample_rate, channels, blocksize, kind,
+                                frequency=float(arg or options.get('frequency', 440)),
+                                level=level)
+    raise ValueError(f"unknown capture backend: {kind}")
@@ -7,11 +7,14 @@
 import asyncio
 import websockets
 import json
-import base64
+import os
 import time
 import sys
 import numpy as np
-import sounddevice as sd
+
+import audio_codec
+import capture
+import protocol
 
 # ========== НАСТРОЙКИ ==========
 # ВАШ АДРЕС НА RENDER - ЗАМЕНИТЕ НА СВОЙ!
@@ -19,16 +22,117 @@ SERVER_URL = "wss://audio-spy-system.onrender.com/ws"  # <-- ЗАМЕНИТЕ Н
 
 # Аудио параметры
 SAMPLE_RATE = 16000      # 16 kHz
-CHUNK_SIZE = 1024        # Размер чанка
 CHANNELS = 1             # Моно
 
+# Профиль задержки: low-latency (кадры 20 мс), balanced (60 мс), bulk (120 мс).
+# Размер кадра подтверждает сервер в ответ на приветствие
+PROFILE = "balanced"
+
+# Id источника: слушатели подписываются на канал с этим именем
+CLIENT_ID = "render_client"
+# Комната: сервер сводит все источники комнаты в канал room:<имя> (None - без комнаты)
+ROOM = None
+
+# Кодеки в порядке предпочтения: adpcm (4:1), ulaw (2:1), pcm16 (без сжатия)
+CODECS = ["adpcm", "ulaw", "pcm16"]
+
+# Источник звука (см. capture.py): sounddevice - микрофон; без звуковой карты
+# file:voice.wav[,speed=2][,loop=1], tone:440 или noise. Можно задать в CAPTURE
+CAPTURE = os.environ.get("CAPTURE", "sounddevice")
+
+# Кольцевой буфер захвата, секунд
+RING_SECONDS = 5
+
+# Если канал к серверу не успевает: накопившиеся кадры уходят одним
+# сообщением (не больше MAX_FRAMES_PER_MESSAGE), а всё старше
+# MAX_BACKLOG_MS выбрасывается - лучше пропуск, чем растущая задержка
+MAX_FRAMES_PER_MESSAGE = 16
+MAX_BACKLOG_MS = 1000
+
+# Синхронизация часов с сервером при подключении: число обменов
+TIME_SYNC_PINGS = 5
+
+# Переподключение: пауза растёт вдвое от RECONNECT_BASE_DELAY до
+# RECONNECT_MAX_DELAY, половина её случайна (protocol.retry_delay), чтобы
+# после рестарта сервера клиенты не пришли разом; подсказку сервера
+# retry_after выполняем. После RECONNECT_ATTEMPTS неудач подряд - выход
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
+RECONNECT_ATTEMPTS = 10
+
+class HelloRejected(Exception):
+    """Сервер не принял приветствие (частота, каналы, chunk_size): то же
+    приветствие он отклонит снова, поэтому не повторяем"""
+
+class AudioRingBuffer:
+    """Кольцевой буфер int16: пишет callback PortAudio, читает отправитель.
+    Один писатель и один читатель, позиции растут монотонно"""
+    
+    def __init__(self, capacity):
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.capacity = capacity
+        self.scratch = np.zeros(0, dtype=np.int16)
+        self.write_pos = 0
+        self.read_pos = 0
+        self.write_time = 0.0
+        self.overflows = 0
+    
+    def write(self, samples):
+        """Вызывается из потока PortAudio"""
+        count = len(samples)
+        start = self.write_pos % self.capacity
+        first = min(count, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:count - first] = samples[first:]
+        self.write_time = time.time()
+        self.write_pos += count
+    
+    def available(self):
+        # Писатель обогнал читателя на целый круг - старое потеряно
+        if self.write_pos - self.read_pos > self.capacity:
+            self.read_pos = self.write_pos - self.capacity
+            self.overflows += 1
+        return self.write_pos - self.read_pos
+    
+    def peek(self, count):
+        """Следующие count сэмплов: срез кольца или (на стыке) scratch"""
+        start = self.read_pos % self.capacity
+        if start + count <= self.capacity:
+            return self.buffer[start:start + count]
+        if len(self.scratch) < count:
+            self.scratch = np.zeros(count, dtype=np.int16)
+        first = self.capacity - start
+        self.scratch[:first] = self.buffer[start:]
+        self.scratch[first:count] = self.buffer[:count - first]
+        return self.scratch[:count]
+    
+    def timestamp(self, samples_per_second):
+        """Время захвата первого непрочитанного сэмпла"""
+        return self.write_time - (self.write_pos - self.read_pos) / samples_per_second
+    
+    def advance(self, count):
+        self.read_pos += count
+
 class RenderAudioClient:
     def __init__(self):
         self.running = True
         self.ws = None
-        self.stream = None
+        self.capture = None
         self.packet_count = 0
         self.start_time = time.time()
+        self.codec = "pcm16"
+        self.chunk_size = protocol.profile_chunk_size(PROFILE, SAMPLE_RATE)
+        self.adpcm = audio_codec.AdpcmEncoder()
+        self.ring = AudioRingBuffer(SAMPLE_RATE * CHANNELS * RING_SECONDS)
+        self.audio_ready = None
+        self.loop = None
+        self.input_overflows = 0
+        # Часы сервера минус наши, сек: кадры помечаются временем сервера
+        self.clock_offset = 0.0
+        self.dropped_frames = 0
+        self.coalesced = 0
+        # Пауза до переподключения, подсказанная сервером, сек
+        self.retry_after = None
         
     def print_info(self):
         """Информация о подключении"""
@@ -36,23 +140,24 @@ class RenderAudioClient:
         print("🎧 АУДИО КЛИЕНТ ДЛЯ RENDER.COM")
         print("="*60)
         print(f"Сервер: {SERVER_URL}")
+        print(f"Канал: {CLIENT_ID}")
         print(f"Частота: {SAMPLE_RATE} Гц")
-        print(f"Чанк: {CHUNK_SIZE} сэмплов")
+        print(f"Профиль: {PROFILE} ({self.chunk_size} сэмплов)")
+        print(f"Захват: {CAPTURE}")
         print("="*60)
-        
-        # Информация о микрофоне
-        try:
-            default_input = sd.default.device[0]
-            device_info = sd.query_devices(default_input)
-            print(f"🎤 Микрофон: {device_info['name']}")
-        except:
-            print("🎤 Используется микрофон по умолчанию")
-    
-    async def connect(self):
-        """Подключение к серверу на Render"""
+    
+    async def connect(self, reconnect=False):
+        """Подключение к серверу на Render; неудача - повтор после паузы.
+        После обрыва (reconnect) пауза и перед первой попыткой"""
         print(f"\n🔗 Подключение к серверу Render...")
         
-        for attempt in range(5):
+        for attempt in range(RECONNECT_ATTEMPTS):
+            if attempt or reconnect:
+                delay = protocol.retry_delay(attempt - (not reconnect), RECONNECT_BASE_DELAY,
+                                             RECONNECT_MAX_DELAY, self.retry_after)
+                self.retry_after = None
+                print(f"⏳ Повтор через {delay:.1f} с...")
+                await asyncio.sleep(delay)
             try:
                 self.ws = await websockets.connect(
                     SERVER_URL,
@@ -60,22 +165,33 @@ class RenderAudioClient:
                     ping_timeout=10
                 )
                 
-                await self.ws.send(json.dumps({
+                hello = {
                     "type": "spy",
                     "sample_rate": SAMPLE_RATE,
-                    "chunk_size": CHUNK_SIZE,
+                    "chunk_size": protocol.profile_chunk_size(PROFILE, SAMPLE_RATE),
                     "channels": CHANNELS,
-                    "client": "render_client"
-                }))
+                    "client": CLIENT_ID,
+                    "codecs": CODECS,
+                    "profile": PROFILE
+                }
+                if ROOM:
+                    hello["room"] = ROOM
+                await self.ws.send(json.dumps(hello))
+                await self.negotiate()
+                await self.sync_clock()
                 
                 print("✅ Успешно подключено к Render!")
                 return True
                 
+            except HelloRejected as e:
+                print(f"⛔ {e}")
+                print("Проверьте SAMPLE_RATE, CHANNELS и профиль клиента")
+                return False
+            except websockets.exceptions.ConnectionClosed as e:
+                print(f"❌ Попытка {attempt+1}/{RECONNECT_ATTEMPTS}: {e}")
+                self.retry_after = self.close_retry_after(e)
             except Exception as e:
-                print(f"❌ Попытка {attempt+1}/5: {e}")
-                if attempt < 4:
-                    print("⏳ Повтор через 3 секунды...")
-                    await asyncio.sleep(3)
+                print(f"❌ Попытка {attempt+1}/{RECONNECT_ATTEMPTS}: {e}")
         
         print("\n❌ Не удалось подключиться к серверу")
         print("Проверьте:")
@@ -84,74 +200,172 @@ class RenderAudioClient:
         print("3. Сервис активен (бесплатные чаты не закончились)")
         return False
     
-    def setup_microphone(self):
-        """Настройка микрофона"""
-        print("\n🎤 Настройка микрофона...")
+    async def negotiate(self):
+        """Ответ сервера на приветствие: выбранные кодек и размер кадра"""
+        self.codec = "pcm16"
+        self.chunk_size = protocol.profile_chunk_size(PROFILE, SAMPLE_RATE)
+        profile = PROFILE
+        try:
+            reply = json.loads(await asyncio.wait_for(self.ws.recv(), timeout=3))
+            # Неверные параметры: повтор не поможет
+            if reply.get("refused") == "invalid_hello":
+                await self.ws.close()
+                raise HelloRejected(reply.get("message", "hello rejected"))
+            # Сервер перегружен: скажет, когда вернуться, и закроет соединение
+            if reply.get("refused"):
+                self.retry_after = reply.get("retry_after")
+                await self.ws.close()
+                raise ConnectionError(reply.get("message", "refused"))
+            self.codec = reply.get("codec", "pcm16")
+            if reply.get("chunk_size"):
+                self.chunk_size = int(reply["chunk_size"])
+                profile = reply.get("profile") or profile
+        except asyncio.TimeoutError:
+            # Старый сервер не отвечает на приветствие
+            pass
+        self.adpcm = audio_codec.AdpcmEncoder()
+        print(f"🗜️  Кодек: {self.codec}")
+        print(f"⏱️  Профиль: {profile}, кадр {self.chunk_size} сэмплов "
+              f"({self.chunk_size * 1000 / SAMPLE_RATE:.0f} мс)")
+    
+    async def sync_clock(self):
+        """Смещение часов сервера (как в NTP): берём обмен с наименьшим RTT"""
+        best = None
+        for _ in range(TIME_SYNC_PINGS):
+            t0 = time.time()
+            await self.ws.send(json.dumps({"type": "time_sync", "t0": t0}))
+            try:
+                reply = json.loads(await asyncio.wait_for(self.ws.recv(), timeout=2))
+            except asyncio.TimeoutError:
+                # Старый сервер не отвечает на синхронизацию
+                break
+            t3 = time.time()
+            if reply.get("type") != "time_sync":
+                continue
+            rtt = (t3 - t0) - (reply["t2"] - reply["t1"])
+            offset = ((reply["t1"] - t0) + (reply["t2"] - t3)) / 2
+            if best is None or rtt < best[0]:
+                best = (rtt, offset)
+        
+        if best is None:
+            self.clock_offset = 0.0
+            print("🕒 Часы не синхронизированы")
+            return
+        self.clock_offset = best[1]
+        print(f"🕒 Смещение часов: {self.clock_offset * 1000:+.1f} мс (RTT {best[0] * 1000:.1f} мс)")
+    
+    def encode_audio(self, audio_int16):
+        """PCM -> (формат кадра, данные) согласно выбранному кодеку"""
+        if self.codec == "adpcm":
+            return protocol.FORMAT_ADPCM, self.adpcm.encode(audio_int16)
+        if self.codec == "ulaw":
+            return protocol.FORMAT_ULAW, audio_codec.ulaw_encode(audio_int16)
+        return protocol.FORMAT_PCM16, audio_int16.tobytes()
+    
+    def audio_callback(self, samples, overflow):
+        """Поток захвата: только копия в кольцо и сигнал отправителю"""
+        if overflow:
+            self.input_overflows += 1
+        self.ring.write(samples)
+        self.loop.call_soon_threadsafe(self.audio_ready.set)
+    
+    def setup_capture(self):
+        """Настройка источника звука"""
+        print("\n🎤 Настройка захвата...")
         
         try:
-            self.stream = sd.InputStream(
-                samplerate=SAMPLE_RATE,
-                blocksize=CHUNK_SIZE,
-                channels=CHANNELS,
-                dtype='int16'
-            )
-            
-            self.stream.start()
-            print("✅ Микрофон запущен")
+            # Захват по callback: время захвата не зависит от сети
+            self.loop = asyncio.get_running_loop()
+            self.audio_ready = asyncio.Event()
+            self.capture = capture.create_capture(CAPTURE, SAMPLE_RATE, CHANNELS, self.chunk_size)
+            self.capture.start(self.audio_callback)
+            print(f"✅ Захват запущен: {self.capture.describe()}")
             return True
             
         except Exception as e:
-            print(f"❌ Ошибка микрофона: {e}")
+            print(f"❌ Ошибка захвата: {e}")
             return False
     
     async def send_audio(self):
-        """Отправка аудио"""
+        """Отправка аудио: забирает готовые кадры из кольцевого буфера"""
         print("\n📤 Начало передачи...")
         print("💬 ГОВОРИТЕ В МИКРОФОН!")
         print("Ctrl+C для остановки")
         print("-" * 50)
         
+        frame_samples = self.chunk_size * CHANNELS
+        max_backlog = max(1, MAX_BACKLOG_MS * SAMPLE_RATE // 1000 // self.chunk_size) * frame_samples
+        
         while self.running and self.ws:
             try:
-                # Читаем аудио
-                data, overflowed = self.stream.read(CHUNK_SIZE)
-                
-                if overflowed:
-                    print("⚠️  Buffer overflow")
-                
-                # Конвертируем
-                audio_int16 = data.astype(np.int16)
-                audio_bytes = audio_int16.tobytes()
-                
-                # Отправляем
-                encoded = base64.b64encode(audio_bytes).decode('ascii')
-                
-                await self.ws.send(json.dumps({
-                    "type": "audio",
-                    "data": encoded,
-                    "packet_id": self.packet_count,
-                    "timestamp": time.time(),
-                    "sample_rate": SAMPLE_RATE
-                }))
+                await self.audio_ready.wait()
+                self.audio_ready.clear()
                 
-                self.packet_count += 1
-                
-                # Статистика
-                if self.packet_count % 10 == 0:
-                    audio_float = audio_int16.astype(np.float32) / 32768.0
-                    rms = np.sqrt(np.mean(audio_float**2))
-                    level = int(min(rms * 40, 30))
-                    bars = '█' * level
+                while self.ring.available() >= frame_samples:
+                    # Очередь слишком длинная: выбрасываем самые старые кадры,
+                    # номера пакетов идут дальше, чтобы пропуск был виден
+                    backlog = self.ring.available()
+                    if backlog > max_backlog:
+                        dropped = (backlog - max_backlog + frame_samples - 1) // frame_samples
+                        self.ring.advance(dropped * frame_samples)
+                        self.packet_count += dropped
+                        self.dropped_frames += dropped
+                    
+                    frames = []
+                    while self.ring.available() >= frame_samples and len(frames) < MAX_FRAMES_PER_MESSAGE:
+                        # Читаем аудио прямо из кольца
+                        audio_int16 = self.ring.peek(frame_samples)
+                        timestamp = self.ring.timestamp(SAMPLE_RATE * CHANNELS) + self.clock_offset
+                        fmt, payload = self.encode_audio(audio_int16)
+                        self.ring.advance(frame_samples)
+                        
+                        frames.append(protocol.pack_frame(
+                            payload,
+                            packet_id=self.packet_count,
+                            timestamp=timestamp,
+                            sample_rate=SAMPLE_RATE,
+                            channels=CHANNELS,
+                            fmt=fmt
+                        ))
+                        self.packet_count += 1
                     
-                    elapsed = time.time() - self.start_time
-                    rate = self.packet_count / elapsed if elapsed > 0 else 0
+                    # Бинарный кадр (без base64/JSON); накопившиеся - одним сообщением
+                    if len(frames) == 1:
+                        await self.ws.send(frames[0])
+                    else:
+                        await self.ws.send(protocol.pack_multi(frames))
+                        self.coalesced += len(frames)
                     
-                    print(f"\r🔊 [{bars:30}] {rms:.3f} | Пакеты: {self.packet_count} | {rate:.1f}/сек", end="")
+                    # Статистика
+                    if self.packet_count // 10 != (self.packet_count - len(frames)) // 10:
+                        audio_float = audio_int16.astype(np.float32) / 32768.0
+                        rms = np.sqrt(np.mean(audio_float**2))
+                        level = int(min(rms * 40, 30))
+                        bars = '█' * level
+                        
+                        elapsed = time.time() - self.start_time
+                        rate = self.packet_count / elapsed if elapsed > 0 else 0
+                        
+                        print(f"\r🔊 [{bars:30}] {rms:.3f} | Пакеты: {self.packet_count} | {rate:.1f}/сек", end="")
+                
+                if self.input_overflows or self.ring.overflows:
+                    print(f"\n⚠️  Buffer overflow (захват: {self.input_overflows}, кольцо: {self.ring.overflows})")
+                    self.input_overflows = 0
+                    self.ring.overflows = 0
                 
-                await asyncio.sleep(0.001)
+                # Файл закончился: дошли до конца записанного
+                if self.capture.finished and self.ring.available() < frame_samples:
+                    print("\n📁 Данные источника закончились")
+                    break
                 
-            except websockets.exceptions.ConnectionClosed:
-                print("\n⚠️  Соединение разорвано")
+                if self.dropped_frames:
+                    print(f"\n⚠️  Канал не успевает: выброшено кадров {self.dropped_frames}, склеено {self.coalesced}")
+                    self.dropped_frames = 0
+                    self.coalesced = 0
+                
+            except websockets.exceptions.ConnectionClosed as e:
+                print(f"\n⚠️  Соединение разорвано: {e}")
+                self.retry_after = self.close_retry_after(e)
                 break
             except Exception as e:
                 print(f"\n⚠️  Ошибка: {e}")
@@ -164,12 +378,16 @@ class RenderAudioClient:
         if not await self.connect():
             return
         
-        if not self.setup_microphone():
+        if not self.setup_capture():
             await self.cleanup()
             return
         
         try:
-            await self.send_audio()
+            # Захват продолжает писать в кольцо, пока переподключаемся
+            while self.running:
+                await self.send_audio()
+                if self.capture.finished or not await self.connect(reconnect=True):
+                    break
         except KeyboardInterrupt:
             print("\n\n⏹️  Остановка...")
         except Exception as e:
@@ -177,14 +395,19 @@ class RenderAudioClient:
         finally:
             await self.cleanup()
     
+    @staticmethod
+    def close_retry_after(error):
+        """Подсказка паузы из причины закрытия, если сервер её дал"""
+        return protocol.parse_retry_after(error.rcvd.reason) if error.rcvd else None
+    
     async def cleanup(self):
         """Очистка"""
         self.running = False
         
-        if self.stream:
-            self.stream.stop()
-            self.stream.close()
-            print("\n✅ Микрофон остановлен")
+        if self.capture:
+            self.capture.stop()
+            self.capture = None
+            print("\n✅ Захват остановлен")
         
         if self.ws:
             await self.ws.close()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+МЕТРИКИ В ТЕКСТОВОМ ФОРМАТЕ PROMETHEUS
+Без внешних зависимостей. Счётчики и гистограммы создаются заранее, на
+горячем пути - только сложение полей (без словарей и строк на пакет).
+Счётчики источников и слушателей - обычные поля их объектов, в текст они
+собираются только при запросе /metrics (см. collect_metrics в server.py).
+"""
+import bisect
+
+
+class Counter:
+    """Монотонный счётчик"""
+    kind = 'counter'
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name, None, self.value
+
+
+class Gauge(Counter):
+    """Текущее значение"""
+    kind = 'gauge'
+
+    def set(self, value):
+        self.value = value
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин"""
+    kind = 'histogram'
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.bounds = sorted(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            yield self.name + '_bucket', {'le': format_value(bound)}, cumulative
+        yield self.name + '_bucket', {'le': '+Inf'}, self.count
+        yield self.name + '_sum', None, self.sum
+        yield self.name + '_count', None, self.count
+
+
+class Family:
+    """Метрики с метками, собранные при запросе: [(метки, значение), ...]"""
+
+    def __init__(self, name, kind, help_text, values):
+        self.name = name
+        self.kind = kind
+        self.help = help_text
+        self.values = values
+
+    def samples(self):
+        for labels, value in self.values:
+            yield self.name, labels, value
+
+
+def quantiles(values, points=(0.5, 0.95, 0.99)):
+    """Квантили выборки: {0.5: ..., 0.95: ...}; пустая выборка - {}"""
+    if not values:
+        return {}
+    ordered = sorted(values)
+    last = len(ordered) - 1
+    return {point: ordered[min(last, int(round(point * last)))] for point in points}
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render(metrics):
+    """Текст для /metrics (формат 0.0.4)"""
+    lines = []
+    for metric in metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        for name, labels, value in metric.samples():
+            if labels:
+                label_text = ','.join(f'{key}="{escape_label(val)}"' for key, val in labels.items())
+                lines.append(f"{name}{{{label_text}}} {format_value(value)}")
+            else:
+                lines.append(f"{name} {format_value(value)}")
+    return '\n'.join(lines) + '\n'
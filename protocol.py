@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+БИНАРНЫЙ ФОРМАТ АУДИО-КАДРОВ
+Общий для клиента, сервера и браузера (см. processAudioData в server.py)
+
+Кадр = фиксированный заголовок (20 байт, network byte order) + сырые данные:
+
+    magic        2s   b'AU'
+    version      B    версия формата
+    format       B    формат данных (FORMAT_*)
+    sample_rate  H    частота дискретизации, Гц
+    channels     B    число каналов
+    flags        B    зарезервировано
+    packet_id    I    номер пакета
+    timestamp    d    время захвата, сек (time.time() по часам сервера,
+                      если источник синхронизировал часы - см. time_sync)
+
+PCM передаётся как int16 little-endian, сжатые форматы - см. audio_codec.py.
+Кадры уходят BINARY-сообщениями, JSON остаётся только для управляющих
+сообщений (spy/listener/status).
+
+Когда канал к серверу не успевает, клиент склеивает накопившиеся кадры
+в одно сообщение (сервер режет его без декодирования):
+
+    magic        2s   b'AM'
+    version      B    версия формата
+    count        B    число кадров
+    затем count раз: length (I) + кадр
+
+Переподключение: пауза растёт экспоненциально со случайным разбросом
+(retry_delay), чтобы после рестарта сервера клиенты не пришли разом.
+Сервер может подсказать паузу сам: поле retry_after (сек) в status и
+"retry_after=<сек>" в причине закрытия WebSocket - она важнее своей.
+"""
+import random
+import re
+import struct
+
+MAGIC = b'AU'
+VERSION = 1
+
+# Форматы данных
+FORMAT_PCM16 = 1
+FORMAT_ULAW = 2      # G.711 μ-law, 8 бит на сэмпл
+FORMAT_ADPCM = 3     # IMA-ADPCM, 4 бита на сэмпл (см. audio_codec.py)
+
+HEADER = struct.Struct('!2sBBHBBId')
+HEADER_SIZE = HEADER.size
+PACKET_ID = struct.Struct('!I')
+PACKET_ID_OFFSET = 8
+TIMESTAMP = struct.Struct('!d')
+TIMESTAMP_OFFSET = 12
+
+# Профили задержки: длительность кадра источника и целевая глубина буфера
+# плеера, мс. Короткий кадр - меньше задержка, но больше накладных
+# расходов на пакет; профиль выбирается при подключении источника
+PROFILES = {
+    'low-latency': {'frame_ms': 20, 'buffer_ms': 60},
+    'balanced': {'frame_ms': 60, 'buffer_ms': 150},
+    'bulk': {'frame_ms': 120, 'buffer_ms': 400},
+}
+DEFAULT_PROFILE = 'balanced'
+
+# Сообщение из нескольких кадров
+MULTI_MAGIC = b'AM'
+MULTI_HEADER = struct.Struct('!2sBB')
+MULTI_LENGTH = struct.Struct('!I')
+MULTI_MAX_FRAMES = 255
+
+
+def pack_frame(payload, packet_id, timestamp, sample_rate, channels=1, fmt=FORMAT_PCM16):
+    """Собирает кадр: заголовок + данные"""
+    return HEADER.pack(
+        MAGIC, VERSION, fmt, sample_rate, channels, 0,
+        packet_id & 0xFFFFFFFF, timestamp
+    ) + payload
+
+
+def unpack_header(frame):
+    """Разбирает заголовок: (format, sample_rate, channels, packet_id, timestamp)"""
+    if len(frame) < HEADER_SIZE:
+        raise ValueError(f"frame too short: {len(frame)} bytes")
+    magic, version, fmt, sample_rate, channels, _flags, packet_id, timestamp = HEADER.unpack_from(frame)
+    if magic != MAGIC:
+        raise ValueError(f"bad magic: {magic!r}")
+    if version != VERSION:
+        raise ValueError(f"unsupported version: {version}")
+    return fmt, sample_rate, channels, packet_id, timestamp
+
+
+def packet_id(frame):
+    """Номер пакета без разбора всего заголовка"""
+    return PACKET_ID.unpack_from(frame, PACKET_ID_OFFSET)[0]
+
+
+def timestamp(frame):
+    """Время захвата без разбора всего заголовка"""
+    return TIMESTAMP.unpack_from(frame, TIMESTAMP_OFFSET)[0]
+
+
+def profile_chunk_size(profile, sample_rate):
+    """Сэмплов в кадре профиля на данной частоте"""
+    return sample_rate * PROFILES[profile]['frame_ms'] // 1000
+
+
+def pack_multi(frames):
+    """Склеивает кадры в одно сообщение"""
+    if not 0 < len(frames) <= MULTI_MAX_FRAMES:
+        raise ValueError(f"bad frame count: {len(frames)}")
+    parts = [MULTI_HEADER.pack(MULTI_MAGIC, VERSION, len(frames))]
+    for frame in frames:
+        parts.append(MULTI_LENGTH.pack(len(frame)))
+        parts.append(frame)
+    return b''.join(parts)
+
+
+def split_multi(message):
+    """Режет сообщение на кадры (срезы memoryview, без копирования)"""
+    magic, version, count = MULTI_HEADER.unpack_from(message)
+    if magic != MULTI_MAGIC or version != VERSION:
+        raise ValueError("bad multi-frame message")
+    view = memoryview(message)
+    offset = MULTI_HEADER.size
+    frames = []
+    for _ in range(count):
+        length, = MULTI_LENGTH.unpack_from(message, offset)
+        offset += MULTI_LENGTH.size
+        if offset + length > len(message):
+            raise ValueError("truncated multi-frame message")
+        frames.append(view[offset:offset + length])
+        offset += length
+    return frames
+
+
+RETRY_AFTER_REASON = re.compile(r'retry_after=(\d+(?:\.\d+)?)')
+# Причина закрытия WebSocket - не больше 123 байт
+CLOSE_REASON_MAX = 123
+
+
+def retry_delay(attempt, base=1.0, cap=60.0, retry_after=None):
+    """Пауза перед попыткой attempt (с 0): подсказка сервера или
+    min(cap, base * 2^attempt), из которой случайна половина"""
+    if retry_after is not None:
+        return retry_after
+    ceiling = min(cap, base * 2 ** attempt)
+    return ceiling / 2 + random.uniform(0, ceiling / 2)
+
+
+def close_reason(message, retry_after=None):
+    """Причина закрытия с подсказкой паузы"""
+    suffix = f"; retry_after={retry_after:g}" if retry_after is not None else ""
+    return message.encode()[:CLOSE_REASON_MAX - len(suffix)].decode(errors='ignore') + suffix
+
+
+def parse_retry_after(reason):
+    """Подсказка из причины закрытия; None, если её нет"""
+    match = RETRY_AFTER_REASON.search(reason or '')
+    return float(match.group(1)) if match else None
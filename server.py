@@ -1,13 +1,99 @@
 import asyncio
+import base64
+import bisect
+import collections
+import hmac
+import itertools
 import json
+import math
+import multiprocessing
+import multiprocessing.connection
 import os
+import random
+import signal
+import socket
+import struct
+import sys
 import time
-from aiohttp import web
+import uuid
+import numpy as np
+from aiohttp import ClientError, ClientSession, ClientTimeout, WSCloseCode, WSMsgType, web
 
-# Храним подключения
-audio_sources = set()
+import audio_codec
+import backplane
+import metrics
+import protocol
+import shared_ring
+
+# Храним подключения: каналы по id источника и все слушатели
+channels = {}
 listeners = set()
 
+# Очередь отправки каждого слушателя: по времени, в кадрах - по длительности
+# кадра канала; LISTENER_QUEUE_SIZE - пока она неизвестна
+LISTENER_QUEUE_SIZE = int(os.environ.get('LISTENER_QUEUE_SIZE', 32))
+LISTENER_QUEUE_MS = int(os.environ.get('LISTENER_QUEUE_MS', 2000))
+LISTENER_QUEUE_MIN = 8
+# Политика переполнения: drop_oldest, drop_newest, disconnect
+LISTENER_OVERFLOW = os.environ.get('LISTENER_OVERFLOW', 'drop_oldest')
+OVERFLOW_POLICIES = ('drop_oldest', 'drop_newest', 'disconnect')
+if LISTENER_OVERFLOW not in OVERFLOW_POLICIES:
+    raise ValueError(f"LISTENER_OVERFLOW must be one of {OVERFLOW_POLICIES}")
+# Сокет занят, пока в буфере транспорта больше этого (байт)
+LISTENER_WRITE_BUFFER = int(os.environ.get('LISTENER_WRITE_BUFFER', 256 * 1024))
+LISTENER_DRAIN_POLL = 0.01
+
+# Метрики для /metrics (см. metrics.py); METRICS=0 отключает замеры
+# времени и эндпоинт, счётчики-поля остаются
+METRICS = os.environ.get('METRICS', '1') == '1'
+FANOUT_SECONDS = metrics.Histogram(
+    'relay_fanout_seconds', 'Time to fan out one frame to all subscribers of a channel',
+    (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05))
+LOOP_LAG_SECONDS = metrics.Histogram(
+    'relay_event_loop_lag_seconds', 'Event loop scheduling delay',
+    (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+LOOP_LAG = metrics.Gauge('relay_event_loop_lag_last_seconds', 'Last measured event loop delay')
+SOURCE_CONNECTIONS = metrics.Counter('relay_source_connections_total', 'Source connections accepted')
+SOURCE_RECONNECTS = metrics.Counter(
+    'relay_source_reconnects_total', 'Source connections to a channel that already had a source')
+LISTENER_CONNECTIONS = metrics.Counter('relay_listener_connections_total', 'Listener connections accepted')
+LISTENER_RESUMES = metrics.Counter(
+    'relay_listener_resumes_total', 'Listener reconnections that asked to resume after a packet')
+INGRESS_LATENCY_SECONDS = metrics.Histogram(
+    'relay_ingress_latency_seconds', 'Capture to server arrival time for clock-synced sources',
+    (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_LAG_INTERVAL = 0.5
+
+# Окно задержек для квантилей в /health и /metrics, кадров
+LATENCY_WINDOW = 512
+
+# Допуск подключений; 0 - без ограничения. При WORKERS > 1 пределы общие
+# для всех процессов: счётчики в разделяемой памяти (shared_ring.SharedCounters)
+MAX_CONNECTIONS = int(os.environ.get('MAX_CONNECTIONS', 0))
+MAX_CONNECTIONS_PER_IP = int(os.environ.get('MAX_CONNECTIONS_PER_IP', 0))
+MAX_LISTENERS_PER_CHANNEL = int(os.environ.get('MAX_LISTENERS_PER_CHANNEL', 0))
+# За прокси адрес клиента - первый в X-Forwarded-For
+TRUST_FORWARDED = os.environ.get('TRUST_FORWARDED', '0') == '1'
+# Перегрузка: задержка цикла событий или среднее время рассылки кадра выше
+# порога (сек; 0 - не проверять). Новых слушателей тогда отклоняем (refuse)
+# или переводим на формат SHED_FORMAT (downgrade); текущие потоки не трогаем
+SHED_LOOP_LAG = float(os.environ.get('SHED_LOOP_LAG', 0))
+SHED_FANOUT = float(os.environ.get('SHED_FANOUT', 0))
+SHED_ACTION = os.environ.get('SHED_ACTION', 'refuse')
+SHED_FORMAT = os.environ.get('SHED_FORMAT', 'adpcm@8000')
+if SHED_ACTION not in ('refuse', 'downgrade'):
+    raise ValueError("SHED_ACTION must be 'refuse' or 'downgrade'")
+# Подсказка retry_after при отказе и остановке: у каждого клиента своя
+# пауза из этого диапазона, чтобы переподключения растянулись (сек)
+RETRY_AFTER_MIN = float(os.environ.get('RETRY_AFTER_MIN', 5))
+RETRY_AFTER_MAX = float(os.environ.get('RETRY_AFTER_MAX', 30))
+LOAD_SMOOTHING = 0.2
+FANOUT_SMOOTHING = 0.02
+LOOP_LAG_AVG = metrics.Gauge('relay_event_loop_lag_avg_seconds', 'Smoothed event loop delay used for load shedding')
+FANOUT_AVG = metrics.Gauge('relay_fanout_avg_seconds', 'Smoothed time to fan out one frame, used for load shedding')
+# Время рассылки меряем для метрик или для сброса нагрузки
+TIME_FANOUT = METRICS or SHED_FANOUT > 0
+
 app = web.Application()
 
 # Главная страница
@@ -167,7 +253,8 @@ async def home(request):
                 <div id="audioIndicator" class="audio-indicator">
                     <div style="font-size: 1.3rem;">🔊 Live Audio Streaming...</div>
                     <div style="margin-top: 10px;">Packets received: <span id="packetCount">0</span></div>
-                    <div>Buffer: <span id="bufferSize">0</span> chunks</div>
+                    <div>Buffer: <span id="bufferSize">0</span> ms</div>
+                    <div>Latency (p50): <span id="latencyMs">-</span> ms</div>
                 </div>
                 
                 <div class="info-panel">
@@ -179,13 +266,31 @@ async def home(request):
                         <span>Audio Sources:</span>
                         <span id="sourcesCount">0</span>
                     </div>
+                    <div class="info-row">
+                        <span>Channel:</span>
+                        <select id="channelSelect" onchange="selectChannel(this.value)"></select>
+                    </div>
+                    <div class="info-row">
+                        <span>Quality:</span>
+                        <select id="formatSelect" onchange="selectFormat(this.value)">
+                            <option value="source">Source</option>
+                            <option value="pcm16@16000">16 kHz PCM</option>
+                            <option value="adpcm@16000">16 kHz ADPCM</option>
+                            <option value="ulaw@8000">8 kHz μ-law</option>
+                            <option value="adpcm@8000">8 kHz ADPCM</option>
+                        </select>
+                    </div>
+                    <div class="info-row">
+                        <span>Latency Profile:</span>
+                        <span id="latencyProfile">-</span>
+                    </div>
                     <div class="info-row">
                         <span>WebSocket Status:</span>
                         <span id="wsStatus">Disconnected</span>
                     </div>
                     <div class="info-row">
                         <span>Audio Format:</span>
-                        <span>16 kHz, mono, int16</span>
+                        <span id="audioFormat">16 kHz, mono, int16</span>
                     </div>
                 </div>
             </div>
@@ -195,129 +300,228 @@ async def home(request):
             const WS_URL = 'wss://' + window.location.host + '/ws';
             let socket = null;
             let audioContext = null;
-            let audioQueue = [];
-            let isPlaying = false;
+            let playerNode = null;
+            let decoderWorker = null;
+            // Целевая глубина джиттер-буфера, мс; профиль канала её меняет
+            const JITTER_TARGET_MS = 150;
+            let jitterTargetMs = JITTER_TARGET_MS;
             let packetCount = 0;
+            let currentChannel = null;
+            // Синхронизация часов с сервером (как в NTP): смещение по
+            // ответу с наименьшим RTT из TIME_SYNC_PINGS
+            const TIME_SYNC_PINGS = 5;
+            let clockOffset = null;
+            let clockRtt = null;
+            let timeSyncBest = null;
+            let timeSyncCount = 0;
+            // Задержки захват -> воспроизведение от плеера, отчёт серверу
+            const LATENCY_REPORT_MS = 5000;
+            let latencySamples = [];
+            let latencyP50 = null;
+            // Последний принятый пакет: после переподключения сервер
+            // дошлёт пропущенное из истории канала
+            let lastPacketId = null;
+            // Переподключение: экспоненциальная пауза, половина случайна, чтобы
+            // после рестарта сервера вкладки не вернулись разом; подсказка
+            // сервера retry_after (в статусе или причине закрытия) важнее
+            const RECONNECT_BASE_MS = 1000;
+            const RECONNECT_MAX_MS = 60000;
+            let reconnectAttempt = 0;
+            let retryAfterMs = null;
+            let reconnectTimer = null;
+            // На телефоне по умолчанию экономный формат
+            let currentFormat = /Mobi|Android/i.test(navigator.userAgent) ? 'adpcm@8000' : 'source';
             
-            // Функция для обработки аудио
-            function processAudioData(base64Data) {
+            // Плеер: AudioWorklet с кольцевым буфером (см. /player-worklet.js),
+            // кадры декодирует Web Worker (см. /decoder-worker.js) и передаёт
+            // их в плеер напрямую через MessageChannel. Создаётся один раз,
+            // повторные вызовы ждут того же обещания
+            let playerReady = null;
+            function ensurePlayer() {
+                if (!playerReady) {
+                    playerReady = createPlayer().then(function(created) {
+                        // Не вышло - следующая попытка создаст заново
+                        if (!created) playerReady = null;
+                    });
+                }
+                return playerReady;
+            }
+            
+            async function createPlayer() {
                 try {
-                    console.log("🎵 Processing audio data");
-                    
-                    // Декодируем base64
-                    const binaryStr = atob(base64Data);
-                    const len = binaryStr.length;
-                    
-                    if (len < 100) {
-                        console.warn("⚠️ Too little data");
-                        return null;
-                    }
-                    
-                    // Создаем ArrayBuffer
-                    const arrayBuffer = new ArrayBuffer(len);
-                    const uint8Array = new Uint8Array(arrayBuffer);
-                    
-                    for (let i = 0; i < len; i++) {
-                        uint8Array[i] = binaryStr.charCodeAt(i);
-                    }
-                    
-                    // Создаем Int16Array
-                    const int16Array = new Int16Array(arrayBuffer);
-                    
-                    // Конвертируем в float32
-                    const float32Array = new Float32Array(int16Array.length);
-                    for (let i = 0; i < int16Array.length; i++) {
-                        float32Array[i] = Math.max(-1, Math.min(1, int16Array[i] / 32768.0));
-                    }
-                    
-                    return float32Array;
+                    audioContext = new (window.AudioContext || window.webkitAudioContext)({
+                        latencyHint: 'interactive'
+                    });
+                    await audioContext.audioWorklet.addModule('/player-worklet.js');
+                    playerNode = new AudioWorkletNode(audioContext, 'jitter-buffer-player', {
+                        numberOfInputs: 0,
+                        outputChannelCount: [1],
+                        processorOptions: { targetMs: jitterTargetMs }
+                    });
+                    playerNode.port.onmessage = function(event) {
+                        bufferMs = event.data.depthMs;
+                        const latencies = event.data.latencies;
+                        if (latencies && latencies.length && latencySamples.length < 2000) {
+                            latencySamples.push.apply(latencySamples, latencies);
+                        }
+                        scheduleUiUpdate();
+                    };
+                    playerNode.connect(audioContext.destination);
                     
+                    decoderWorker = new Worker('/decoder-worker.js');
+                    decoderWorker.onmessage = function(event) {
+                        audioFormat = (event.data.sampleRate / 1000) + ' kHz, mono, ' + event.data.format;
+                        scheduleUiUpdate();
+                    };
+                    const channel = new MessageChannel();
+                    playerNode.port.postMessage({ port: channel.port1 }, [channel.port1]);
+                    decoderWorker.postMessage({ port: channel.port2 }, [channel.port2]);
+                    applyClock();
+                    console.log("✅ AudioWorklet player and decoder worker created");
+                    return true;
                 } catch (error) {
-                    console.error('❌ Audio decoding error:', error);
-                    return null;
+                    console.error("❌ Failed to create audio player:", error);
+                    audioContext = null;
+                    playerNode = null;
+                    decoderWorker = null;
+                    return false;
                 }
             }
             
-            // Воспроизведение из очереди
-            function playFromQueue() {
-                if (!audioContext) {
-                    try {
-                        audioContext = new (window.AudioContext || window.webkitAudioContext)({
-                            sampleRate: 16000
-                        });
-                        console.log("✅ AudioContext created");
-                    } catch (error) {
-                        console.error("❌ Failed to create AudioContext:", error);
-                        return;
-                    }
+            // Кадр уходит в Worker без копирования (transferable)
+            function addAudioToQueue(buffer) {
+                if (decoderWorker) {
+                    decoderWorker.postMessage(buffer, [buffer]);
                 }
-                
-                if (audioQueue.length === 0) {
-                    isPlaying = false;
-                    document.getElementById('bufferSize').textContent = '0';
+            }
+            
+            function sendTimeSync() {
+                if (socket && socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({ type: 'time_sync', t0: Date.now() / 1000 }));
+                }
+            }
+            
+            function startTimeSync() {
+                timeSyncBest = null;
+                timeSyncCount = 0;
+                sendTimeSync();
+            }
+            
+            function handleTimeSync(data) {
+                const t3 = Date.now() / 1000;
+                const rtt = (t3 - data.t0) - (data.t2 - data.t1);
+                const offset = ((data.t1 - data.t0) + (data.t2 - t3)) / 2;
+                if (!timeSyncBest || rtt < timeSyncBest.rtt) {
+                    timeSyncBest = { rtt: rtt, offset: offset };
+                }
+                if (++timeSyncCount < TIME_SYNC_PINGS) {
+                    sendTimeSync();
                     return;
                 }
-                
-                isPlaying = true;
-                document.getElementById('bufferSize').textContent = audioQueue.length;
-                
-                // Берем данные из очереди
-                const audioData = audioQueue.shift();
-                
-                try {
-                    // Создаем AudioBuffer
-                    const audioBuffer = audioContext.createBuffer(1, audioData.length, 16000);
-                    audioBuffer.copyToChannel(audioData, 0);
-                    
-                    // Создаем источник
-                    const source = audioContext.createBufferSource();
-                    source.buffer = audioBuffer;
-                    
-                    // GainNode для громкости
-                    const gainNode = audioContext.createGain();
-                    gainNode.gain.value = 1.0;
-                    
-                    // Подключаем
-                    source.connect(gainNode);
-                    gainNode.connect(audioContext.destination);
-                    
-                    // Запускаем
-                    source.start();
-                    
-                    // Следующий чанк
-                    source.onended = () => {
-                        setTimeout(playFromQueue, 0);
-                    };
-                    
-                } catch (error) {
-                    console.error("❌ Playback error:", error);
-                    setTimeout(playFromQueue, 0);
+                clockOffset = timeSyncBest.offset;
+                clockRtt = timeSyncBest.rtt;
+                console.log('🕒 Clock offset ' + Math.round(clockOffset * 1000) + ' ms, RTT ' + Math.round(clockRtt * 1000) + ' ms');
+                applyClock();
+            }
+            
+            // Плееру: смещение часов и задержка вывода звуковой карты
+            function applyClock() {
+                if (!playerNode || clockOffset === null) return;
+                playerNode.port.postMessage({ clock: {
+                    offset: clockOffset,
+                    outputLatency: audioContext.outputLatency || audioContext.baseLatency || 0
+                }});
+            }
+            
+            function quantile(sorted, point) {
+                return sorted[Math.min(sorted.length - 1, Math.round(point * (sorted.length - 1)))];
+            }
+            
+            // Квантили задержки за период - на сервер (видны в /health и /metrics)
+            function reportLatency() {
+                if (!latencySamples.length) return;
+                const sorted = latencySamples.sort(function(a, b) { return a - b; });
+                latencySamples = [];
+                latencyP50 = quantile(sorted, 0.5);
+                scheduleUiUpdate();
+                if (socket && socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({
+                        type: 'latency',
+                        p50: latencyP50,
+                        p95: quantile(sorted, 0.95),
+                        p99: quantile(sorted, 0.99),
+                        count: sorted.length,
+                        clock_rtt: clockRtt
+                    }));
                 }
             }
             
-            // Добавление аудио в очередь
-            function addAudioToQueue(base64Data) {
-                const audioData = processAudioData(base64Data);
-                if (audioData) {
-                    audioQueue.push(audioData);
-                    
-                    if (!isPlaying) {
-                        playFromQueue();
+            // Буфер плеера под профиль задержки канала
+            function setJitterTarget(targetMs) {
+                targetMs = targetMs || JITTER_TARGET_MS;
+                if (targetMs === jitterTargetMs) return;
+                jitterTargetMs = targetMs;
+                if (playerNode) {
+                    playerNode.port.postMessage({ targetMs: targetMs });
+                }
+            }
+            
+            function resetPlayer() {
+                if (decoderWorker) {
+                    decoderWorker.postMessage({ reset: true });
+                }
+            }
+            
+            // Счётчики в DOM - не чаще одного раза за кадр анимации
+            let uiScheduled = false;
+            let bufferMs = 0;
+            let audioFormat = '';
+            function scheduleUiUpdate() {
+                if (uiScheduled) return;
+                uiScheduled = true;
+                requestAnimationFrame(function() {
+                    uiScheduled = false;
+                    document.getElementById('packetCount').textContent = packetCount;
+                    document.getElementById('bufferSize').textContent = Math.round(bufferMs);
+                    if (latencyP50 !== null) {
+                        document.getElementById('latencyMs').textContent = Math.round(latencyP50 * 1000);
                     }
-                    
-                    if (audioQueue.length > 10) {
-                        audioQueue.shift();
+                    if (audioFormat) {
+                        document.getElementById('audioFormat').textContent = audioFormat;
+                    }
+                    if (packetCount > 0) {
+                        document.getElementById('audioIndicator').classList.add('active');
                     }
+                });
+            }
+            
+            function reconnectDelay() {
+                if (retryAfterMs !== null) {
+                    const delay = retryAfterMs;
+                    retryAfterMs = null;
+                    return delay;
                 }
+                const ceiling = Math.min(RECONNECT_MAX_MS, RECONNECT_BASE_MS * Math.pow(2, reconnectAttempt));
+                reconnectAttempt++;
+                return ceiling / 2 + Math.random() * ceiling / 2;
             }
             
             function connectWebSocket() {
                 if (socket && socket.readyState === WebSocket.OPEN) return;
+                clearTimeout(reconnectTimer);
+                
+                // Звук разрешается только после действия пользователя
+                ensurePlayer().then(function() {
+                    if (audioContext && audioContext.state === 'suspended') {
+                        audioContext.resume();
+                    }
+                });
                 
                 updateStatus('Connecting...', 'disconnected');
                 document.getElementById('wsStatus').textContent = 'Connecting';
                 
                 socket = new WebSocket(WS_URL);
+                socket.binaryType = 'arraybuffer';
                 
                 socket.onopen = function() {
                     updateStatus('✅ Connected to server', 'connected');
@@ -325,23 +529,69 @@ async def home(request):
                     document.getElementById('disconnectBtn').disabled = false;
                     document.getElementById('wsStatus').textContent = 'Connected';
                     
-                    // Register as listener
-                    socket.send(JSON.stringify({
-                        type: 'listener',
-                        device: 'web_interface',
-                        timestamp: Date.now()
-                    }));
+                    // Register as listener, когда плеер готов: иначе предзагрузка
+                    // и дошедшее по resume_after придут раньше декодера
+                    const opened = socket;
+                    ensurePlayer().then(function() {
+                        if (socket !== opened || opened.readyState !== WebSocket.OPEN) return;
+                        opened.send(JSON.stringify({
+                            type: 'listener',
+                            device: 'web_interface',
+                            channel: currentChannel,
+                            format: formatRequest(currentFormat),
+                            resume_after: lastPacketId,
+                            timestamp: Date.now()
+                        }));
+                        startTimeSync();
+                    });
                     
                     console.log("✅ WebSocket connected");
                 };
                 
                 socket.onmessage = function(event) {
                     try {
+                        // Аудио приходит бинарными кадрами
+                        if (event.data instanceof ArrayBuffer) {
+                            packetCount++;
+                            lastPacketId = new DataView(event.data).getUint32(8);
+                            addAudioToQueue(event.data);
+                            scheduleUiUpdate();
+                            return;
+                        }
+                        
                         const data = JSON.parse(event.data);
                         
-                        if (data.type === 'status') {
+                        if (data.type === 'time_sync') {
+                            handleTimeSync(data);
+                        } else if (data.type === 'status') {
+                            if (data.retry_after != null) {
+                                retryAfterMs = data.retry_after * 1000;
+                            }
+                            // Отказ при перегрузке: сервер закроет соединение сам
+                            if (data.refused) {
+                                updateStatus('⛔ ' + data.message, 'disconnected');
+                                return;
+                            }
+                            if (data.retry_after == null) {
+                                reconnectAttempt = 0;
+                            }
+                            // Сервер уходит на перезапуск: в назначенное время
+                            // переподключаемся сразу, с resume_after, без паузы
+                            if (data.drain) {
+                                const draining = socket;
+                                setTimeout(function() {
+                                    if (socket === draining) {
+                                        retryAfterMs = 0;
+                                        draining.close();
+                                    }
+                                }, (data.reconnect_in || 0) * 1000);
+                            }
                             updateStatus(data.message, 'connected');
                             document.getElementById('sourcesCount').textContent = data.sources_count || 0;
+                            updateChannels(data.channels || [], data.channel);
+                            setJitterTarget(data.buffer_ms);
+                            document.getElementById('latencyProfile').textContent =
+                                data.profile ? data.profile + ' (' + jitterTargetMs + ' ms buffer)' : '-';
                             
                             if (data.has_source) {
                                 document.getElementById('audioIndicator').classList.add('active');
@@ -349,29 +599,25 @@ async def home(request):
                                 document.getElementById('audioIndicator').classList.remove('active');
                             }
                         }
-                        else if (data.type === 'audio') {
-                            packetCount++;
-                            document.getElementById('packetCount').textContent = packetCount;
-                            document.getElementById('audioIndicator').classList.add('active');
-                            
-                            if (data.data && data.data.length > 100) {
-                                addAudioToQueue(data.data);
-                            }
-                        }
                     } catch (error) {
                         console.error('❌ Error:', error);
                     }
                 };
                 
-                socket.onclose = function() {
-                    updateStatus('❌ Connection closed', 'disconnected');
+                socket.onclose = function(event) {
+                    const hint = /retry_after=(\\d+(?:\\.\\d+)?)/.exec(event.reason || '');
+                    if (hint) {
+                        retryAfterMs = parseFloat(hint[1]) * 1000;
+                    }
+                    const delay = reconnectDelay();
+                    updateStatus('❌ Connection closed, reconnecting in ' + Math.round(delay / 1000) + ' s', 'disconnected');
                     document.getElementById('connectBtn').disabled = false;
                     document.getElementById('disconnectBtn').disabled = true;
                     document.getElementById('audioIndicator').classList.remove('active');
                     document.getElementById('wsStatus').textContent = 'Disconnected';
                     
-                    console.log("🔌 WebSocket closed");
-                    setTimeout(connectWebSocket, 3000);
+                    console.log("🔌 WebSocket closed", event.code, event.reason);
+                    reconnectTimer = setTimeout(connectWebSocket, delay);
                 };
                 
                 socket.onerror = function(error) {
@@ -381,8 +627,57 @@ async def home(request):
                 };
             }
             
+            // Список каналов (источников)
+            function updateChannels(channels, channel) {
+                if ((channel || null) !== currentChannel) {
+                    lastPacketId = null;
+                }
+                currentChannel = channel || null;
+                const select = document.getElementById('channelSelect');
+                select.innerHTML = '';
+                const ids = channels.slice();
+                if (currentChannel && !ids.includes(currentChannel)) {
+                    ids.unshift(currentChannel);
+                }
+                for (const id of ids) {
+                    const option = document.createElement('option');
+                    option.value = id;
+                    option.textContent = channels.includes(id) ? id : id + ' (offline)';
+                    select.appendChild(option);
+                }
+                select.value = currentChannel || '';
+            }
+            
+            // Подписка на другой канал
+            function selectChannel(channel) {
+                if (!channel || channel === currentChannel) return;
+                currentChannel = channel;
+                lastPacketId = null;
+                resetPlayer();
+                if (socket && socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({ type: 'subscribe', channel: channel }));
+                }
+            }
+            
+            // Формат, который перекодирует сервер: 'codec@rate' или 'source'
+            function formatRequest(value) {
+                if (value === 'source') return null;
+                const parts = value.split('@');
+                return { codec: parts[0], sample_rate: parseInt(parts[1], 10) };
+            }
+            
+            function selectFormat(value) {
+                currentFormat = value;
+                if (socket && socket.readyState === WebSocket.OPEN) {
+                    socket.send(JSON.stringify({ type: 'format', format: formatRequest(value) }));
+                }
+            }
+            
             function disconnectWebSocket() {
+                // Отключил пользователь: без переподключения
+                clearTimeout(reconnectTimer);
                 if (socket) {
+                    socket.onclose = null;
                     socket.close();
                 }
                 updateStatus('Disconnected', 'disconnected');
@@ -391,12 +686,12 @@ async def home(request):
                 document.getElementById('audioIndicator').classList.remove('active');
                 document.getElementById('wsStatus').textContent = 'Disconnected';
                 packetCount = 0;
+                lastPacketId = null;
                 document.getElementById('packetCount').textContent = '0';
                 document.getElementById('sourcesCount').textContent = '0';
                 document.getElementById('bufferSize').textContent = '0';
                 
-                audioQueue = [];
-                isPlaying = false;
+                resetPlayer();
                 
                 console.log("⏹️ Disconnected");
             }
@@ -418,7 +713,15 @@ async def home(request):
             // Auto-connect
             window.onload = function() {
                 document.getElementById('serverUrl').textContent = window.location.host;
+                document.getElementById('formatSelect').value = currentFormat;
+                // Автоподключение без клика: звук включится по первому клику
+                document.addEventListener('click', function() {
+                    if (audioContext && audioContext.state === 'suspended') {
+                        audioContext.resume();
+                    }
+                });
                 console.log("🌐 Page loaded");
+                setInterval(reportLatency, LATENCY_REPORT_MS);
                 setTimeout(connectWebSocket, 1000);
             };
         </script>
@@ -426,23 +729,1547 @@ async def home(request):
     </html>
     """, content_type="text/html")
 
+# Плеер страницы: AudioWorklet с кольцевым джиттер-буфером. Держит целевую
+# глубину, слегка ускоряя или замедляя воспроизведение
+PLAYER_WORKLET_JS = """
+class JitterBufferPlayer extends AudioWorkletProcessor {
+    constructor(options) {
+        super();
+        const opts = (options && options.processorOptions) || {};
+        this.targetMs = opts.targetMs || 150;
+        this.maxRateAdjust = 0.03;
+        this.inputRate = 0;
+        this.ring = null;
+        this.writeIndex = 0;
+        this.readPos = 0;
+        this.rate = 1.0;
+        this.buffering = true;
+        this.underruns = 0;
+        this.lastReport = 0;
+        // Задержка захват -> воспроизведение: метки начала кадров в кольце,
+        // смещение часов сервера и задержка вывода (от страницы)
+        this.marks = [];
+        this.latencies = [];
+        this.clockOffset = null;
+        this.outputLatency = 0;
+        this.port.onmessage = (event) => this.onMessage(event.data);
+    }
+
+    onControl(data) {
+        // Порт от Web Worker-декодера: по нему приходят сэмплы
+        data.port.onmessage = (event) => this.onMessage(event.data);
+    }
+
+    reset(inputRate) {
+        this.inputRate = inputRate;
+        // Кольцо на 4 секунды входного потока
+        this.ring = new Float32Array(Math.ceil(inputRate * 4));
+        this.writeIndex = 0;
+        this.readPos = 0;
+        this.rate = 1.0;
+        this.buffering = true;
+        this.marks = [];
+    }
+
+    onMessage(data) {
+        if (data.port) {
+            this.onControl(data);
+            return;
+        }
+        if (data.reset) {
+            if (this.inputRate) this.reset(this.inputRate);
+            return;
+        }
+        if (data.clock) {
+            this.clockOffset = data.clock.offset;
+            this.outputLatency = data.clock.outputLatency || 0;
+            return;
+        }
+        if (data.targetMs) {
+            this.targetMs = data.targetMs;
+        }
+        if (!data.samples) return;
+        if (data.sampleRate !== this.inputRate) {
+            this.reset(data.sampleRate);
+        }
+        const samples = data.samples;
+        const size = this.ring.length;
+        // Переполнение: отбрасываем самое старое до целевой глубины
+        if (this.writeIndex + samples.length - this.readPos > size) {
+            this.readPos = this.writeIndex + samples.length - this.targetSamples();
+        }
+        for (let i = 0; i < samples.length; i++) {
+            this.ring[(this.writeIndex + i) % size] = samples[i];
+        }
+        if (data.timestamp && this.clockOffset !== null && this.marks.length < 256) {
+            this.marks.push({ index: this.writeIndex, timestamp: data.timestamp });
+        }
+        this.writeIndex += samples.length;
+    }
+
+    // Кадры, чьё начало прозвучало в этом блоке; пропущенные при
+    // переполнении не считаются
+    measureLatency(blockSamples) {
+        const now = Date.now() / 1000 + this.clockOffset + this.outputLatency;
+        while (this.marks.length && this.marks[0].index <= this.readPos) {
+            const mark = this.marks.shift();
+            if (this.readPos - mark.index <= blockSamples) {
+                this.latencies.push(now - mark.timestamp);
+            }
+        }
+    }
+
+    targetSamples() {
+        return this.targetMs * this.inputRate / 1000;
+    }
+
+    process(inputs, outputs) {
+        const output = outputs[0][0];
+        if (!this.ring) {
+            output.fill(0);
+            return true;
+        }
+        const size = this.ring.length;
+        const target = this.targetSamples();
+        let depth = this.writeIndex - this.readPos;
+
+        if (this.buffering) {
+            if (depth < target) {
+                output.fill(0);
+                this.report(depth, currentTime);
+                return true;
+            }
+            this.buffering = false;
+        }
+
+        // Глубина выше цели - чуть быстрее, ниже - чуть медленнее
+        const error = (depth - target) / target;
+        const wanted = 1 + Math.max(-this.maxRateAdjust, Math.min(this.maxRateAdjust, error * 0.05));
+        this.rate += (wanted - this.rate) * 0.01;
+        const step = this.inputRate / sampleRate * this.rate;
+
+        for (let i = 0; i < output.length; i++) {
+            if (this.writeIndex - this.readPos < 2) {
+                // Буфер пуст: тишина и повторное накопление
+                output.fill(0, i);
+                this.underruns++;
+                this.buffering = true;
+                break;
+            }
+            const index = Math.floor(this.readPos);
+            const frac = this.readPos - index;
+            const a = this.ring[index % size];
+            const b = this.ring[(index + 1) % size];
+            output[i] = a + (b - a) * frac;
+            this.readPos += step;
+        }
+        if (this.marks.length) {
+            this.measureLatency(output.length * step + 1);
+        }
+        this.report(this.writeIndex - this.readPos, currentTime);
+        return true;
+    }
+
+    report(depth, now) {
+        if (now - this.lastReport < 0.25) return;
+        this.lastReport = now;
+        this.port.postMessage({
+            depthMs: depth * 1000 / this.inputRate,
+            rate: this.rate,
+            underruns: this.underruns,
+            latencies: this.latencies
+        });
+        this.latencies = [];
+    }
+}
+
+registerProcessor('jitter-buffer-player', JitterBufferPlayer);
+"""
+
+async def player_worklet(request):
+    return web.Response(text=PLAYER_WORKLET_JS, content_type="application/javascript")
+
+# Декодер страницы: Web Worker разбирает кадры и отдаёт Float32 прямо в
+# AudioWorklet через MessagePort, не занимая основной поток
+DECODER_WORKER_JS = """
+// Бинарный формат кадра (см. protocol.py)
+const FRAME_HEADER_SIZE = 20;
+const FORMAT_PCM16 = 1;
+const FORMAT_ULAW = 2;
+const FORMAT_ADPCM = 3;
+const FORMAT_NAMES = { 1: 'int16', 2: 'μ-law', 3: 'IMA-ADPCM' };
+
+// G.711 μ-law: таблица на 256 кодов
+const ULAW_TABLE = (function() {
+    const table = new Float32Array(256);
+    for (let i = 0; i < 256; i++) {
+        const code = ~i & 0xFF;
+        const exponent = (code >> 4) & 0x07;
+        const magnitude = ((((code & 0x0F) << 3) + 0x84) << exponent) - 0x84;
+        table[i] = ((code & 0x80) ? -magnitude : magnitude) / 32768.0;
+    }
+    return table;
+})();
+
+// IMA-ADPCM (см. audio_codec.py)
+const ADPCM_STEPS = [
+    7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+    50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+    253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+    1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+    3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+    11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+    32767
+];
+const ADPCM_INDEX_ADJUST = [-1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8];
+
+function decodeAdpcm(buffer, offset) {
+    const view = new DataView(buffer, offset);
+    let predictor = view.getInt16(0, true);
+    let index = view.getUint8(2);
+    const codes = new Uint8Array(buffer, offset + 4);
+    const count = codes.length * 2 - (view.getUint8(3) & 1);
+    const output = new Float32Array(count);
+    
+    for (let i = 0; i < count; i++) {
+        const code = (i & 1) ? (codes[i >> 1] >> 4) : (codes[i >> 1] & 0x0F);
+        const step = ADPCM_STEPS[index];
+        let delta = step >> 3;
+        if (code & 4) delta += step;
+        if (code & 2) delta += step >> 1;
+        if (code & 1) delta += step >> 2;
+        predictor += (code & 8) ? -delta : delta;
+        if (predictor > 32767) predictor = 32767;
+        else if (predictor < -32768) predictor = -32768;
+        output[i] = predictor / 32768.0;
+        
+        index += ADPCM_INDEX_ADJUST[code];
+        if (index < 0) index = 0;
+        else if (index > 88) index = 88;
+    }
+    return output;
+}
+
+// Функция для обработки аудио
+function processAudioData(buffer) {
+    try {
+        if (buffer.byteLength <= FRAME_HEADER_SIZE) {
+            console.warn("⚠️ Too little data");
+            return null;
+        }
+        
+        // Заголовок: magic 'AU', version, format, sample_rate, ...
+        const view = new DataView(buffer);
+        if (view.getUint8(0) !== 0x41 || view.getUint8(1) !== 0x55) {
+            console.warn("⚠️ Unknown frame");
+            return null;
+        }
+        const format = view.getUint8(3);
+        const sampleRate = view.getUint16(4);
+        const timestamp = view.getFloat64(12);
+        let samples;
+        
+        if (format === FORMAT_PCM16) {
+            // Данные int16 сразу после заголовка, без копирования
+            const int16Array = new Int16Array(buffer, FRAME_HEADER_SIZE,
+                (buffer.byteLength - FRAME_HEADER_SIZE) >> 1);
+            samples = new Float32Array(int16Array.length);
+            for (let i = 0; i < int16Array.length; i++) {
+                samples[i] = int16Array[i] / 32768.0;
+            }
+        } else if (format === FORMAT_ULAW) {
+            const codes = new Uint8Array(buffer, FRAME_HEADER_SIZE);
+            samples = new Float32Array(codes.length);
+            for (let i = 0; i < codes.length; i++) {
+                samples[i] = ULAW_TABLE[codes[i]];
+            }
+        } else if (format === FORMAT_ADPCM) {
+            samples = decodeAdpcm(buffer, FRAME_HEADER_SIZE);
+        } else {
+            console.warn("⚠️ Unsupported audio format:", format);
+            return null;
+        }
+        
+        return { samples: samples, sampleRate: sampleRate, format: format, timestamp: timestamp };
+        
+    } catch (error) {
+        console.error('❌ Audio decoding error:', error);
+        return null;
+    }
+}
+
+// Порт AudioWorklet-плеера (передаётся со страницы)
+let playerPort = null;
+let lastFormat = 0;
+let lastSampleRate = 0;
+
+self.onmessage = function(event) {
+    const data = event.data;
+    if (data instanceof ArrayBuffer) {
+        const audioData = processAudioData(data);
+        if (!audioData) return;
+        if (playerPort) {
+            playerPort.postMessage(
+                { samples: audioData.samples, sampleRate: audioData.sampleRate, timestamp: audioData.timestamp },
+                [audioData.samples.buffer]
+            );
+        }
+        // Формат сообщаем странице только при изменении
+        if (audioData.format !== lastFormat || audioData.sampleRate !== lastSampleRate) {
+            lastFormat = audioData.format;
+            lastSampleRate = audioData.sampleRate;
+            self.postMessage({ format: FORMAT_NAMES[lastFormat] || lastFormat, sampleRate: lastSampleRate });
+        }
+    } else if (data.port) {
+        playerPort = data.port;
+    } else if (data.reset && playerPort) {
+        playerPort.postMessage({ reset: true });
+    }
+};
+"""
+
+async def decoder_worker(request):
+    return web.Response(text=DECODER_WORKER_JS, content_type="application/javascript")
+
+# Заголовок WebSocket-кадра сервер -> клиент (без маски, RFC 6455)
+WS_FRAME_SHORT = struct.Struct('!BB')
+WS_FRAME_MEDIUM = struct.Struct('!BBH')
+WS_FRAME_LONG = struct.Struct('!BBQ')
+
+# Кадр собирается один раз на пакет и пишется в транспорт каждого слушателя
+def build_ws_frame(payload, opcode=WSMsgType.BINARY):
+    length = len(payload)
+    if length < 126:
+        header = WS_FRAME_SHORT.pack(0x80 | opcode, length)
+    elif length < 65536:
+        header = WS_FRAME_MEDIUM.pack(0x80 | opcode, 126, length)
+    else:
+        header = WS_FRAME_LONG.pack(0x80 | opcode, 127, length)
+    return header + payload
+
+# Слушатели с новыми кадрами: сбрасываются одним вызовом за итерацию цикла
+pending_flush = set()
+flush_scheduled = False
+
+def schedule_flush(listener):
+    global flush_scheduled
+    pending_flush.add(listener)
+    if not flush_scheduled:
+        flush_scheduled = True
+        asyncio.get_running_loop().call_soon(flush_listeners)
+
+def flush_listeners():
+    global flush_scheduled
+    flush_scheduled = False
+    batch = list(pending_flush)
+    pending_flush.clear()
+    for listener in batch:
+        listener.flush()
+
+# Слушатель: своя ограниченная очередь готовых кадров и задача-писатель
+# для медленного сокета, чтобы он не тормозил остальных и чтение источника
+class Listener:
+    _ids = itertools.count(1)
+
+    def __init__(self, ws, transport, remote=None):
+        self.id = next(self._ids)
+        self.ws = ws
+        self.transport = transport
+        self.remote = remote
+        self.queue = collections.deque()
+        # Аудиокадров в очереди: управляющие в предел очереди не входят
+        self.audio_queued = 0
+        self.wakeup = asyncio.Event()
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped = 0
+        self.closing = None
+        self.channel = None
+        self.format = None
+        self.queue_limit = LISTENER_QUEUE_SIZE
+        # Задержка захват -> воспроизведение по отчёту страницы
+        self.latency = None
+        self.task = asyncio.create_task(self.writer())
+
+    @property
+    def closed(self):
+        return self.ws.closed or self.transport is None or self.transport.is_closing()
+
+    def enqueue(self, frame):
+        if self.closing is not None:
+            return
+        if self.audio_queued >= self.queue_limit:
+            self.dropped += 1
+            if LISTENER_OVERFLOW == 'drop_newest':
+                return
+            if LISTENER_OVERFLOW == 'disconnect':
+                self.disconnect()
+                return
+            self.drop_oldest_audio()
+        self.queue.append(frame)
+        self.audio_queued += 1
+        schedule_flush(self)
+
+    # Вытесняем самый старый аудиокадр; статусы перед ним остаются на месте
+    def drop_oldest_audio(self):
+        for index, queued in enumerate(self.queue):
+            if queued[0] & 0x0f == WSMsgType.BINARY:
+                del self.queue[index]
+                self.audio_queued -= 1
+                return
+
+    # Управляющие сообщения не проходят через политику переполнения
+    def send_status(self, payload):
+        self.queue.append(build_ws_frame(json.dumps(payload).encode(), WSMsgType.TEXT))
+        schedule_flush(self)
+
+    def disconnect(self):
+        if self.closing is None and not self.ws.closed:
+            print(f"⚠️ Listener {self.id} too slow, disconnecting")
+            self.queue.clear()
+            self.audio_queued = 0
+            self.closing = asyncio.create_task(self.ws.close(
+                code=WSCloseCode.TRY_AGAIN_LATER, message=b'send queue overflow'))
+
+    # Пишем всё накопленное одним writelines, если сокет не занят;
+    # force - перед закрытием, когда ждать разгрузки уже некогда
+    def flush(self, force=False):
+        if not self.queue or self.closed:
+            return
+        if not force and self.transport.get_write_buffer_size() > LISTENER_WRITE_BUFFER:
+            self.wakeup.set()
+            return
+        self.transport.writelines(self.queue)
+        self.sent_frames += len(self.queue)
+        self.sent_bytes += sum(map(len, self.queue))
+        self.queue.clear()
+        self.audio_queued = 0
+
+    # Ждём, пока медленный сокет разгрузит буфер
+    async def writer(self):
+        while not self.closed:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.queue and not self.closed:
+                if self.transport.get_write_buffer_size() > LISTENER_WRITE_BUFFER:
+                    await asyncio.sleep(LISTENER_DRAIN_POLL)
+                else:
+                    self.flush()
+
+    def close(self):
+        self.task.cancel()
+        self.queue.clear()
+        self.audio_queued = 0
+        pending_flush.discard(self)
+
+    def stats(self):
+        return {
+            "id": self.id,
+            "remote": self.remote,
+            "format": format_name(self.format),
+            "queue_depth": len(self.queue),
+            "queue_limit": self.queue_limit,
+            "sent_frames": self.sent_frames,
+            "sent_bytes": self.sent_bytes,
+            "dropped": self.dropped,
+            "playout_latency": self.latency
+        }
+
+# История кадров источника: последние секунды по packet_id с пределом по
+# памяти. Новый слушатель получает из неё предзагрузку, вернувшийся - пропущенное
+HISTORY_SECONDS = float(os.environ.get('HISTORY_SECONDS', 5))
+HISTORY_MAX_BYTES = int(os.environ.get('HISTORY_MAX_BYTES', 1024 * 1024))
+# Предзагрузка, если профиль канала не задаёт буфер плеера, мс
+PREROLL_MS = int(os.environ.get('PREROLL_MS', 150))
+
+class FrameHistory:
+    def __init__(self):
+        self.ids = collections.deque()
+        self.frames = collections.deque()
+        self.bytes = 0
+        self.max_frames = LISTENER_QUEUE_SIZE
+
+    def resize(self, frame_ms):
+        self.max_frames = max(1, int(HISTORY_SECONDS * 1000 / frame_ms))
+        self.trim()
+
+    def append(self, frame):
+        # Срез склеенного сообщения копируем, чтобы не держать его целиком
+        if not isinstance(frame, bytes):
+            frame = bytes(frame)
+        self.ids.append(protocol.packet_id(frame))
+        self.frames.append(frame)
+        self.bytes += len(frame)
+        self.trim()
+
+    def trim(self):
+        while self.frames and (len(self.frames) > self.max_frames or self.bytes > HISTORY_MAX_BYTES):
+            self.ids.popleft()
+            self.bytes -= len(self.frames.popleft())
+
+    def clear(self):
+        self.ids.clear()
+        self.frames.clear()
+        self.bytes = 0
+
+    def last(self, count):
+        return list(itertools.islice(self.frames, max(0, len(self.frames) - count), None))
+
+    # Кадры после packet_id; None - этого места в истории уже (или ещё) нет
+    def after(self, packet_id):
+        if not self.ids or not self.ids[0] - 1 <= packet_id <= self.ids[-1]:
+            return None
+        start = bisect.bisect_right(self.ids, packet_id)
+        return list(itertools.islice(self.frames, start, None))
+
+    def stats(self):
+        return {
+            "frames": len(self.frames),
+            "bytes": self.bytes,
+            "first_packet": self.ids[0] if self.ids else None,
+            "last_packet": self.ids[-1] if self.ids else None
+        }
+
+# Канал: один источник и его подписчики
+class Channel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.source = None
+        self.info = {}
+        self.subscribers = set()
+        # Подписчики по формату и перекодировщики для каждого формата
+        self.groups = {}
+        self.transcoders = {}
+        self.room = None
+        self.profile = None
+        self.frame_ms = None
+        self.queue_limit = LISTENER_QUEUE_SIZE
+        self.history = FrameHistory()
+        self.pacer = None
+        # Счётчики для /metrics
+        self.frames_in = 0
+        self.bytes_in = 0
+        self.frames_relayed = 0
+        self.source_connects = 0
+        # Задержка захват -> сервер, если источник синхронизировал часы
+        self.clock_synced = False
+        self.ingress = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, listener):
+        self.subscribers.add(listener)
+        self.groups.setdefault(listener.format, set()).add(listener)
+        listener.queue_limit = self.queue_limit
+
+    # Длительность кадра задаёт очередь подписчиков, профиль - буфер плеера
+    def set_profile(self, profile, frame_ms):
+        self.profile = profile
+        self.frame_ms = frame_ms
+        self.queue_limit = max(LISTENER_QUEUE_MIN, int(LISTENER_QUEUE_MS / frame_ms))
+        self.history.resize(frame_ms)
+        for listener in self.subscribers:
+            listener.queue_limit = self.queue_limit
+
+    @property
+    def buffer_ms(self):
+        if self.profile is None:
+            return None
+        return protocol.PROFILES[self.profile]['buffer_ms']
+
+    def remove(self, listener):
+        self.subscribers.discard(listener)
+        group = self.groups.get(listener.format)
+        if group is not None:
+            group.discard(listener)
+            if not group:
+                del self.groups[listener.format]
+                self.transcoders.pop(listener.format, None)
+
+    def transcoder(self, key):
+        transcoder = self.transcoders.get(key)
+        if transcoder is None:
+            transcoder = self.transcoders[key] = Transcoder(*key)
+        return transcoder
+
+    def stats(self):
+        return {
+            "source": self.source is not None,
+            "subscribers": len(self.subscribers),
+            "formats": [format_name(key) for key in self.groups],
+            "room": self.room.name if self.room else None,
+            "profile": self.profile,
+            "frame_ms": self.frame_ms,
+            "history": self.history.stats(),
+            "pacing": self.pacer.stats() if self.pacer else None,
+            "ingress_latency": {f"p{int(point * 100)}": value
+                                for point, value in metrics.quantiles(self.ingress).items()}
+        }
+
+# Кодеки, которые принимает релей от источников (кадры идут дальше как есть)
+SERVER_CODECS = os.environ.get('CODECS', 'pcm16,ulaw,adpcm').split(',')
+
+# Профили задержки, которые может выбрать источник (см. protocol.PROFILES)
+SERVER_PROFILES = os.environ.get('PROFILES', ','.join(protocol.PROFILES)).split(',')
+
+# Частоты, которые слушатель может запросить
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 48000
+# Предел chunk_size старого клиента без профиля, сэмплов. Вместе с профилями
+# на MAX_SAMPLE_RATE задаёт самый большой кадр (pcm16, моно) и слот кольца
+MAX_CHUNK_SIZE = int(os.environ.get('MAX_CHUNK_SIZE', 8192))
+MAX_FRAME_SIZE = protocol.HEADER_SIZE + 2 * max(
+    [MAX_CHUNK_SIZE] + [protocol.profile_chunk_size(profile, MAX_SAMPLE_RATE) for profile in protocol.PROFILES])
+
+# Перекодировщик канала для одного формата слушателей: частота и кодек;
+# состояние ресемплера и ADPCM переносится между кадрами
+class Transcoder:
+    def __init__(self, fmt, sample_rate):
+        self.fmt = fmt
+        self.sample_rate = sample_rate
+        self.resampler = None
+        self.adpcm = audio_codec.AdpcmEncoder()
+
+    def transcode(self, header, pcm):
+        _, sample_rate, _, packet_id, timestamp = header
+        target_rate = self.sample_rate or sample_rate
+        if target_rate != sample_rate:
+            if self.resampler is None or self.resampler.src_rate != sample_rate:
+                self.resampler = audio_codec.Resampler(sample_rate, target_rate)
+            pcm = self.resampler.process(pcm)
+        payload = audio_codec.encode(self.fmt, pcm, self.adpcm)
+        return protocol.pack_frame(payload, packet_id, timestamp, target_rate, fmt=self.fmt)
+
+# Выравнивание источника по реальному времени: пачку кадров после сбоя сети
+# релей отдаёт слушателям не сразу, а в темпе захвата (по timestamp кадров),
+# догоняя с ускорением PACING_CATCHUP. Всё, что старше PACING_MAX_LATENCY,
+# выбрасывается. Включается для всех (PACING=1) или источником в приветствии
+PACING = os.environ.get('PACING', '0') == '1'
+PACING_CATCHUP = float(os.environ.get('PACING_CATCHUP', 1.25))
+PACING_MAX_LATENCY = float(os.environ.get('PACING_MAX_LATENCY', 1.0))
+
+class Pacer:
+    def __init__(self, channel):
+        self.channel = channel
+        self.queue = collections.deque()
+        # Позиция воспроизведения во времени источника и когда она обновлена
+        self.position = None
+        self.updated = 0.0
+        self.released_end = None
+        self.speed = 1.0
+        self.handle = None
+        self.dropped = 0
+
+    def push(self, frame):
+        timestamp = protocol.unpack_header(frame)[4]
+        self.queue.append((timestamp, frame))
+        # Предел задержки: выбрасываем самое старое
+        frame_time = self.channel.frame_ms / 1000
+        while len(self.queue) > 1 and self.queue[-1][0] + frame_time - self.queue[0][0] > PACING_MAX_LATENCY:
+            self.queue.popleft()
+            self.dropped += 1
+        if self.handle is None:
+            self.release(idle=True)
+
+    # Вызывается таймером; idle - первый кадр после простоя
+    def release(self, idle=False):
+        self.handle = None
+        if not self.queue:
+            return
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        frame_time = self.channel.frame_ms / 1000
+        head = self.queue[0][0]
+
+        if self.position is None:
+            self.position = head
+        else:
+            self.position += (now - self.updated) * self.speed
+            if idle:
+                # За время простоя позиция не уходит дальше отправленного
+                self.position = min(self.position, self.released_end)
+            if head > self.released_end + frame_time / 2:
+                # Разрыв во времени источника (выброшенные кадры) не ждём
+                self.position = max(self.position, head)
+        self.updated = now
+
+        while self.queue and self.queue[0][0] <= self.position + 1e-4:
+            timestamp, frame = self.queue.popleft()
+            relay_frame(self.channel, frame)
+            self.released_end = timestamp + frame_time
+        if not self.queue:
+            self.speed = 1.0
+            return
+
+        # Отстаём от источника больше чем на кадр - догоняем
+        backlog = self.queue[-1][0] + frame_time - self.position
+        self.speed = PACING_CATCHUP if backlog > 1.5 * frame_time else 1.0
+        self.handle = loop.call_later((self.queue[0][0] - self.position) / self.speed, self.release)
+
+    def close(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.queue.clear()
+
+    def stats(self):
+        return {
+            "queued": len(self.queue),
+            "dropped": self.dropped,
+            "speed": self.speed
+        }
+
+# Комнаты: несколько источников сводятся в один поток канала room:<имя>
+ROOM_PREFIX = 'room:'
+rooms = {}
+
+# Запас по громкости при сложении и порог мягкого ограничения
+MIXER_HEADROOM = float(os.environ.get('MIXER_HEADROOM', 0.7))
+MIXER_KNEE = 0.6
+# Задержка на джиттер сети и предел накопления на вход, сек
+MIXER_JITTER_DELAY = float(os.environ.get('MIXER_JITTER_DELAY', 0.1))
+MIXER_MAX_LATENCY = float(os.environ.get('MIXER_MAX_LATENCY', 0.5))
+
+# Вход микшера: кадры одного источника по packet_id и очередь сэмплов
+class MixerInput:
+    def __init__(self):
+        self.pending = []
+        self.chunks = collections.deque()
+        self.buffered = 0
+        self.position = 0
+        self.offset = None
+        self.last_packet_id = -1
+        self.late = 0
+
+    def push(self, packet_id, timestamp, samples, arrival):
+        if packet_id <= self.last_packet_id:
+            self.late += 1
+            return
+        # Смещение часов источника: быстро вниз, медленно вверх
+        transit = arrival - timestamp
+        if self.offset is None or transit < self.offset:
+            self.offset = transit
+        else:
+            self.offset += 0.001 * (transit - self.offset)
+        due = timestamp + self.offset + MIXER_JITTER_DELAY
+        bisect.insort(self.pending, (packet_id, due, samples), key=lambda item: item[0])
+
+    # Переносит созревшие кадры в очередь и копирует len(out) сэмплов в out
+    def take(self, now, out, max_buffered):
+        while self.pending and self.pending[0][1] <= now:
+            packet_id, _, samples = self.pending.pop(0)
+            self.last_packet_id = packet_id
+            self.chunks.append(samples)
+            self.buffered += len(samples)
+        while self.chunks and self.buffered - len(self.chunks[0]) + self.position >= max_buffered:
+            self.buffered -= len(self.chunks.popleft()) - self.position
+            self.position = 0
+            self.late += 1
+
+        filled = 0
+        while filled < len(out) and self.chunks:
+            chunk = self.chunks[0]
+            count = min(len(out) - filled, len(chunk) - self.position)
+            out[filled:filled + count] = chunk[self.position:self.position + count]
+            filled += count
+            self.position += count
+            self.buffered -= count
+            if self.position == len(chunk):
+                self.chunks.popleft()
+                self.position = 0
+        out[filled:] = 0
+        return filled > 0
+
+# Микшер комнаты: выравнивает кадры по timestamp/packet_id и сводит их
+# векторно в один кадр на такт, один раз на комнату
+class Mixer:
+    def __init__(self, name, sample_rate, frame_size):
+        self.name = name
+        self.channel_id = ROOM_PREFIX + name
+        self.sample_rate = sample_rate
+        self.frame_size = frame_size
+        self.inputs = {}
+        self.rows = np.zeros((0, frame_size), np.float32)
+        self.packet_id = 0
+        self.skipped = 0
+        self.task = None
+
+    @property
+    def closed(self):
+        return not self.inputs
+
+    def join(self, source_id):
+        self.inputs[source_id] = MixerInput()
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    def leave(self, source_id):
+        self.inputs.pop(source_id, None)
+
+    def push(self, source_id, frame, arrival):
+        mixer_input = self.inputs.get(source_id)
+        if mixer_input is None:
+            return
+        fmt, sample_rate, channels_count, packet_id, timestamp = protocol.unpack_header(frame)
+        if sample_rate != self.sample_rate or channels_count != 1:
+            self.skipped += 1
+            return
+        samples = audio_codec.decode(fmt, memoryview(frame)[protocol.HEADER_SIZE:])
+        mixer_input.push(packet_id, timestamp, samples, arrival)
+
+    def mix(self, now):
+        if self.rows.shape[0] != len(self.inputs):
+            self.rows = np.zeros((len(self.inputs), self.frame_size), np.float32)
+        max_buffered = int(MIXER_MAX_LATENCY * self.sample_rate)
+        active = 0
+        for row, mixer_input in zip(self.rows, self.inputs.values()):
+            active += mixer_input.take(now, row, max_buffered)
+        if not active:
+            return None
+
+        # Сумма с запасом и мягким ограничением выше порога
+        mixed = self.rows.sum(axis=0) * (MIXER_HEADROOM / 32768.0)
+        magnitude = np.abs(mixed)
+        over = magnitude > MIXER_KNEE
+        if over.any():
+            soft = MIXER_KNEE + (1 - MIXER_KNEE) * np.tanh((magnitude[over] - MIXER_KNEE) / (1 - MIXER_KNEE))
+            mixed[over] = np.copysign(soft, mixed[over])
+        pcm = (mixed * 32767.0).astype('<i2')
+
+        frame = protocol.pack_frame(pcm.tobytes(), self.packet_id, now - MIXER_JITTER_DELAY,
+                                    self.sample_rate)
+        self.packet_id += 1
+        return frame
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        period = self.frame_size / self.sample_rate
+        next_tick = loop.time()
+        try:
+            while self.inputs:
+                next_tick += period
+                await asyncio.sleep(max(0, next_tick - loop.time()))
+                if loop.time() - next_tick > 4 * period:
+                    next_tick = loop.time()
+                frame = self.mix(time.time())
+                channel = channels.get(self.channel_id)
+                if frame is not None and channel is not None:
+                    relay_frame(channel, frame)
+        except Exception as e:
+            print(f"❌ Mixer {self.name} error: {e}")
+        finally:
+            self.task = None
+
+    def stats(self):
+        return {
+            "sources": list(self.inputs),
+            "sample_rate": self.sample_rate,
+            "frame_size": self.frame_size,
+            "mixed_frames": self.packet_id,
+            "late_frames": sum(mixer_input.late for mixer_input in self.inputs.values()),
+            "skipped_frames": self.skipped
+        }
+
+def join_room(channel, name):
+    mixer = rooms.get(name)
+    if mixer is None:
+        mixer = rooms[name] = Mixer(
+            name,
+            int(channel.info.get('sample_rate', 16000)),
+            int(channel.info.get('chunk_size', 1024))
+        )
+    room_channel = channels.get(mixer.channel_id)
+    if room_channel is None:
+        room_channel = channels[mixer.channel_id] = Channel(mixer.channel_id)
+    if room_channel.source is not mixer:
+        room_channel.history.clear()
+        room_channel.set_profile(channel.profile, mixer.frame_size * 1000 / mixer.sample_rate)
+    room_channel.source = mixer
+    mixer.join(channel.id)
+    channel.room = mixer
+    print(f"🎛️ Audio source {channel.id} joined room {name}")
+
+def leave_room(channel):
+    mixer = channel.room
+    channel.room = None
+    mixer.leave(channel.id)
+    if mixer.inputs:
+        return
+    rooms.pop(mixer.name, None)
+    room_channel = channels.get(mixer.channel_id)
+    if room_channel is not None:
+        room_channel.source = None
+        publish_gone(room_channel.id)
+        drop_idle_channel(room_channel)
+
+def has_source(channel_id):
+    channel = channels.get(channel_id)
+    return channel is not None and channel.source is not None
+
+def live_channel_ids():
+    return [channel.id for channel in channels.values() if channel.source is not None]
+
+def subscribe(listener, channel_id):
+    unsubscribe(listener)
+    channel = channels.get(channel_id)
+    if channel is None:
+        channel = channels[channel_id] = Channel(channel_id)
+    listener.channel = channel_id
+    channel.add(listener)
+    if admission is not None:
+        admission.add(admission.channel(channel_id))
+
+def unsubscribe(listener):
+    channel = channels.get(listener.channel)
+    listener.channel = None
+    if channel is not None:
+        if admission is not None and listener in channel.subscribers:
+            admission.add(admission.channel(channel.id), -1)
+        channel.remove(listener)
+        drop_idle_channel(channel)
+
+def set_listener_format(listener, key):
+    channel = channels.get(listener.channel)
+    if channel is not None:
+        channel.remove(listener)
+    listener.format = key
+    if channel is not None:
+        channel.add(listener)
+
+def drop_idle_channel(channel):
+    if channel.source is None and not channel.subscribers:
+        channels.pop(channel.id, None)
+
+# Статус слушателю: его канал и список доступных
+def listener_status(listener, message):
+    channel = channels.get(listener.channel)
+    return {
+        'type': 'status',
+        'message': message,
+        'has_source': has_source(listener.channel),
+        'sources_count': len(live_channel_ids()),
+        'channel': listener.channel,
+        'channels': live_channel_ids(),
+        'profile': channel.profile if channel else None,
+        'buffer_ms': channel.buffer_ms if channel else None,
+        'format': format_name(listener.format)
+    }
+
+# Статус всем слушателям
+def broadcast_status(message):
+    for listener in listeners:
+        if not listener.closed:
+            listener.send_status(listener_status(listener, message))
+
 # Health check
+# Во время drain - 503, чтобы балансировщик убрал узел
 async def health(request):
     return web.json_response({
-        "status": "ok", 
+        "status": "draining" if draining is not None else "ok",
         "service": "audio-streaming-system",
         "stats": {
-            "audio_sources": len(audio_sources),
-            "listeners": len(listeners)
+            "audio_sources": len(live_channel_ids()),
+            "listeners": len(listeners),
+            "channels": {channel.id: channel.stats() for channel in channels.values()},
+            "rooms": {name: mixer.stats() for name, mixer in rooms.items()},
+            "listener_queues": [listener.stats() for listener in listeners],
+            "shared_ring": shared_ring_stats() if ring_writer is not None else None,
+            "backplane": bus.stats() if bus is not None else None,
+            "edge": edge_stats() if ORIGIN_URL else None,
+            "admission": admission_stats()
         }
-    })
+    }, status=503 if draining is not None else 200)
+
+# Номера слушателей в каждом процессе начинаются с 1: при WORKERS > 1
+# метка получает номер процесса, иначе ряды разных процессов совпали бы
+def metric_listener_id(listener):
+    return f'{worker_id}-{listener.id}' if WORKERS > 1 else listener.id
+
+# Метрики источников и слушателей собираются из их полей при запросе
+def collect_metrics():
+    channel_list = list(channels.values())
+    listener_list = list(listeners)
+
+    def per_channel(attr):
+        return [({'channel': channel.id}, getattr(channel, attr)) for channel in channel_list]
+
+    def per_listener(value):
+        return [({'listener': metric_listener_id(listener), 'channel': listener.channel or ''}, value(listener))
+                for listener in listener_list]
+
+    return [
+        metrics.Family('relay_sources', 'gauge', 'Connected audio sources',
+                       [(None, len(live_channel_ids()))]),
+        metrics.Family('relay_listeners', 'gauge', 'Connected listeners', [(None, len(listener_list))]),
+        metrics.Family('relay_channel_frames_in_total', 'counter',
+                       'Frames received from the channel source', per_channel('frames_in')),
+        metrics.Family('relay_channel_bytes_in_total', 'counter',
+                       'Bytes received from the channel source', per_channel('bytes_in')),
+        metrics.Family('relay_channel_frames_relayed_total', 'counter',
+                       'Frames fanned out to channel subscribers', per_channel('frames_relayed')),
+        metrics.Family('relay_channel_source_connects_total', 'counter',
+                       'Source connections to the channel', per_channel('source_connects')),
+        metrics.Family('relay_channel_subscribers', 'gauge', 'Listeners subscribed to the channel',
+                       [({'channel': channel.id}, len(channel.subscribers)) for channel in channel_list]),
+        metrics.Family('relay_channel_pacing_dropped_total', 'counter', 'Frames dropped by source pacing',
+                       [({'channel': channel.id}, channel.pacer.dropped)
+                        for channel in channel_list if channel.pacer is not None]),
+        metrics.Family('relay_listener_frames_out_total', 'counter', 'Frames written to the listener',
+                       per_listener(lambda listener: listener.sent_frames)),
+        metrics.Family('relay_listener_bytes_out_total', 'counter', 'Bytes written to the listener',
+                       per_listener(lambda listener: listener.sent_bytes)),
+        metrics.Family('relay_listener_dropped_total', 'counter', 'Frames dropped by the listener queue',
+                       per_listener(lambda listener: listener.dropped)),
+        metrics.Family('relay_listener_queue_depth', 'gauge', 'Frames waiting in the listener queue',
+                       per_listener(lambda listener: len(listener.queue))),
+        metrics.Family('relay_channel_ingress_latency_quantile_seconds', 'gauge',
+                       'Recent capture to server arrival time',
+                       [({'channel': channel.id, 'quantile': point}, value)
+                        for channel in channel_list
+                        for point, value in metrics.quantiles(channel.ingress).items()]),
+        metrics.Family('relay_listener_playout_latency_quantile_seconds', 'gauge',
+                       'Capture to playout time reported by the listener',
+                       [({'listener': metric_listener_id(listener), 'channel': listener.channel or '',
+                          'quantile': point},
+                         listener.latency[f"p{int(point * 100)}"])
+                        for listener in listener_list if listener.latency
+                        for point in (0.5, 0.95, 0.99)]),
+        metrics.Family('relay_shared_ring_lost_total', 'counter',
+                       'Records of another worker overwritten before this worker read them',
+                       [({'worker': worker_id, 'from': worker}, reader.lost) for worker, reader in ring_readers]),
+        metrics.Family('relay_shared_ring_too_large_total', 'counter',
+                       'Frames too large for a shared ring slot, not seen by other workers',
+                       [({'worker': worker_id}, ring_writer.too_large)] if ring_writer is not None else []),
+        metrics.Family('relay_backplane_frames_total', 'counter', 'Frames published to and received from the backplane',
+                       [({'direction': 'out'}, bus.published), ({'direction': 'in'}, bus.received)]
+                       if bus is not None else []),
+        metrics.Family('relay_edge_upstream_connected', 'gauge', 'Edge subscription to the origin channel is open',
+                       [({'channel': channel_id}, int(upstream.connected))
+                        for channel_id, upstream in upstreams.items()]),
+        metrics.Family('relay_edge_upstream_lag_quantile_seconds', 'gauge',
+                       'Capture to edge arrival time, origin clock',
+                       [({'channel': channel_id, 'quantile': point}, value)
+                        for channel_id, upstream in upstreams.items()
+                        for point, value in metrics.quantiles(upstream.lag).items()]),
+        metrics.Family('relay_backplane_dropped_total', 'counter',
+                       'Backplane messages dropped while disconnected or congested',
+                       [(None, bus.dropped)] if bus is not None else []),
+        metrics.Family('relay_admission_refused_total', 'counter', 'Connections refused by admission control',
+                       [({'reason': reason}, count) for reason, count in refusals.items()]),
+        OPEN_CONNECTIONS,
+        LISTENER_DOWNGRADES,
+        LOOP_LAG_AVG,
+        FANOUT_AVG,
+        INGRESS_LATENCY_SECONDS,
+        SOURCE_CONNECTIONS,
+        SOURCE_RECONNECTS,
+        LISTENER_CONNECTIONS,
+        LISTENER_RESUMES,
+        FANOUT_SECONDS,
+        LOOP_LAG,
+        LOOP_LAG_SECONDS,
+    ]
+
+async def metrics_endpoint(request):
+    return web.Response(
+        body=metrics.render(collect_metrics()).encode(),
+        headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'}
+    )
+
+# Кадров разослано за текущий такт measure_loop_lag
+fanout_frames = 0
+
+# Такт оценки нагрузки. Среднее время рассылки меняется только с кадрами:
+# если за такт их не было, оно затухает к нулю, иначе после всплеска и
+# тишины перегрузка держалась бы вечно и источники не смогли бы вернуться
+def update_load(lag):
+    global fanout_frames
+    LOOP_LAG_AVG.value += (lag - LOOP_LAG_AVG.value) * LOAD_SMOOTHING
+    if not fanout_frames:
+        FANOUT_AVG.value -= FANOUT_AVG.value * LOAD_SMOOTHING
+    fanout_frames = 0
+
+# Задержка цикла событий: насколько позже положенного просыпается sleep
+async def measure_loop_lag(app):
+    async def run():
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            lag = max(0.0, loop.time() - started - LOOP_LAG_INTERVAL)
+            LOOP_LAG.set(lag)
+            LOOP_LAG_SECONDS.observe(lag)
+            update_load(lag)
+
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+
+# Синхронизация часов (как в NTP): клиент шлёт t0, сервер отвечает временем
+# приёма t1 и отправки t2, клиент по t3 получает смещение и RTT
+def time_sync_reply(request_data, received):
+    return {
+        'type': 'time_sync',
+        't0': request_data.get('t0'),
+        't1': received,
+        't2': time.time()
+    }
+
+# Отчёт страницы о задержке воспроизведения, сек
+def listener_latency(data):
+    return {
+        'p50': float(data['p50']),
+        'p95': float(data['p95']),
+        'p99': float(data['p99']),
+        'count': int(data.get('count', 0)),
+        'clock_rtt': data.get('clock_rtt')
+    }
+
+# Аудио-сообщение старого формата (base64 в JSON, json.dumps клиента)
+LEGACY_AUDIO_PREFIX = '{"type": "audio"'
+
+# Конвертация аудио-сообщения старого формата
+def legacy_audio_to_frame(audio_data):
+    return protocol.pack_frame(
+        base64.b64decode(audio_data['data']),
+        packet_id=audio_data.get('packet_id', 0),
+        timestamp=audio_data.get('timestamp', time.time()),
+        sample_rate=audio_data.get('sample_rate', 16000)
+    )
+
+# Быстрый путь: аудио определяется по опкоду и префиксу, без разбора;
+# склеенные кадры режутся срезами без копирования
+def source_audio_frames(msg):
+    if msg.type == web.WSMsgType.BINARY:
+        if msg.data.startswith(protocol.MAGIC):
+            return (msg.data,)
+        if msg.data.startswith(protocol.MULTI_MAGIC):
+            return protocol.split_multi(msg.data)
+    elif msg.type == web.WSMsgType.TEXT:
+        if msg.data.startswith(LEGACY_AUDIO_PREFIX):
+            # Старый клиент: base64 в JSON -> бинарный кадр
+            return (legacy_audio_to_frame(json.loads(msg.data)),)
+    return ()
+
+# Формату слушателя нужен не исходный кадр
+def needs_transcode(key, header):
+    return key is not None and (key[0] != header[0] or key[1] not in (None, header[1]))
+
+# Собираем WebSocket-кадр один раз на формат и ставим его в очередь подписчиков;
+# исходный кадр декодируется не больше одного раза
+def relay_frame(channel, frame):
+    global fanout_frames
+    if TIME_FANOUT:
+        started = time.perf_counter()
+    # Кадры своих источников - остальным процессам и узлам
+    if (ring_writer is not None or bus is not None) and type(channel.source) is not RemoteSource:
+        publish_frame(channel, frame)
+    channel.frames_relayed += 1
+    channel.history.append(frame)
+    header = pcm = None
+    for key, group in channel.groups.items():
+        out = frame
+        if key is not None:
+            if header is None:
+                header = protocol.unpack_header(frame)
+            if needs_transcode(key, header):
+                if pcm is None:
+                    pcm = audio_codec.decode(header[0], memoryview(frame)[protocol.HEADER_SIZE:])
+                out = channel.transcoder(key).transcode(header, pcm)
+        wire = build_ws_frame(out)
+        for listener in group:
+            if not listener.closed:
+                listener.enqueue(wire)
+    if TIME_FANOUT:
+        elapsed = time.perf_counter() - started
+        FANOUT_SECONDS.observe(elapsed)
+        FANOUT_AVG.value += (elapsed - FANOUT_AVG.value) * FANOUT_SMOOTHING
+        fanout_frames += 1
+
+# Кадры из истории канала одному слушателю: после resume_after, если это
+# место ещё в истории, иначе короткая предзагрузка. Перекодировщик свой,
+# чтобы не сбить состояние общего
+def replay_history(listener, resume_after=None):
+    channel = channels.get(listener.channel)
+    if channel is None or not channel.frame_ms:
+        return 0
+    frames = None
+    if resume_after is not None:
+        frames = channel.history.after(int(resume_after))
+    if frames is None:
+        preroll_ms = channel.buffer_ms or PREROLL_MS
+        frames = channel.history.last(math.ceil(preroll_ms / channel.frame_ms))
+    frames = frames[-listener.queue_limit:]
+
+    transcoder = None
+    for frame in frames:
+        out = frame
+        if listener.format is not None:
+            header = protocol.unpack_header(frame)
+            if needs_transcode(listener.format, header):
+                if transcoder is None:
+                    transcoder = Transcoder(*listener.format)
+                pcm = audio_codec.decode(header[0], memoryview(frame)[protocol.HEADER_SIZE:])
+                out = transcoder.transcode(header, pcm)
+        listener.enqueue(build_ws_frame(out))
+    return len(frames)
+
+# Формат слушателя из приветствия: {"codec": "adpcm", "sample_rate": 8000}
+# или просто "adpcm". None - кадры источника как есть
+def listener_format(data):
+    requested = data.get('format')
+    if not requested:
+        return None
+    if isinstance(requested, str):
+        requested = {'codec': requested}
+    if not isinstance(requested, dict):
+        raise ValueError(f"bad format: {requested!r}")
+    codec = requested.get('codec', 'pcm16')
+    sample_rate = hello_int(requested, 'sample_rate', 0) or None
+    if codec not in audio_codec.CODECS:
+        raise ValueError(f"unknown codec: {codec}")
+    if sample_rate is not None and not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        raise ValueError(f"unsupported sample rate: {sample_rate}")
+    return audio_codec.CODECS[codec], sample_rate
+
+def format_name(key):
+    if key is None:
+        return 'source'
+    fmt, sample_rate = key
+    return f"{audio_codec.CODEC_NAMES[fmt]}@{sample_rate or 'source'}"
+
+# Кодек источника: первый из предложенных, который принимает релей
+def negotiate_codec(data):
+    for name in data.get('codecs') or ():
+        if name in SERVER_CODECS and name in audio_codec.CODECS:
+            return name
+    return 'pcm16'
+
+# Профиль источника: предложенный, если релей его принимает
+def negotiate_profile(data):
+    requested = data.get('profile')
+    if requested in SERVER_PROFILES and requested in protocol.PROFILES:
+        return requested
+    if protocol.DEFAULT_PROFILE in SERVER_PROFILES:
+        return protocol.DEFAULT_PROFILE
+    return SERVER_PROFILES[0]
+
+# Целое поле приветствия: ValueError с именем поля вместо ошибки int()
+def hello_int(data, key, default):
+    value = data.get(key) or default
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"bad {key}: {value!r}") from None
+
+# Параметры источника из приветствия; размер кадра задаёт профиль,
+# старый клиент без профиля шлёт кадры по своему chunk_size.
+# Только моно: перекодировщик, микшер комнат и плеер страницы стерео не разбирают
+def source_params(data):
+    sample_rate = hello_int(data, 'sample_rate', 16000)
+    channels_count = hello_int(data, 'channels', 1)
+    if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        raise ValueError(f"unsupported sample rate: {sample_rate}")
+    if channels_count != 1:
+        raise ValueError(f"unsupported channel count: {channels_count} (mono only)")
+    if 'profile' in data:
+        profile = negotiate_profile(data)
+        chunk_size = protocol.profile_chunk_size(profile, sample_rate)
+    else:
+        profile = None
+        chunk_size = hello_int(data, 'chunk_size', 1024)
+        if not 0 < chunk_size <= MAX_CHUNK_SIZE:
+            raise ValueError(f"bad chunk size: {chunk_size}")
+    return {
+        'sample_rate': sample_rate,
+        'channels': channels_count,
+        'chunk_size': chunk_size,
+        'profile': profile,
+        'frame_ms': chunk_size * 1000 / sample_rate
+    }
+
+# Регистрация источника: id берётся из поля client приветствия
+def attach_source(ws, data):
+    channel_id = str(data.get('client') or 'default')
+    if channel_id.startswith(ROOM_PREFIX):
+        raise ValueError(f"source id must not start with {ROOM_PREFIX!r}")
+    params = source_params(data)
+    channel = channels.get(channel_id)
+    if channel is None:
+        channel = channels[channel_id] = Channel(channel_id)
+    SOURCE_CONNECTIONS.inc()
+    if channel.source_connects:
+        SOURCE_RECONNECTS.inc()
+    channel.source_connects += 1
+    if channel.source is not None and not channel.source.closed:
+        # Переподключение: новое соединение заменяет старое
+        print(f"🔁 Audio source {channel_id} replaced")
+        asyncio.create_task(channel.source.close(message=b'replaced by new connection'))
+    channel.source = ws
+    channel.info = dict(data, **params)
+    channel.clock_synced = False
+    channel.ingress.clear()
+    # Новое соединение нумерует пакеты заново
+    channel.history.clear()
+    if channel.pacer is not None:
+        channel.pacer.close()
+    channel.pacer = Pacer(channel) if data.get('pacing', PACING) else None
+    channel.set_profile(params['profile'], params['frame_ms'])
+
+    # Источник в комнате дополнительно идёт в микшер
+    if channel.room is not None:
+        leave_room(channel)
+    if data.get('room'):
+        join_room(channel, str(data['room']))
+
+    # Слушатели без выбранного канала подключаются к первому источнику
+    for listener in listeners:
+        if listener.channel is None:
+            subscribe(listener, channel_id)
+    return channel
+
+def detach_source(ws, channel):
+    if channel.source is not ws:
+        return False
+    channel.source = None
+    publish_gone(channel.id)
+    if channel.pacer is not None:
+        channel.pacer.close()
+        channel.pacer = None
+    if channel.room is not None:
+        leave_room(channel)
+    drop_idle_channel(channel)
+    return True
+
+# Допуск: подключения по адресам, отказы по причинам, переводы на SHED_FORMAT
+connections = collections.Counter()
+# Открытые WebSocket -> Listener (None у источников и до приветствия)
+sockets = {}
+refusals = collections.Counter()
+OPEN_CONNECTIONS = metrics.Gauge('relay_connections', 'Open WebSocket connections')
+LISTENER_DOWNGRADES = metrics.Counter(
+    'relay_listener_downgrades_total', 'New listeners switched to SHED_FORMAT because of overload')
+CODEC_BITS = {protocol.FORMAT_PCM16: 16, protocol.FORMAT_ULAW: 8, protocol.FORMAT_ADPCM: 4}
+
+def format_key(name):
+    codec, _, sample_rate = name.partition('@')
+    return listener_format({'format': {'codec': codec, 'sample_rate': None if sample_rate == 'source' else sample_rate}})
+
+SHED_FORMAT_KEY = format_key(SHED_FORMAT)
+
+# Бит в секунду на канал; кадры источника как есть считаем самыми тяжёлыми
+def format_bitrate(key):
+    if key is None:
+        return math.inf
+    fmt, sample_rate = key
+    return CODEC_BITS[fmt] * (sample_rate or MAX_SAMPLE_RATE)
+
+def client_ip(request):
+    if TRUST_FORWARDED:
+        forwarded = request.headers.get('X-Forwarded-For')
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return request.remote
+
+# Отказ в подключении: (сообщение, причина для метрик) или None
+def connection_refusal(ip):
+    if MAX_CONNECTIONS and open_connections() >= MAX_CONNECTIONS:
+        return 'too many connections', 'connections'
+    if MAX_CONNECTIONS_PER_IP and ip_connections(ip) >= MAX_CONNECTIONS_PER_IP:
+        return 'too many connections from your address', 'connections_per_ip'
+    return None
+
+def channel_full(channel_id):
+    return bool(MAX_LISTENERS_PER_CHANNEL and channel_id is not None
+                and channel_listeners(channel_id) >= MAX_LISTENERS_PER_CHANNEL)
+
+# Счётчики для пределов: свои или, при WORKERS > 1, сумма по всем процессам
+def open_connections():
+    if admission is not None:
+        return admission.total(admission.TOTAL)
+    return OPEN_CONNECTIONS.value
+
+def ip_connections(ip):
+    if admission is not None:
+        return admission.total(admission.ip(str(ip)))
+    return connections[ip]
+
+def channel_listeners(channel_id):
+    if admission is not None:
+        return admission.total(admission.channel(channel_id))
+    channel = channels.get(channel_id)
+    return len(channel.subscribers) if channel is not None else 0
+
+def count_connection(ip, delta):
+    connections[ip] += delta
+    if not connections[ip]:
+        del connections[ip]
+    OPEN_CONNECTIONS.inc(delta)
+    if admission is not None:
+        admission.add(admission.TOTAL, delta)
+        admission.add(admission.ip(str(ip)), delta)
+
+# Перегрузка релея: описание или None
+def overload():
+    if SHED_LOOP_LAG and LOOP_LAG_AVG.value > SHED_LOOP_LAG:
+        return f'event loop lag {LOOP_LAG_AVG.value * 1000:.0f} ms'
+    if SHED_FANOUT and FANOUT_AVG.value > SHED_FANOUT:
+        return f'fan-out {FANOUT_AVG.value * 1000:.1f} ms per frame'
+    return None
+
+def retry_after_hint():
+    return round(random.uniform(RETRY_AFTER_MIN, RETRY_AFTER_MAX), 1)
+
+# Последний статус и закрытие; retry_after - и в статусе, и в причине закрытия
+async def send_goodbye(ws, listener, message, code, retry_after=None, **fields):
+    if retry_after is None:
+        retry_after = retry_after_hint()
+    payload = dict({'type': 'status', 'message': message, 'retry_after': retry_after, 'has_source': False},
+                   **fields)
+    if listener is not None:
+        # Через очередь слушателя, чтобы не обогнать уже отправленные кадры,
+        # и сразу в сокет, даже медленный: иначе он закроется без этого статуса
+        listener.send_status(payload)
+        listener.flush(force=True)
+    else:
+        await ws.send_str(json.dumps(payload))
+    await ws.close(code=code, message=protocol.close_reason(message, retry_after).encode())
+
+# Понятный статус и закрытие с кодом 1013 (Try Again Later)
+async def refuse(ws, message, reason):
+    refusals[reason] += 1
+    print(f"⛔ Connection refused: {message}")
+    await send_goodbye(ws, None, f'Server busy: {message}', WSCloseCode.TRY_AGAIN_LATER, refused=reason)
+
+# Неверное приветствие: статус с причиной и закрытие (1008), без подсказки паузы
+async def reject(ws, message):
+    print(f"⛔ Hello rejected: {message}")
+    await ws.send_str(json.dumps({'type': 'status', 'message': message, 'has_source': False,
+                                  'refused': 'invalid_hello'}))
+    await ws.close(code=WSCloseCode.POLICY_VIOLATION, message=protocol.close_reason(message).encode())
+
+# Остановка сервера: каждому клиенту своя пауза до переподключения, чтобы
+# после рестарта все не пришли в одну секунду
+async def close_connections(app):
+    if not sockets:
+        return
+    print(f"👋 Closing {len(sockets)} connections")
+    await asyncio.gather(*(send_goodbye(ws, listener, 'Server restarting', WSCloseCode.SERVICE_RESTART)
+                           for ws, listener in list(sockets.items()) if not ws.closed),
+                         return_exceptions=True)
+
+def admission_stats():
+    return {
+        "connections": OPEN_CONNECTIONS.value,
+        "connections_all_workers": open_connections() if admission is not None else None,
+        "addresses": len(connections),
+        "overload": overload(),
+        "loop_lag_avg": LOOP_LAG_AVG.value,
+        "fanout_avg": FANOUT_AVG.value,
+        "refused": dict(refusals),
+        "downgraded": LISTENER_DOWNGRADES.value
+    }
+
+# Плавная остановка (drain): SIGUSR1 (и SIGTERM при DRAIN_ON_SIGTERM=1) или
+# POST /drain с токеном DRAIN_TOKEN. Новых клиентов не принимаем, /health
+# отвечает 503; подключённым - статус с просьбой переподключиться, каждому
+# своё время в первой половине DRAIN_WINDOW. Релей работает, пока они не
+# уйдут, оставшихся закрываем в конце окна и выходим
+DRAIN_WINDOW = float(os.environ.get('DRAIN_WINDOW', 20))
+DRAIN_ON_SIGTERM = os.environ.get('DRAIN_ON_SIGTERM', '0') == '1'
+DRAIN_TOKEN = os.environ.get('DRAIN_TOKEN', '')
+# Подсказка паузы при отказе во время drain: дальше решает балансировщик
+DRAIN_RETRY_AFTER = 1.0
+DRAIN_POLL = 0.5
+DRAIN_MESSAGE = 'Server draining, reconnect elsewhere'
+
+# Время начала drain; None - обычная работа
+draining = None
+
+def start_drain():
+    global draining
+    if draining is not None:
+        return
+    draining = time.monotonic()
+    print(f"🚰 Draining {len(sockets)} connections within {DRAIN_WINDOW:g} s")
+    asyncio.create_task(drain())
+
+async def close_for_drain(ws, listener=None):
+    if not ws.closed:
+        await send_goodbye(ws, listener, DRAIN_MESSAGE, WSCloseCode.SERVICE_RESTART,
+                           retry_after=round(random.uniform(0, DRAIN_RETRY_AFTER), 1))
+
+async def drain():
+    loop = asyncio.get_running_loop()
+    for ws, listener in list(sockets.items()):
+        reconnect_in = round(random.uniform(0, DRAIN_WINDOW / 2), 1)
+        if listener is not None:
+            listener.send_status(dict(listener_status(listener, DRAIN_MESSAGE),
+                                      drain=True, reconnect_in=reconnect_in))
+        else:
+            # Источники статусы не читают: закрываем сами, клиент вернётся через долю секунды
+            loop.call_later(reconnect_in, lambda ws=ws: asyncio.create_task(close_for_drain(ws)))
+
+    deadline = draining + DRAIN_WINDOW
+    while sockets and time.monotonic() < deadline:
+        await asyncio.sleep(DRAIN_POLL)
+    if sockets:
+        print(f"🚰 Drain window over, closing {len(sockets)} connections")
+        await asyncio.gather(*(close_for_drain(ws, listener) for ws, listener in list(sockets.items())),
+                             return_exceptions=True)
+    print("🚰 Drain complete")
+    loop.call_soon(stop_server)
+
+def stop_server():
+    raise web.GracefulExit()
+
+# Повторный SIGTERM во время drain - остановка сразу
+def drain_or_exit():
+    if draining is not None:
+        stop_server()
+    start_drain()
+
+async def install_drain_signals(app):
+    if not hasattr(signal, 'SIGUSR1'):
+        return
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, start_drain)
+    if DRAIN_ON_SIGTERM:
+        loop.add_signal_handler(signal.SIGTERM, drain_or_exit)
+
+async def drain_endpoint(request):
+    # Сравнение за постоянное время: по задержке ответа токен не подобрать
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(),
+                               f'Bearer {DRAIN_TOKEN}'.encode()):
+        return web.json_response({'error': 'unauthorized'}, status=401)
+    if WORKERS > 1:
+        # Родитель передаст сигнал всем процессам
+        os.kill(os.getppid(), signal.SIGUSR1)
+    else:
+        start_drain()
+    return web.json_response({
+        'status': 'draining',
+        'window': DRAIN_WINDOW,
+        'connections': len(sockets)
+    }, status=202)
 
 # WebSocket handler
 async def websocket_handler(request):
-    ws = web.WebSocketResponse()
+    # Без permessage-deflate: кадры пишутся в транспорт как есть
+    ws = web.WebSocketResponse(compress=False)
     await ws.prepare(request)
     
+    if draining is not None:
+        await send_goodbye(ws, None, DRAIN_MESSAGE, WSCloseCode.SERVICE_RESTART,
+                           retry_after=round(random.uniform(0, DRAIN_RETRY_AFTER), 1), refused='draining')
+        return ws
+    ip = client_ip(request)
+    refusal = connection_refusal(ip)
+    if refusal is not None:
+        await refuse(ws, *refusal)
+        return ws
+    count_connection(ip, 1)
+    sockets[ws] = None
     client_type = None
+    channel = None
     
     try:
         async for msg in ws:
@@ -450,51 +2277,146 @@ async def websocket_handler(request):
                 data = json.loads(msg.data)
                 
                 if data.get('type') == 'spy':
+                    try:
+                        channel = attach_source(ws, data)
+                    except ValueError as e:
+                        await reject(ws, f'Source rejected: {e}')
+                        return ws
                     client_type = 'spy'
-                    audio_sources.add(ws)
-                    print(f"🎤 Audio source connected")
+                    codec = negotiate_codec(data)
+                    print(f"🎤 Audio source {channel.id} connected "
+                          f"({codec}, {channel.profile or 'no profile'}, {channel.frame_ms:.0f} ms)")
                     
-                    for listener in listeners:
-                        if not listener.closed:
-                            await listener.send_str(json.dumps({
-                                'type': 'status',
-                                'message': f'Audio source available',
-                                'has_source': True,
-                                'sources_count': len(audio_sources)
-                            }))
+                    # Ответ источнику: выбранные кодек и профиль
+                    await ws.send_str(json.dumps({
+                        'type': 'status',
+                        'message': f'Channel {channel.id} ready',
+                        'channel': channel.id,
+                        'codec': codec,
+                        'profile': channel.profile,
+                        'chunk_size': channel.info['chunk_size']
+                    }))
+                    
+                    broadcast_status(f'Audio source {channel.id} available')
                     
                     async for audio_msg in ws:
-                        if audio_msg.type == web.WSMsgType.TEXT:
-                            try:
-                                audio_data = json.loads(audio_msg.data)
-                                
-                                if audio_data.get('type') == 'audio':
-                                    # Пересылаем слушателям
-                                    for listener in list(listeners):
-                                        try:
-                                            if not listener.closed:
-                                                await listener.send_str(audio_msg.data)
-                                        except:
-                                            listeners.discard(listener)
-                                        
-                            except Exception as e:
-                                print(f"❌ Error: {e}")
+                        try:
+                            received = time.time()
+                            frames = source_audio_frames(audio_msg)
+                            for frame in frames:
+                                channel.frames_in += 1
+                                channel.bytes_in += len(frame)
+                                # Отметка приёма: задержка от захвата до сервера
+                                if channel.clock_synced:
+                                    ingress = received - protocol.timestamp(frame)
+                                    channel.ingress.append(ingress)
+                                    INGRESS_LATENCY_SECONDS.observe(ingress)
+                                if channel.pacer is not None:
+                                    channel.pacer.push(frame)
+                                else:
+                                    relay_frame(channel, frame)
+                                if channel.room is not None:
+                                    channel.room.push(channel.id, frame, received)
+                            if not frames and audio_msg.type == web.WSMsgType.TEXT:
+                                control = json.loads(audio_msg.data)
+                                if control.get('type') == 'time_sync':
+                                    channel.clock_synced = True
+                                    await ws.send_str(json.dumps(time_sync_reply(control, received)))
+                        except Exception as e:
+                            print(f"❌ Error: {e}")
                     
                 elif data.get('type') == 'listener':
+                    # Канал из приветствия, иначе первый доступный
+                    channel_id = data.get('channel')
+                    if not channel_id and live_channel_ids():
+                        channel_id = live_channel_ids()[0]
+                    channel_id = str(channel_id) if channel_id else None
+                    try:
+                        requested_format = listener_format(data)
+                        format_error = None
+                    except ValueError as e:
+                        # Неверный формат - кадры источника как есть, причина в статусе
+                        requested_format = None
+                        format_error = f'Format rejected: {e}'
+                    
+                    # Полный канал и перегрузка: отказ или формат полегче,
+                    # текущие слушатели продолжают как были
+                    shed = overload()
+                    if channel_full(channel_id):
+                        await refuse(ws, f'channel {channel_id} is full', 'channel_full')
+                        return ws
+                    if shed is not None and SHED_ACTION == 'refuse':
+                        await refuse(ws, f'overloaded, {shed}', 'overload')
+                        return ws
+                    downgrade = (shed is not None and
+                                 format_bitrate(requested_format) > format_bitrate(SHED_FORMAT_KEY))
+                    
                     client_type = 'listener'
-                    listeners.add(ws)
-                    print(f"🎧 Listener connected")
+                    listener = Listener(ws, request.transport, ip)
+                    listener.format = SHED_FORMAT_KEY if downgrade else requested_format
+                    listeners.add(listener)
+                    sockets[ws] = listener
+                    LISTENER_CONNECTIONS.inc()
+                    if data.get('resume_after') is not None:
+                        LISTENER_RESUMES.inc()
+                    if channel_id:
+                        subscribe(listener, channel_id)
+                    print(f"🎧 Listener {listener.id} connected to {listener.channel}")
                     
-                    await ws.send_str(json.dumps({
-                        'type': 'status',
-                        'message': 'Ready for audio streaming' if audio_sources else 'Waiting for audio source',
-                        'has_source': len(audio_sources) > 0,
-                        'sources_count': len(audio_sources)
-                    }))
+                    if downgrade:
+                        LISTENER_DOWNGRADES.inc()
+                        message = f'Server busy ({shed}), streaming as {format_name(listener.format)}'
+                        print(f"🎧 Listener {listener.id} downgraded: {shed}")
+                    elif format_error is not None:
+                        message = f'{format_error}, streaming as {format_name(listener.format)}'
+                    elif has_source(listener.channel):
+                        message = 'Ready for audio streaming'
+                    else:
+                        message = 'Waiting for audio source'
+                    listener.send_status(listener_status(listener, message))
+                    replayed = replay_history(listener, data.get('resume_after'))
+                    if replayed:
+                        print(f"⏪ Listener {listener.id}: {replayed} frames from history")
                     
                     try:
-                        async for _ in ws:
-                            pass
+                        async for listener_msg in ws:
+                            if listener_msg.type != web.WSMsgType.TEXT:
+                                continue
+                            received = time.time()
+                            request_data = json.loads(listener_msg.data)
+                            # Синхронизация часов страницы
+                            if request_data.get('type') == 'time_sync':
+                                listener.send_status(time_sync_reply(request_data, received))
+                            # Переключение на другой канал
+                            elif request_data.get('type') == 'subscribe' and request_data.get('channel'):
+                                if channel_full(str(request_data['channel'])):
+                                    listener.send_status(listener_status(
+                                        listener, f"Channel {request_data['channel']} is full"))
+                                    continue
+                                subscribe(listener, str(request_data['channel']))
+                                print(f"🎧 Listener {listener.id} switched to {listener.channel}")
+                                listener.send_status(listener_status(
+                                    listener, f'Listening to {listener.channel}'))
+                                replay_history(listener)
+                            # Смена формата
+                            elif request_data.get('type') == 'format':
+                                try:
+                                    key = listener_format(request_data)
+                                    # Под перегрузкой формат тяжелее SHED_FORMAT не выдаём
+                                    if (SHED_ACTION == 'downgrade' and overload() is not None
+                                            and format_bitrate(key) > format_bitrate(SHED_FORMAT_KEY)):
+                                        raise ValueError('server busy')
+                                    set_listener_format(listener, key)
+                                except ValueError as e:
+                                    listener.send_status(listener_status(listener, f'Format rejected: {e}'))
+                                    continue
+                                print(f"🎧 Listener {listener.id} format {format_name(listener.format)}")
+                            # Задержка захват -> воспроизведение, квантили от страницы
+                            elif request_data.get('type') == 'latency':
+                                try:
+                                    listener.latency = listener_latency(request_data)
+                                except (KeyError, TypeError, ValueError):
+                                    continue
                     except:
                         pass
     
@@ -502,33 +2424,483 @@ async def websocket_handler(request):
         print(f"❌ WebSocket error: {e}")
     
     finally:
-        if client_type == 'spy' and ws in audio_sources:
-            audio_sources.remove(ws)
-            print(f"🎤 Audio source disconnected")
-            
-            if not audio_sources:
-                for listener in listeners:
-                    if not listener.closed:
-                        await listener.send_str(json.dumps({
-                            'type': 'status',
-                            'message': 'No audio sources available',
-                            'has_source': False,
-                            'sources_count': 0
-                        }))
-                        
-        elif client_type == 'listener' and ws in listeners:
-            listeners.remove(ws)
-            print(f"🎧 Listener disconnected")
+        # Слот допуска освобождаем, даже если разбор роли упал
+        try:
+            if client_type == 'spy' and channel is not None and detach_source(ws, channel):
+                print(f"🎤 Audio source {channel.id} disconnected")
+                broadcast_status(f'Audio source {channel.id} disconnected'
+                                 if live_channel_ids() else 'No audio sources available')
+                            
+            elif client_type == 'listener':
+                unsubscribe(listener)
+                listener.close()
+                listeners.discard(listener)
+                print(f"🎧 Listener {listener.id} disconnected")
+        finally:
+            sockets.pop(ws, None)
+            count_connection(ip, -1)
     
     return ws
 
+# Несколько процессов на одном порту (SO_REUSEPORT, только Linux). Кадры
+# своих источников процесс пишет в своё кольцо в разделяемой памяти
+# (shared_ring.py), кольца остальных читает и раздаёт своим слушателям
+WORKERS = int(os.environ.get('WORKERS', 1))
+SHM_SLOTS = int(os.environ.get('SHM_SLOTS', 512))
+# Слот по умолчанию вмещает самый большой кадр, который пропускает приветствие
+SHM_SLOT_SIZE = int(os.environ.get('SHM_SLOT_SIZE', shared_ring.slot_size(MAX_FRAME_SIZE)))
+SHM_POLL = float(os.environ.get('SHM_POLL', 0.005))
+# Профиль в кольце и шине - номер в этом списке
+PROFILE_CODES = [None] + list(protocol.PROFILES)
+
+# Корзин на адреса и на каналы в общих счётчиках допуска
+ADMISSION_BUCKETS = 4096
+
+# Номер процесса, его кольцо и читатели чужих колец: [(номер, читатель), ...]
+worker_id = 0
+ring_writer = None
+ring_readers = []
+# Общие счётчики допуска (shared_ring.SharedCounters); None - один процесс
+admission = None
+
+# Общая шина между узлами за балансировщиком (backplane.py): memory,
+# redis://хост:6379; пустая строка - один узел. Процессы одного узла
+# (WORKERS) делят NODE_ID и обмениваются кадрами через кольца
+BACKPLANE = os.environ.get('BACKPLANE', '')
+BACKPLANE_PREFIX = os.environ.get('BACKPLANE_PREFIX', backplane.DEFAULT_PREFIX)
+NODE_ID = os.environ.get('NODE_ID') or uuid.uuid4().hex[:backplane.NODE_ID_SIZE]
+if len(NODE_ID.encode()) > backplane.NODE_ID_SIZE:
+    raise ValueError(f"NODE_ID must be at most {backplane.NODE_ID_SIZE} bytes: {NODE_ID!r}")
+bus = None
+
+# Источник другого процесса или узла пропал без уведомления (упал)
+REMOTE_SOURCE_TIMEOUT = float(os.environ.get('REMOTE_SOURCE_TIMEOUT', 3.0))
+REMOTE_EXPIRY_INTERVAL = 1.0
+
+# Источник, подключённый к другому процессу ('worker 1') или узлу ('node ...')
+class RemoteSource:
+    closed = False
+
+    def __init__(self, origin):
+        self.origin = origin
+        self.last_seen = time.monotonic()
+
+    async def close(self, message=b''):
+        pass
+
+def publish_frame(channel, frame):
+    frame_ms = channel.frame_ms or 0.0
+    profile = PROFILE_CODES.index(channel.profile) if channel.profile in PROFILE_CODES else 0
+    if ring_writer is not None:
+        if not ring_writer.publish(shared_ring.KIND_FRAME, channel.id, frame, frame_ms, profile):
+            # Остальные процессы этот кадр не получат; пишем первый и каждый сотый
+            if ring_writer.too_large % 100 == 1:
+                print(f"⚠️ Frame of {len(frame)} bytes from {channel.id} does not fit a shared ring "
+                      f"slot ({SHM_SLOT_SIZE} bytes), {ring_writer.too_large} dropped so far")
+    if bus is not None:
+        bus.publish_frame(channel.id, frame, frame_ms, profile)
+
+def publish_gone(channel_id):
+    if ring_writer is not None:
+        ring_writer.publish(shared_ring.KIND_GONE, channel_id)
+    if bus is not None:
+        bus.publish_event(channel_id, {'type': 'source_gone'})
+
+def drop_remote_source(channel, message):
+    channel.source = None
+    drop_idle_channel(channel)
+    print(f"🎤 Audio source {channel.id} disconnected ({message})")
+    broadcast_status(f'Audio source {channel.id} disconnected'
+                     if live_channel_ids() else 'No audio sources available')
+
+# Кадр источника с другого процесса или узла. Свой источник канала важнее чужого
+def on_remote_frame(origin, channel_id, frame, frame_ms, profile):
+    channel = channels.get(channel_id)
+    if channel is None:
+        channel = channels[channel_id] = Channel(channel_id)
+    source = channel.source
+    if source is not None and type(source) is not RemoteSource:
+        return
+    profile = PROFILE_CODES[profile] if profile < len(PROFILE_CODES) else None
+    if source is None or source.origin != origin:
+        # Источник появился или переехал: нумерация пакетов заново
+        source = channel.source = RemoteSource(origin)
+        channel.history.clear()
+        if frame_ms:
+            channel.set_profile(profile, frame_ms)
+        print(f"🎤 Audio source {channel_id} available on {origin}")
+        # Слушатели без выбранного канала подключаются к первому источнику
+        for listener in listeners:
+            if listener.channel is None:
+                subscribe(listener, channel_id)
+        broadcast_status(f'Audio source {channel_id} available')
+    elif frame_ms and (frame_ms != channel.frame_ms or profile != channel.profile):
+        channel.set_profile(profile, frame_ms)
+    source.last_seen = time.monotonic()
+    channel.frames_in += 1
+    channel.bytes_in += len(frame)
+    relay_frame(channel, frame)
+
+def on_remote_gone(origin, channel_id):
+    channel = channels.get(channel_id)
+    if channel is not None and type(channel.source) is RemoteSource and channel.source.origin == origin:
+        drop_remote_source(channel, origin)
+
+def expire_remote_sources():
+    now = time.monotonic()
+    for channel in list(channels.values()):
+        if type(channel.source) is RemoteSource and now - channel.source.last_seen > REMOTE_SOURCE_TIMEOUT:
+            drop_remote_source(channel, 'timeout')
+
+# Опрос чужих колец; раз в секунду - источники упавших процессов
+async def read_shared_rings(app):
+    async def run():
+        origins = [(f'worker {worker}', reader) for worker, reader in ring_readers]
+        next_expiry = 0.0
+        while True:
+            await asyncio.sleep(SHM_POLL)
+            for origin, reader in origins:
+                for kind, channel_id, frame, frame_ms, profile in reader.poll():
+                    try:
+                        if kind == shared_ring.KIND_GONE:
+                            on_remote_gone(origin, channel_id)
+                        else:
+                            on_remote_frame(origin, channel_id, frame, frame_ms, profile)
+                    except Exception as e:
+                        print(f"❌ Shared ring error: {e}")
+            now = time.monotonic()
+            if now >= next_expiry:
+                next_expiry = now + REMOTE_EXPIRY_INTERVAL
+                expire_remote_sources()
+
+    task = asyncio.create_task(run())
+    yield
+    task.cancel()
+
+def shared_ring_stats():
+    return {
+        "worker": worker_id,
+        "published": ring_writer.write_seq,
+        "too_large": ring_writer.too_large,
+        "lost": {worker: reader.lost for worker, reader in ring_readers}
+    }
+
+def on_bus_event(node, channel_id, event):
+    if event.get('type') == 'source_gone':
+        on_remote_gone(f'node {node}', channel_id)
+
+# Подключение к шине; раз в секунду - источники упавших узлов
+async def connect_backplane(app):
+    global bus
+    bus = backplane.create_backplane(BACKPLANE, NODE_ID, BACKPLANE_PREFIX)
+    await bus.start(lambda node, *frame: on_remote_frame(f'node {node}', *frame), on_bus_event)
+    print(f"🔗 Backplane {BACKPLANE.split('@')[-1]}, node {NODE_ID}")
+
+    async def expire():
+        while True:
+            await asyncio.sleep(REMOTE_EXPIRY_INTERVAL)
+            expire_remote_sources()
+
+    task = asyncio.create_task(expire())
+    yield
+    task.cancel()
+    await bus.close()
+    bus = None
+
+# Процесс-обработчик: сегменты колец достались от родителя через fork
+def run_worker(index, segments, counters, port):
+    global worker_id, ring_writer, ring_readers, admission
+    worker_id = index
+    admission = shared_ring.SharedCounters(counters, index, WORKERS, ADMISSION_BUCKETS)
+    ring_writer = shared_ring.RingWriter(segments[index])
+    ring_readers = [(worker, shared_ring.RingReader(segment))
+                    for worker, segment in enumerate(segments) if worker != index]
+    app.cleanup_ctx.append(read_shared_rings)
+    print(f"👷 Worker {index} started (pid {os.getpid()})")
+    web.run_app(app, host='0.0.0.0', port=port, reuse_port=True, print=None)
+
+# Родитель создаёт кольца, запускает обработчики и ждёт; упал один -
+# останавливаются все (перезапуск - дело супервизора)
+def run_workers(port):
+    if not hasattr(socket, 'SO_REUSEPORT'):
+        raise SystemExit("WORKERS > 1 needs SO_REUSEPORT (Linux)")
+    segments = [shared_ring.create(SHM_SLOTS, SHM_SLOT_SIZE) for _ in range(WORKERS)]
+    counters = shared_ring.SharedCounters.create(WORKERS, ADMISSION_BUCKETS)
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=run_worker, args=(index, segments, counters, port))
+                 for index in range(WORKERS)]
+    for process in processes:
+        process.start()
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    # Drain: сигнал всем обработчикам, ждём, пока выйдут все
+    drain_requested = []
+
+    def forward_drain(*args):
+        drain_requested.append(True)
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGUSR1)
+
+    if hasattr(signal, 'SIGUSR1'):
+        signal.signal(signal.SIGUSR1, forward_drain)
+    try:
+        alive = processes
+        while alive:
+            multiprocessing.connection.wait([process.sentinel for process in alive])
+            alive = [process for process in processes if process.is_alive()]
+            if not drain_requested:
+                print("❌ Worker exited, stopping")
+                break
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        for process in processes:
+            process.join()
+        for segment in segments + [counters]:
+            segment.close()
+            segment.unlink()
+
+# Edge-режим: релей подписывается на origin-релей (ORIGIN_URL, http(s)://хост:порт)
+# одним слушателем на канал и раздаёт кадры своим слушателям; origin отдаёт
+# по потоку на edge, а не на каждый браузер. Список каналов - из /health origin
+ORIGIN_URL = os.environ.get('ORIGIN_URL', '').rstrip('/')
+EDGE_POLL = float(os.environ.get('EDGE_POLL', 2.0))
+EDGE_RECONNECT_MIN = 0.5
+EDGE_RECONNECT_MAX = float(os.environ.get('EDGE_RECONNECT_MAX', 15.0))
+EDGE_TIME_SYNC_PINGS = 5
+
+# Подписки на origin по id канала
+upstreams = {}
+
+# Длительность кадра по его содержимому, мс (для источников без профиля)
+def frame_duration_ms(frame):
+    fmt, sample_rate, channels_count, _, _ = protocol.unpack_header(frame)
+    samples = len(audio_codec.decode(fmt, memoryview(frame)[protocol.HEADER_SIZE:]))
+    return samples / channels_count * 1000 / sample_rate
+
+# Канал origin как источник edge-канала: подключение слушателем с resume_after,
+# переподключение с нарастающей паузой
+class Upstream:
+    closed = False
+
+    def __init__(self, channel_id):
+        self.channel_id = channel_id
+        self.task = None
+        self.connected = False
+        self.has_source = False
+        self.profile = None
+        self.connects = 0
+        self.frames = 0
+        self.last_frame = None
+        # Смещение часов origin и задержка захват -> edge по его часам
+        self.clock_offset = 0.0
+        self.clock_rtt = None
+        self.time_sync = set()
+        self.retry_after = None
+        self.ws = None
+        self.lag = collections.deque(maxlen=LATENCY_WINDOW)
+
+    async def close(self, message=b''):
+        pass
+
+    def start(self, session):
+        self.task = asyncio.create_task(self.run(session))
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        self.on_source_lost('stopped on origin')
+
+    async def run(self, session):
+        attempt = 0
+        while True:
+            try:
+                async with session.ws_connect(ORIGIN_URL + '/ws', heartbeat=30) as ws:
+                    self.ws = ws
+                    await self.subscribe(ws)
+                    attempt = 0
+                    async for msg in ws:
+                        if msg.type == WSMsgType.BINARY:
+                            self.on_frame(msg.data)
+                        elif msg.type == WSMsgType.TEXT:
+                            self.on_message(json.loads(msg.data))
+            except (ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+                print(f"❌ Upstream {self.channel_id}: {e}")
+            finally:
+                self.connected = False
+                self.ws = None
+            self.on_source_lost('origin connection lost')
+            await asyncio.sleep(protocol.retry_delay(attempt, EDGE_RECONNECT_MIN, EDGE_RECONNECT_MAX, self.retry_after))
+            self.retry_after = None
+            attempt += 1
+
+    async def subscribe(self, ws):
+        hello = {'type': 'listener', 'channel': self.channel_id}
+        channel = channels.get(self.channel_id)
+        if channel is not None and channel.history.ids:
+            hello['resume_after'] = channel.history.ids[-1]
+        await ws.send_str(json.dumps(hello))
+        self.connected = True
+        self.connects += 1
+        print(f"🛰️ Upstream {self.channel_id} connected to {ORIGIN_URL}"
+              + (f", resume after {hello['resume_after']}" if 'resume_after' in hello else ""))
+        for _ in range(EDGE_TIME_SYNC_PINGS):
+            t0 = time.time()
+            self.time_sync.add(t0)
+            await ws.send_str(json.dumps({'type': 'time_sync', 't0': t0}))
+
+    def on_message(self, data):
+        if data.get('type') == 'time_sync':
+            if data.get('t0') not in self.time_sync:
+                return
+            self.time_sync.discard(data['t0'])
+            # Как в NTP: берём обмен с наименьшим RTT
+            t3 = time.time()
+            rtt = (t3 - data['t0']) - (data['t2'] - data['t1'])
+            if self.clock_rtt is None or rtt < self.clock_rtt:
+                self.clock_rtt = rtt
+                self.clock_offset = ((data['t1'] - data['t0']) + (data['t2'] - t3)) / 2
+        elif data.get('type') == 'status' and data.get('retry_after') is not None:
+            # Origin закрывает соединение и подсказывает, когда вернуться
+            self.retry_after = float(data['retry_after'])
+        elif data.get('type') == 'status' and data.get('drain') and self.ws is not None:
+            # Origin уходит на перезапуск: в назначенное время переподключаемся,
+            # балансировщик отправит на другой узел, догоним по resume_after
+            ws = self.ws
+            self.retry_after = 0
+            asyncio.get_running_loop().call_later(
+                float(data.get('reconnect_in', 0)), lambda: asyncio.create_task(ws.close()))
+        elif data.get('type') == 'status' and data.get('channel') == self.channel_id:
+            self.profile = data.get('profile')
+            self.has_source = bool(data.get('has_source'))
+            if not self.has_source:
+                self.on_source_lost('disconnected on origin')
+
+    def on_frame(self, frame):
+        received = time.time()
+        channel = channels.get(self.channel_id)
+        if channel is None:
+            channel = channels[self.channel_id] = Channel(self.channel_id)
+        if channel.source is None:
+            channel.source = self
+            print(f"🎤 Audio source {self.channel_id} available from origin")
+            # Слушатели без выбранного канала подключаются к первому источнику
+            for listener in listeners:
+                if listener.channel is None:
+                    subscribe(listener, self.channel_id)
+            broadcast_status(f'Audio source {self.channel_id} available')
+        elif channel.source is not self:
+            # Свой источник на edge важнее
+            return
+        if channel.frame_ms is None or channel.profile != self.profile:
+            channel.set_profile(self.profile, frame_duration_ms(frame))
+        # Источник на origin переподключился: нумерация пакетов заново
+        if channel.history.ids and protocol.packet_id(frame) <= channel.history.ids[-1]:
+            channel.history.clear()
+        self.frames += 1
+        self.last_frame = received
+        self.lag.append(received + self.clock_offset - protocol.timestamp(frame))
+        channel.frames_in += 1
+        channel.bytes_in += len(frame)
+        relay_frame(channel, frame)
+
+    def on_source_lost(self, message):
+        channel = channels.get(self.channel_id)
+        if channel is not None and channel.source is self:
+            channel.source = None
+            drop_idle_channel(channel)
+            print(f"🎤 Audio source {self.channel_id} {message}")
+            broadcast_status(f'Audio source {self.channel_id} disconnected'
+                             if live_channel_ids() else 'No audio sources available')
+
+    def stats(self):
+        return {
+            "connected": self.connected,
+            "has_source": self.has_source,
+            "connects": self.connects,
+            "frames": self.frames,
+            "last_frame_age": time.time() - self.last_frame if self.last_frame else None,
+            "clock_offset": self.clock_offset,
+            "clock_rtt": self.clock_rtt,
+            "lag": {f"p{int(point * 100)}": value for point, value in metrics.quantiles(self.lag).items()}
+        }
+
+# Каналы с источником на origin: подписки открываются и закрываются по /health
+async def follow_origin():
+    async with ClientSession() as session:
+        available = True
+        try:
+            while True:
+                try:
+                    async with session.get(ORIGIN_URL + '/health', timeout=ClientTimeout(total=5)) as response:
+                        stats = (await response.json())['stats']['channels']
+                    live = {channel_id for channel_id, info in stats.items() if info.get('source')}
+                except (ClientError, asyncio.TimeoutError, ValueError, KeyError) as e:
+                    # Подписки переподключаются сами, список обновим позже
+                    if available:
+                        print(f"❌ Origin {ORIGIN_URL} unavailable: {e}")
+                    available = False
+                    live = None
+                if live is not None:
+                    available = True
+                    for channel_id in live - upstreams.keys():
+                        upstream = upstreams[channel_id] = Upstream(channel_id)
+                        upstream.start(session)
+                    for channel_id in upstreams.keys() - live:
+                        upstreams.pop(channel_id).stop()
+                await asyncio.sleep(EDGE_POLL)
+        finally:
+            for upstream in upstreams.values():
+                upstream.stop()
+            upstreams.clear()
+
+# С несколькими процессами на origin ходит только первый, остальные
+# получают кадры через кольца
+async def connect_origin(app):
+    task = None
+    if worker_id == 0:
+        print(f"🛰️ Edge relay of {ORIGIN_URL}")
+        task = asyncio.create_task(follow_origin())
+    yield
+    if task is not None:
+        task.cancel()
+
+def edge_stats():
+    return {
+        "origin": ORIGIN_URL,
+        "upstreams": {channel_id: upstream.stats() for channel_id, upstream in upstreams.items()}
+    }
+
 # Setup routes
 app.router.add_get('/', home)
+app.router.add_get('/player-worklet.js', player_worklet)
+app.router.add_get('/decoder-worker.js', decoder_worker)
 app.router.add_get('/health', health)
+if METRICS:
+    app.router.add_get('/metrics', metrics_endpoint)
+if METRICS or SHED_LOOP_LAG or SHED_FANOUT:
+    app.cleanup_ctx.append(measure_loop_lag)
+if BACKPLANE:
+    app.cleanup_ctx.append(connect_backplane)
+if ORIGIN_URL:
+    app.cleanup_ctx.append(connect_origin)
 app.router.add_get('/ws', websocket_handler)
+app.on_shutdown.append(close_connections)
+app.on_startup.append(install_drain_signals)
+if DRAIN_TOKEN:
+    app.router.add_post('/drain', drain_endpoint)
 
 # Start server
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 8000))
-    print(f"🚀 Server started on port {port}")
-    web.run_app(app, host='0.0.0.0', port=port)
\ No newline at end of file
+    if WORKERS > 1:
+        print(f"🚀 Server started on port {port}, {WORKERS} workers")
+        run_workers(port)
+    else:
+        print(f"🚀 Server started on port {port}")
+        web.run_app(app, host='0.0.0.0', port=port)
\ No newline at end of file
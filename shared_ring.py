@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+КОЛЬЦО КАДРОВ В РАЗДЕЛЯЕМОЙ ПАМЯТИ
+Для режима нескольких процессов (WORKERS > 1 в server.py): каждый процесс
+пишет кадры своих источников в своё кольцо, остальные читают чужие кольца
+напрямую из памяти, без пересылки через каналы и сокеты.
+
+Сегмент = заголовок кольца + слоты фиксированного размера:
+
+    write_seq  Q   номер следующей записи
+    slots      I   число слотов
+    slot_size  I   размер слота, байт
+
+    слот:
+    seq        Q   номер записи в слоте (SLOT_EMPTY, пока слот пишется)
+    kind       B   KIND_FRAME или KIND_GONE (источник отключился)
+    id_length  B   длина id канала (UTF-8)
+    profile    B   код профиля задержки (см. server.py)
+    frame_ms   H   длительность кадра, десятые доли мс
+    length     I   длина кадра
+    ...            id канала + кадр
+
+Писатель один, читателей много, блокировок нет: писатель помечает слот
+пустым, пишет данные и только потом номер записи; читатель сверяет номер
+до и после копирования (как seqlock) и пропускает перезаписанные слоты.
+
+Там же счётчики допуска (SharedCounters): у каждого процесса своя строка
+int64, пишет её только он, предел сверяется с суммой по всем строкам.
+"""
+import struct
+import zlib
+from multiprocessing import shared_memory
+
+RING_HEADER = struct.Struct('=QII')
+SLOT_SEQ = struct.Struct('=Q')
+SLOT_META = struct.Struct('=BBBHI')
+SLOT_HEADER_SIZE = SLOT_SEQ.size + SLOT_META.size
+SLOT_EMPTY = 2 ** 64 - 1
+MAX_ID_LENGTH = 255
+
+KIND_FRAME = 0
+KIND_GONE = 1
+
+
+def create(slots, slot_size):
+    """Новый сегмент с пустым кольцом"""
+    shm = shared_memory.SharedMemory(create=True, size=RING_HEADER.size + slots * slot_size)
+    RING_HEADER.pack_into(shm.buf, 0, 0, slots, slot_size)
+    for index in range(slots):
+        SLOT_SEQ.pack_into(shm.buf, RING_HEADER.size + index * slot_size, SLOT_EMPTY)
+    return shm
+
+
+def slot_size(frame_size):
+    """Размер слота, в который помещается кадр frame_size с любым id канала"""
+    return SLOT_HEADER_SIZE + MAX_ID_LENGTH + frame_size
+
+
+def attach(name):
+    return shared_memory.SharedMemory(name=name)
+
+
+class RingWriter:
+    def __init__(self, shm):
+        self.buf = shm.buf
+        self.write_seq, self.slots, self.slot_size = RING_HEADER.unpack_from(self.buf, 0)
+        self.too_large = 0
+
+    def publish(self, kind, channel_id, frame=b'', frame_ms=0.0, profile=0):
+        """Запись в кольцо; False - кадр не помещается в слот"""
+        cid = channel_id.encode()
+        length = len(frame)
+        if len(cid) > MAX_ID_LENGTH or SLOT_HEADER_SIZE + len(cid) + length > self.slot_size:
+            self.too_large += 1
+            return False
+        seq = self.write_seq
+        offset = RING_HEADER.size + (seq % self.slots) * self.slot_size
+        buf = self.buf
+
+        SLOT_SEQ.pack_into(buf, offset, SLOT_EMPTY)
+        SLOT_META.pack_into(buf, offset + SLOT_SEQ.size, kind, len(cid), profile,
+                            min(65535, int(frame_ms * 10)), length)
+        start = offset + SLOT_HEADER_SIZE
+        buf[start:start + len(cid)] = cid
+        start += len(cid)
+        buf[start:start + length] = frame
+        SLOT_SEQ.pack_into(buf, offset, seq)
+
+        self.write_seq = seq + 1
+        struct.pack_into('=Q', buf, 0, self.write_seq)
+        return True
+
+
+class RingReader:
+    """Читатель чужого кольца; начинает с текущей позиции писателя"""
+
+    def __init__(self, shm):
+        self.buf = shm.buf
+        self.read_seq, self.slots, self.slot_size = RING_HEADER.unpack_from(self.buf, 0)
+        self.lost = 0
+
+    def poll(self):
+        """Новые записи: [(kind, channel_id, frame, frame_ms, profile), ...]"""
+        buf = self.buf
+        write_seq = SLOT_SEQ.unpack_from(buf, 0)[0]
+        if write_seq - self.read_seq > self.slots:
+            # Писатель обогнал на круг: самое старое уже перезаписано
+            self.lost += write_seq - self.slots - self.read_seq
+            self.read_seq = write_seq - self.slots
+
+        records = []
+        while self.read_seq < write_seq:
+            seq = self.read_seq
+            self.read_seq += 1
+            offset = RING_HEADER.size + (seq % self.slots) * self.slot_size
+            if SLOT_SEQ.unpack_from(buf, offset)[0] != seq:
+                self.lost += 1
+                continue
+            kind, id_length, profile, frame_ms, length = SLOT_META.unpack_from(buf, offset + SLOT_SEQ.size)
+            start = offset + SLOT_HEADER_SIZE
+            channel_id = bytes(buf[start:start + id_length])
+            frame = bytes(buf[start + id_length:start + id_length + length])
+            # Слот переписали, пока мы копировали
+            if SLOT_SEQ.unpack_from(buf, offset)[0] != seq:
+                self.lost += 1
+                continue
+            records.append((kind, channel_id.decode(), frame, frame_ms / 10, profile))
+        return records
+
+
+class SharedCounters:
+    """Счётчики подключений всех процессов: общий, по адресам и по каналам.
+    Адрес и канал хешируются в одну из buckets корзин; совпадение корзин
+    делает предел строже, но никогда не слабее"""
+
+    TOTAL = 0
+
+    def __init__(self, shm, worker, workers, buckets):
+        self.counts = shm.buf.cast('q')
+        self.workers = workers
+        self.buckets = buckets
+        self.row = self.row_size(buckets)
+        self.own = worker * self.row
+
+    @staticmethod
+    def row_size(buckets):
+        return 1 + 2 * buckets
+
+    @classmethod
+    def create(cls, workers, buckets):
+        """Сегмент с нулями для workers процессов"""
+        size = workers * cls.row_size(buckets) * 8
+        shm = shared_memory.SharedMemory(create=True, size=size)
+        shm.buf[:size] = bytes(size)
+        return shm
+
+    def ip(self, address):
+        return 1 + zlib.crc32(address.encode()) % self.buckets
+
+    def channel(self, channel_id):
+        return 1 + self.buckets + zlib.crc32(channel_id.encode()) % self.buckets
+
+    def add(self, index, delta=1):
+        self.counts[self.own + index] += delta
+
+    def total(self, index):
+        return sum(self.counts[worker * self.row + index] for worker in range(self.workers))
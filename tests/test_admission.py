@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ДОПУСК И СБРОС НАГРУЗКИ
+Оценка перегрузки по сглаженным задержке цикла и времени рассылки: после
+всплеска и тишины релей снова принимает подключения.
+
+Запуск:
+    python -m unittest discover tests
+"""
+import os
+import sys
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import server
+
+# Тактов measure_loop_lag в секунде
+TICKS_PER_SECOND = int(1 / server.LOOP_LAG_INTERVAL)
+
+
+class FanoutRecoveryTest(unittest.TestCase):
+    def setUp(self):
+        patch = mock.patch.object(server, 'SHED_FANOUT', 0.002)
+        patch.start()
+        self.addCleanup(patch.stop)
+        self.addCleanup(self.reset)
+        # Всплеск: рассылка кадра в пять раз дольше порога
+        server.FANOUT_AVG.value = 0.01
+        server.fanout_frames = 0
+
+    def reset(self):
+        server.FANOUT_AVG.value = 0
+        server.LOOP_LAG_AVG.value = 0
+        server.fanout_frames = 0
+
+    def test_overloaded_while_frames_flow(self):
+        for _ in range(10 * TICKS_PER_SECOND):
+            server.fanout_frames += 1
+            server.update_load(0.0)
+        self.assertIn('fan-out', server.overload())
+
+    def test_idle_recovers(self):
+        self.assertIn('fan-out', server.overload())
+        # Источники ушли: за несколько секунд без кадров перегрузка снимается
+        for _ in range(5 * TICKS_PER_SECOND):
+            server.update_load(0.0)
+        self.assertIsNone(server.overload())
+        self.assertIsNone(server.connection_refusal('127.0.0.1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
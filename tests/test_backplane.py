@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ШИНА REDIS МЕЖДУ УЗЛАМИ
+RedisBackplane против маленькой замены redis-server на asyncio: понимает
+PSUBSCRIBE и PUBLISH (RESP2), этого шине достаточно. Кадры узла A доходят
+до узла B, свои кадры узел отбрасывает, после обрыва соединения шина
+подключается снова.
+
+Запуск:
+    python -m unittest discover tests
+"""
+import asyncio
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backplane
+
+
+def bulk(value):
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class RespServer:
+    """Pub/sub из redis-server: PSUBSCRIBE <prefix>*, PUBLISH, PING"""
+
+    def __init__(self):
+        self.writers = set()
+        self.handlers = set()
+        # Подписки: writer -> шаблоны
+        self.patterns = {}
+        self.server = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, '127.0.0.1', 0)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        # Клиенты уже закрылись: даём обработчикам дочитать EOF
+        if self.handlers:
+            await asyncio.wait(self.handlers, timeout=1)
+        self.drop()
+        self.server.close()
+        await self.server.wait_closed()
+
+    def drop(self):
+        """Обрыв всех соединений, как при рестарте Redis"""
+        for writer in list(self.writers):
+            writer.close()
+        self.writers.clear()
+        self.patterns.clear()
+
+    @property
+    def subscribers(self):
+        return len(self.patterns)
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        self.handlers.add(asyncio.current_task())
+        try:
+            while True:
+                command = await backplane.read_reply(reader)
+                name = command[0].upper()
+                if name == b'PSUBSCRIBE':
+                    for count, pattern in enumerate(command[1:], 1):
+                        self.patterns.setdefault(writer, []).append(pattern)
+                        writer.write(b'*3\r\n' + bulk(b'psubscribe') + bulk(pattern) + b':%d\r\n' % count)
+                elif name == b'PUBLISH':
+                    topic, payload = command[1], command[2]
+                    receivers = 0
+                    for subscriber, patterns in self.patterns.items():
+                        for pattern in patterns:
+                            if topic.startswith(pattern.rstrip(b'*')):
+                                subscriber.write(b'*4\r\n' + bulk(b'pmessage') + bulk(pattern)
+                                                 + bulk(topic) + bulk(payload))
+                                receivers += 1
+                    writer.write(b':%d\r\n' % receivers)
+                elif name == b'PING':
+                    writer.write(b'+PONG\r\n')
+                else:
+                    writer.write(b'-ERR unknown command\r\n')
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.handlers.discard(asyncio.current_task())
+            self.writers.discard(writer)
+            self.patterns.pop(writer, None)
+            writer.close()
+
+
+class Node:
+    """Узел релея: шина и всё, что она ему передала"""
+
+    def __init__(self, url, node_id):
+        self.bus = backplane.RedisBackplane(url, node_id)
+        self.frames = asyncio.Queue()
+        self.events = asyncio.Queue()
+
+    async def start(self):
+        await self.bus.start(lambda *frame: self.frames.put_nowait(frame),
+                             lambda *event: self.events.put_nowait(event))
+
+
+class RedisBackplaneTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.redis = RespServer()
+        url = f'redis://127.0.0.1:{await self.redis.start()}'
+        self.a = Node(url, 'node-a')
+        self.b = Node(url, 'node-b')
+        for node in (self.a, self.b):
+            await node.start()
+        await self.wait_connected()
+
+    async def asyncTearDown(self):
+        for node in (self.a, self.b):
+            await node.bus.close()
+        await self.redis.close()
+
+    async def wait_connected(self):
+        for _ in range(100):
+            if self.a.bus.connected and self.b.bus.connected and self.redis.subscribers == 2:
+                return
+            await asyncio.sleep(0.05)
+        self.fail('backplane did not connect')
+
+    async def test_frame_reaches_other_node(self):
+        self.a.bus.publish_frame('mic', b'frame-1', 20.0, 2)
+        frame = await asyncio.wait_for(self.b.frames.get(), 2)
+        self.assertEqual(frame, ('node-a', 'mic', b'frame-1', 20.0, 2))
+        self.assertEqual(self.a.bus.published, 1)
+        self.assertEqual(self.b.bus.received, 1)
+
+    async def test_event_reaches_other_node(self):
+        self.a.bus.publish_event('mic', {'type': 'source_gone'})
+        event = await asyncio.wait_for(self.b.events.get(), 2)
+        self.assertEqual(event, ('node-a', 'mic', {'type': 'source_gone'}))
+
+    async def test_own_frames_ignored(self):
+        self.a.bus.publish_frame('mic', b'echo')
+        self.a.bus.publish_event('mic', {'type': 'source_gone'})
+        # До B дошло - значит, и до подписки A тоже
+        await asyncio.wait_for(self.b.frames.get(), 2)
+        await asyncio.wait_for(self.b.events.get(), 2)
+        self.assertTrue(self.a.frames.empty())
+        self.assertTrue(self.a.events.empty())
+        self.assertEqual(self.a.bus.received, 0)
+
+    async def test_reconnects_after_drop(self):
+        self.redis.drop()
+        for _ in range(40):
+            if not self.a.bus.connected and not self.b.bus.connected:
+                break
+            await asyncio.sleep(0.05)
+        self.assertFalse(self.a.bus.connected)
+        # Пока соединения нет, кадры отбрасываются, а не копятся
+        self.a.bus.publish_frame('mic', b'lost')
+        self.assertEqual(self.a.bus.dropped, 1)
+
+        await self.wait_connected()
+        self.a.bus.publish_frame('mic', b'after-reconnect')
+        frame = await asyncio.wait_for(self.b.frames.get(), 2)
+        self.assertEqual(frame[2], b'after-reconnect')
+
+
+if __name__ == '__main__':
+    unittest.main()
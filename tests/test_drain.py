@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+ПЛАВНАЯ ОСТАНОВКА (DRAIN)
+Запускает server.py отдельным процессом (как benchmarks/relay_load.py) и
+проверяет оба способа начать drain: SIGUSR1 и POST /drain с DRAIN_TOKEN.
+Подключённый слушатель получает статус drain, новые соединения и /health
+получают отказ, в конце окна процесс выходит сам.
+
+Запуск:
+    python -m unittest discover tests
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import unittest
+
+import aiohttp
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DRAIN_TOKEN = 'test-token'
+DRAIN_WINDOW = 1.0
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class DrainTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        port = free_port()
+        self.url = f'http://127.0.0.1:{port}'
+        self.proc = subprocess.Popen(
+            [sys.executable, os.path.join(ROOT, 'server.py')],
+            cwd=ROOT,
+            env=dict(os.environ, PORT=str(port), DRAIN_TOKEN=DRAIN_TOKEN, DRAIN_WINDOW=str(DRAIN_WINDOW)),
+            stdout=subprocess.DEVNULL
+        )
+        self.addCleanup(self.stop_process)
+        self.session = aiohttp.ClientSession()
+        # Строка о старте печатается до того, как порт открыт: ждём /health
+        for _ in range(100):
+            try:
+                async with self.session.get(self.url + '/health') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.1)
+        self.fail('server did not start')
+
+    async def asyncTearDown(self):
+        await self.session.close()
+
+    def stop_process(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+
+    async def listener(self):
+        ws = await self.session.ws_connect(self.url + '/ws')
+        await ws.send_str(json.dumps({'type': 'listener'}))
+        status = await ws.receive_json(timeout=2)
+        self.assertEqual(status['type'], 'status')
+        return ws
+
+    async def assert_drains(self, ws):
+        status = await ws.receive_json(timeout=2)
+        self.assertTrue(status['drain'])
+        self.assertLessEqual(status['reconnect_in'], DRAIN_WINDOW / 2)
+
+        # Новых не принимаем, балансировщик видит 503
+        async with self.session.get(self.url + '/health') as response:
+            self.assertEqual(response.status, 503)
+        refused = await self.session.ws_connect(self.url + '/ws')
+        goodbye = await refused.receive_json(timeout=2)
+        self.assertEqual(goodbye['refused'], 'draining')
+        await refused.receive(timeout=2)
+        self.assertEqual(refused.close_code, aiohttp.WSCloseCode.SERVICE_RESTART)
+
+        await refused.close()
+
+        # Слушатель не ушёл сам: прощальный статус и закрытие в конце окна,
+        # затем процесс выходит
+        goodbye = await ws.receive_json(timeout=DRAIN_WINDOW + 2)
+        self.assertEqual(goodbye['message'], 'Server draining, reconnect elsewhere')
+        await ws.receive(timeout=2)
+        self.assertEqual(ws.close_code, aiohttp.WSCloseCode.SERVICE_RESTART)
+        await ws.close()
+        self.assertEqual(await asyncio.to_thread(self.proc.wait, DRAIN_WINDOW + 5), 0)
+
+    @unittest.skipUnless(hasattr(signal, 'SIGUSR1'), 'no SIGUSR1')
+    async def test_sigusr1(self):
+        ws = await self.listener()
+        self.proc.send_signal(signal.SIGUSR1)
+        await self.assert_drains(ws)
+
+    async def test_drain_endpoint(self):
+        ws = await self.listener()
+        headers = {'Authorization': f'Bearer {DRAIN_TOKEN}'}
+        async with self.session.post(self.url + '/drain', headers=headers) as response:
+            self.assertEqual(response.status, 202)
+            self.assertEqual((await response.json())['status'], 'draining')
+        await self.assert_drains(ws)
+
+    async def test_drain_endpoint_rejects_bad_token(self):
+        for headers in ({}, {'Authorization': 'Bearer wrong'}, {'Authorization': DRAIN_TOKEN}):
+            async with self.session.post(self.url + '/drain', headers=headers) as response:
+                self.assertEqual(response.status, 401)
+        async with self.session.get(self.url + '/health') as response:
+            self.assertEqual(response.status, 200)
+
+
+if __name__ == '__main__':
+    unittest.main()